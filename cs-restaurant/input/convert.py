@@ -8,7 +8,7 @@ import json
 import re
 from argparse import ArgumentParser
 from collections import deque
-from itertools import islice
+from itertools import islice, izip_longest
 
 from ufal.morphodita import Tagger, Forms, TaggedLemma, TaggedLemmas, TokenRanges, Analyses, Indices
 
@@ -17,6 +17,7 @@ import os
 sys.path.insert(0, os.path.abspath('../../'))  # add tgen main directory to modules path
 from tgen.logf import log_info
 from tgen.data import Abst, DAI, DA
+from tgen.convert import ordered_map, OutputFiles
 
 # Start IPdb on error in interactive mode
 from tgen.debug import exc_info_hook
@@ -125,168 +126,77 @@ class MorphoAnalyzer(object):
                              in zip(self._forms_buf, self._analyses_buf, self._indices_buf)])
         return analyzed
 
-    def process_files(self, input_text_file, input_da_file, skip_hello=False):
-        """Load DAs & sentences, obtain abstraction instructions, and store it all in member
-        variables (to be used later by writing methods).
-        @param input_text_file: path to the input file with sentences
-        @param input_da_file: path to the input file with DAs
-        @param skip_hello: skip hello() DAs (remove them from the output?)
+    def process_item(self, item):
+        """Analyze and delexicalize one sentence-DA pair.
+        @param item: a tuple of item number, DA, and sentence (string)
+        @return: a tuple of DA, analyzed sentence (list of form-lemma-tag tuples), \
+            delexicalized sentence, abstraction instructions, and delexicalized DA
         """
-        # load DAs
-        self._das = []
-        with codecs.open(input_da_file, 'r', encoding='UTF-8') as fh:
-            for line in fh:
-                self._das.append(DA.parse(line.strip()))
-        # load & process sentences
-        self._sents = []
-        with codecs.open(input_text_file, 'r', encoding='UTF-8') as fh:
-            for line in fh:
-                self._sents.append(self.analyze(line.strip()))
-        assert(len(self._das) == len(self._sents))
-        # skip hello() DAs, if required
-        if skip_hello:
-            pos = 0
-            while pos < len(self._das):
-                da = self._das[pos]
-                if len(da) == 1 and da[0].da_type == 'hello':
-                    del self._das[pos]
-                    del self._sents[pos]
-                else:
-                    pos += 1
-        # delexicalize DAs and sentences
-        self._delex_texts()
-        self._delex_das()
-
-    def buf_length(self):
-        """Return the number of sentence-DA pairs currently loaded in the buffer."""
-        return len(self._sents)
-
-    def _write_plain(self, output_file, data_items):
-        with codecs.open(output_file, 'wb', encoding='UTF-8') as fh:
-            for data_item in data_items:
-                print >> fh, unicode(data_item)
-
-    def _write_conll(self, output_file, data_items):
-        with codecs.open(output_file, 'wb', encoding='UTF-8') as fh:
-            for line in data_items:
-                for idx, tok in enumerate(line, start=1):
-                    print >> fh, "\t".join((str(idx),
-                                            tok[0].replace(' ', '_'),
-                                            tok[1].replace(' ', '_'),
-                                            '_', tok[2], '_',
-                                            '0', '_', '_', '_'))
-                print >> fh
-
-    def _write_interleaved(self, output_file, data_items):
-        with codecs.open(output_file, 'wb', encoding='UTF-8') as fh:
-            for line in data_items:
-                for _, lemma, tag in line:
-                    print >> fh, lemma.replace(' ', '_'), tag,
-                print >> fh
-
-    def write_text(self, data_file, out_format, subrange, delex=False):
-        """Write output sentences for the given data subrange.
-        @param data_file: output file name
-        @param out_format: output format ('conll' -- CoNLL-U morphology, \
-            'interleaved' -- lemma/tag interleaved, 'plain' -- plain text)
-        @param subrange: data range (slice) from buffers to write
-        @param delex: delexicalize? false by default
-        """
-        if delex:
-            texts = self._delexed_texts[subrange]
-        else:
-            texts = self._sents[subrange]
-        if out_format == 'interleaved':
-            self._write_interleaved(data_file, texts)
-        elif out_format == 'conll':
-            self._write_conll(data_file, texts)
-        else:
-            self._write_plain(data_file, [" ".join([form for form, _, _ in sent])
-                                          for sent in texts])
-
-    def write_absts(self, data_file, subrange):
-        """Write delexicalization/abstraction instructions (for the given data subrange).
-        @param data_file: output file name
-        @param subrange: data range (slice) from buffers to write
+        text_idx, da, sent = item
+        text = self.analyze(sent)
+        delex_text, absts = self._delex_text(text_idx, text, da)
+        return da, text, delex_text, absts, self._delex_da(da)
+
+    def _delex_da(self, da):
+        """Delexicalize a DA, return the result as a new DA."""
+        delex_da = DA()
+        for dai in da:
+            delex_dai = DAI(dai.da_type, dai.slot,
+                            'X-' + dai.slot
+                            if (dai.value not in [None, 'none', 'dont_care'] and
+                                dai.slot in self._abst_slots)
+                            else dai.value)
+            delex_da.append(delex_dai)
+        return delex_da
+
+    def _delex_text(self, text_idx, text, da):
+        """Delexicalize a sentence, return the delexicalized sentence along with the
+        delexicalization instructions used for the operation.
+        @param text_idx: number of the sentence (for logging)
+        @param text: the analyzed sentence (list of form-lemma-tag tuples)
+        @param da: the corresponding DA
+        @return: a tuple of delexicalized sentence and list of abstraction instructions
         """
-        self._write_plain(data_file, ["\t".join([unicode(abst_) for abst_ in abst])
-                                      for abst in self._absts[subrange]])
-
-    def write_das(self, data_file, subrange, delex=False):
-        """Write DAs (for the given subrange).
-        @param data_file: output file name
-        @param subrange: data range (slice) from buffers to write
-        @param delex: delexicalize? false by default
-        """
-        if delex:
-            das = self._delexed_das[subrange]
-        else:
-            das = self._das[subrange]
-        self._write_plain(data_file, das)
-
-    def _delex_das(self):
-        """Delexicalize DAs in the buffers, save them separately."""
-        out = []
-        for da in self._das:
-            delex_da = DA()
-            for dai in da:
-                delex_dai = DAI(dai.da_type, dai.slot,
-                                'X-' + dai.slot
-                                if (dai.value not in [None, 'none', 'dont_care'] and
-                                    dai.slot in self._abst_slots)
-                                else dai.value)
-                delex_da.append(delex_dai)
-            out.append(delex_da)
-        self._delexed_das = out
-
-    def _delex_texts(self):
-        """Delexicalize texts in the buffers and save them separately in the member variables,
-        along with the delexicalization instructions used for the operation."""
-        self._delexed_texts = []
-        self._absts = []
-        for text_idx, (text, da) in enumerate(zip(self._sents, self._das)):
-            delex_text = []
-            absts = []
-            # do the delexicalization, keep track of which slots we used
-            for tok_idx, (form, lemma, tag) in enumerate(text):
-                # abstract away from numbers
-                abst_form = re.sub(r'( |^)[0-9]+( |$)', r'\1_\2', form.lower())
-                abst_lemma = re.sub(r'( |^)[0-9]+( |$)', r'\1_\2', lemma)
-                # try to find if the surface form belongs to some slot
-                slot, value = self._rev_sf_dict.get((abst_form, abst_lemma, tag), (None, None))
-                # if we found a slot, get back the numbers
-                if slot:
-                    for num_match in re.finditer(r'(?: |^)([0-9]+)(?: |$)', lemma):
-                        value = re.sub(r'_', num_match.group(1), value, count=1)
-                # fall back to directly comparing against the DA value
-                else:
-                    slot = da.has_value(lemma)
-                    value = lemma
-
-                # if we found something, delexicalize it
-                if (slot and slot in self._abst_slots and
-                        da.value_for_slot(slot) not in [None, 'none', 'dont_care']):
-                    delex_text.append(('X-' + slot, 'X-' + slot, tag))
-                    absts.append(Abst(slot, value, form, tok_idx, tok_idx + 1))
-                # otherwise keep the token as it is
-                else:
-                    delex_text.append((form, lemma, tag))
-            # fix coordinated delexicalized values
-            self._delex_fix_coords(delex_text, da, absts)
-            covered_slots = set([a.slot for a in absts])
-            # check and warn if we left isomething non-delexicalized
-            for dai in da:
-                if (dai.slot in self._abst_slots and
-                        dai.value not in [None, 'none', 'dont_care'] and
-                        dai.slot not in covered_slots):
-                    log_info("Cannot delexicalize slot  %s  at %d:\nDA: %s\nTx: %s\n" %
-                             (dai.slot,
-                              text_idx,
-                              unicode(da),
-                              " ".join([form for form, _, _ in text])))
-            # save the delexicalized text and the delexicalization instructions
-            self._delexed_texts.append(delex_text)
-            self._absts.append(absts)
+        delex_text = []
+        absts = []
+        # do the delexicalization, keep track of which slots we used
+        for tok_idx, (form, lemma, tag) in enumerate(text):
+            # abstract away from numbers
+            abst_form = re.sub(r'( |^)[0-9]+( |$)', r'\1_\2', form.lower())
+            abst_lemma = re.sub(r'( |^)[0-9]+( |$)', r'\1_\2', lemma)
+            # try to find if the surface form belongs to some slot
+            slot, value = self._rev_sf_dict.get((abst_form, abst_lemma, tag), (None, None))
+            # if we found a slot, get back the numbers
+            if slot:
+                for num_match in re.finditer(r'(?: |^)([0-9]+)(?: |$)', lemma):
+                    value = re.sub(r'_', num_match.group(1), value, count=1)
+            # fall back to directly comparing against the DA value
+            else:
+                slot = da.has_value(lemma)
+                value = lemma
+
+            # if we found something, delexicalize it
+            if (slot and slot in self._abst_slots and
+                    da.value_for_slot(slot) not in [None, 'none', 'dont_care']):
+                delex_text.append(('X-' + slot, 'X-' + slot, tag))
+                absts.append(Abst(slot, value, form, tok_idx, tok_idx + 1))
+            # otherwise keep the token as it is
+            else:
+                delex_text.append((form, lemma, tag))
+        # fix coordinated delexicalized values
+        self._delex_fix_coords(delex_text, da, absts)
+        covered_slots = set([a.slot for a in absts])
+        # check and warn if we left isomething non-delexicalized
+        for dai in da:
+            if (dai.slot in self._abst_slots and
+                    dai.value not in [None, 'none', 'dont_care'] and
+                    dai.slot not in covered_slots):
+                log_info("Cannot delexicalize slot  %s  at %d:\nDA: %s\nTx: %s\n" %
+                         (dai.slot,
+                          text_idx,
+                          unicode(da),
+                          " ".join([form for form, _, _ in text])))
+        return delex_text, absts
 
     def _delex_fix_coords(self, text, da, absts):
         """Fix (merge) coordinated values in delexicalized text (X-slot and X-slot -> X-slot).
@@ -309,14 +219,93 @@ class MorphoAnalyzer(object):
             idx += 1
 
 
+#
+# Input & output
+
+
+def read_items(input_da_file, input_text_file, skip_hello=False):
+    """Read DAs & sentences from the input files lazily.
+    @param input_da_file: path to the input file with DAs
+    @param input_text_file: path to the input file with sentences
+    @param skip_hello: skip hello() DAs (remove them from the output?)
+    @return: generator of tuples of item number, DA, and sentence
+    """
+    with codecs.open(input_da_file, 'r', encoding='UTF-8') as da_fh, \
+            codecs.open(input_text_file, 'r', encoding='UTF-8') as text_fh:
+        text_idx = 0
+        for da_line, text_line in izip_longest(da_fh, text_fh):
+            assert da_line is not None and text_line is not None
+            da = DA.parse(da_line.strip())
+            if skip_hello and len(da) == 1 and da[0].da_type == 'hello':
+                continue
+            yield text_idx, da, text_line.strip()
+            text_idx += 1
+
+
+def write_plain(fh, data_item):
+    print >> fh, unicode(data_item)
+
+
+def write_conll(fh, line):
+    for idx, tok in enumerate(line, start=1):
+        print >> fh, "\t".join((str(idx),
+                                tok[0].replace(' ', '_'),
+                                tok[1].replace(' ', '_'),
+                                '_', tok[2], '_',
+                                '0', '_', '_', '_'))
+    print >> fh
+
+
+def write_interleaved(fh, line):
+    for _, lemma, tag in line:
+        print >> fh, lemma.replace(' ', '_'), tag,
+    print >> fh
+
+
+def write_item(out, da, text, delex_text, absts, delex_da):
+    """Write one processed item into all output files.
+    @param out: output files (`OutputFiles`)
+    @param da: the original DA
+    @param text: the analyzed sentence (list of form-lemma-tag tuples)
+    @param delex_text: the delexicalized sentence (list of form-lemma-tag tuples)
+    @param absts: the abstraction instructions
+    @param delex_da: the delexicalized DA
+    """
+    write_plain(out['abst'], "\t".join([unicode(abst_) for abst_ in absts]))
+
+    write_plain(out['das_l'], da)
+    write_plain(out['das'], delex_da)
+
+    write_plain(out['text_l'], " ".join([form for form, _, _ in text]))
+    write_plain(out['text'], " ".join([form for form, _, _ in delex_text]))
+    write_interleaved(out['tls_l'], text)
+    write_interleaved(out['tls'], delex_text)
+    write_conll(out['text_l_conll'], text)
+    write_conll(out['text_conll'], delex_text)
+
+
+# analyzer used by `process_item` (in each worker process, if running in parallel)
+_analyzer = None
+
+
+def init_analyzer(tagger_model, abst_slots, surface_forms_fname):
+    """Initialize the analyzer (in the current/worker process)."""
+    global _analyzer
+    _analyzer = MorphoAnalyzer(tagger_model, abst_slots)
+    _analyzer.load_surface_forms(surface_forms_fname)
+
+
+def process_item(item):
+    """Analyze & delexicalize one item using the current analyzer (see `init_analyzer`)."""
+    return _analyzer.process_item(item)
+
+
 def convert(args):
     """Main conversion function (using command-line arguments as parsed by Argparse)."""
     log_info('Loading...')
-    analyzer = MorphoAnalyzer(args.tagger_model, args.abst_slots)
-    analyzer.load_surface_forms(args.surface_forms)
-    log_info('Processing input files...')
-    analyzer.process_files(args.input_text_file, args.input_da_file, args.skip_hello)
-    log_info('Loaded %d data items.' % analyzer.buf_length())
+    num_items = sum(1 for _ in read_items(args.input_da_file, args.input_text_file,
+                                          args.skip_hello))
+    log_info('Found %d data items.' % num_items)
 
     # outputs: plain delex, plain lex, interleaved delex & lex, CoNLL-U delex & lex, DAs, abstrs
     # TODO maybe do relexicalization, but not now (no time)
@@ -328,37 +317,37 @@ def convert(args):
         assert len(out_names) == len(data_sizes)
         # compute sizes for all but the 1st part (+ round them)
         total = float(sum(data_sizes))
-        remain = analyzer.buf_length()
+        remain = num_items
         for part_no in xrange(len(data_sizes) - 1, 0, -1):
-            part_size = int(round(analyzer.buf_length() * (data_sizes[part_no] / total)))
+            part_size = int(round(num_items * (data_sizes[part_no] / total)))
             data_sizes[part_no] = part_size
             remain -= part_size
         # put whatever remained into the 1st part
         data_sizes[0] = remain
     else:
         # use just one part -- containing all the data
-        data_sizes = [analyzer.buf_length()]
+        data_sizes = [num_items]
         out_names = [args.out_prefix]
 
-    # write all data parts
-    offset = 0
+    # process the data (in parallel, if required) and write all data parts as we go
+    log_info('Processing input files...')
+    results = ordered_map(process_item,
+                          read_items(args.input_da_file, args.input_text_file, args.skip_hello),
+                          args.workers, init_analyzer,
+                          (args.tagger_model, args.abst_slots, args.surface_forms))
     for part_size, part_name in zip(data_sizes, out_names):
         log_info('Writing %s (size: %d)...' % (part_name, part_size))
-        subrange = slice(offset, offset + part_size)
-
-        analyzer.write_absts(part_name + '-abst.txt', subrange)
-
-        analyzer.write_das(part_name + '-das_l.txt', subrange)
-        analyzer.write_das(part_name + '-das.txt', subrange, delex=True)
-
-        analyzer.write_text(part_name + '-text_l.txt', 'plain', subrange)
-        analyzer.write_text(part_name + '-text.txt', 'plain', subrange, delex=True)
-        analyzer.write_text(part_name + '-tls_l.txt', 'interleaved', subrange)
-        analyzer.write_text(part_name + '-tls.txt', 'interleaved', subrange, delex=True)
-        analyzer.write_text(part_name + '-text_l.conll', 'conll', subrange)
-        analyzer.write_text(part_name + '-text.conll', 'conll', subrange, delex=True)
-
-        offset += part_size
+        with OutputFiles(abst=part_name + '-abst.txt',
+                         das_l=part_name + '-das_l.txt',
+                         das=part_name + '-das.txt',
+                         text_l=part_name + '-text_l.txt',
+                         text=part_name + '-text.txt',
+                         tls_l=part_name + '-tls_l.txt',
+                         tls=part_name + '-tls.txt',
+                         text_l_conll=part_name + '-text_l.conll',
+                         text_conll=part_name + '-text.conll') as out:
+            for result in islice(results, part_size):
+                write_item(out, *result)
 
 
 if __name__ == '__main__':
@@ -372,6 +361,8 @@ if __name__ == '__main__':
     ap.add_argument('-a', '--abst-slots', help='List of slots to delexicalize/abstract (comma-separated)')
     ap.add_argument('-s', '--split', help='Colon-separated sizes of splits (e.g.: 3:1:1)')
     ap.add_argument('-i', '--skip-hello', help='Ignore hello() DAs', action='store_true')
+    ap.add_argument('-w', '--workers', type=int, default=1,
+                    help='Number of parallel processes used for analysis & delexicalization')
 
     args = ap.parse_args()
     convert(args)
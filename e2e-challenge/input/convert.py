@@ -11,7 +11,6 @@ from __future__ import unicode_literals
 import re
 import argparse
 import unicodecsv as csv
-import codecs
 from collections import OrderedDict
 
 import os
@@ -22,6 +21,7 @@ sys.path.insert(0, os.path.abspath('../../'))
 from tgen.data import DA
 from tgen.delex import delex_sent
 from tgen.futil import tokenize
+from tgen.convert import ordered_map, OutputFiles
 
 from tgen.debug import exc_info_hook
 
@@ -34,6 +34,33 @@ def filter_abst(abst, slots_to_abstract):
     return [a for a in abst if a.slot in slots_to_abstract]
 
 
+# conversion settings (set by `init_settings`, in each worker process)
+_settings = {}
+
+
+def init_settings(slots_to_abstract, slot_names):
+    """Set conversion settings for `convert_instance`."""
+    _settings['slots_to_abstract'] = slots_to_abstract
+    _settings['slot_names'] = slot_names
+
+
+def convert_instance(row):
+    """Convert one instance (a CSV row with MR and text): parse the DA, tokenize & delexicalize
+    the text.
+    @return: a tuple of concrete DA, abstracted DA, concrete text, abstracted text, \
+        and abstraction instructions
+    """
+    mr, conc = row
+    conc_da = DA.parse_diligent_da(mr)
+    conc_da.sort()
+
+    text, da, abst = delex_sent(conc_da, tokenize(conc), _settings['slots_to_abstract'],
+                                _settings['slot_names'], repeated=True)
+    text = text.lower().replace('x-', 'X-')  # lowercase all but placeholders
+    da.sort()
+    return conc_da, da, conc, text, abst
+
+
 def convert(args):
     """Main function – read in the CSV data and output TGEN-specific files."""
 
@@ -42,89 +69,57 @@ def convert(args):
     if args.abstract is not None:
         slots_to_abstract.update(re.split(r'[, ]+', args.abstract))
 
-    # initialize storage
-    conc_das = []
-    das = []  # abstracted DAs
-    concs = []  # concrete sentences
-    texts = []  # abstracted sentences
-    absts = []  # abstraction descriptions
-
     # statistics about different DAs
     da_keys = {}
     insts = 0
-
-    def process_instance(da, conc):
-        da.sort()
-        conc_das.append(da)
-
-        text, da, abst = delex_sent(da, tokenize(conc), slots_to_abstract, args.slot_names, repeated=True)
-        text = text.lower().replace('x-', 'X-')  # lowercase all but placeholders
-        da.sort()
-
-        da_keys[unicode(da)] = da_keys.get(unicode(da), 0) + 1
-        das.append(da)
-        concs.append(conc)
-        absts.append(abst)
-        texts.append(text)
-
-    # process the input data and store it in memory
-    with open(args.in_file, 'r') as fh:
+    dais_total = 0
+    max_da_len = 0
+    max_text_len = 0
+
+    # for multi-ref mode, group by the same conc DA (need to keep everything in memory);
+    # otherwise, write outputs as we go
+    groups = OrderedDict()
+    out = OutputFiles(das=args.out_name + '-das.txt', conc_das=args.out_name + '-conc_das.txt',
+                      conc=args.out_name + '-conc.txt', abst=args.out_name + '-abst.txt',
+                      text=args.out_name + '-text.txt')
+
+    # process the input data (in parallel, if required)
+    with out, open(args.in_file, 'r') as fh:
         csvread = csv.reader(fh, encoding='UTF-8')
         csvread.next()  # skip header
-        for mr, text in csvread:
-            da = DA.parse_diligent_da(mr)
-            process_instance(da, text)
+        for conc_da, da, conc, text, abst in ordered_map(convert_instance, csvread, args.workers,
+                                                         init_settings,
+                                                         (slots_to_abstract, args.slot_names)):
+            da_keys[unicode(da)] = da_keys.get(unicode(da), 0) + 1
             insts += 1
+            dais_total += len(da)
+            max_da_len = max(max_da_len, len(da))
+            max_text_len = max(max_text_len, text.count(' ') + 1)
+
+            if args.multi_ref:
+                group = groups.get(unicode(conc_da), {})
+                group['da'] = da
+                group['conc_da'] = conc_da
+                group['abst'] = group.get('abst', []) + [abst]
+                group['conc'] = group.get('conc', []) + [conc]
+                group['text'] = group.get('text', []) + [text]
+                groups[unicode(conc_da)] = group
+            else:
+                # (abstraction instructions are coordinated with multi-ref mode)
+                out.write(das=unicode(da), conc_das=unicode(conc_da), conc=conc, text=text,
+                          abst="\t".join([unicode(a) for a in abst]))
 
         print 'Processed', insts, 'instances.'
         print '%d different DAs.' % len(da_keys)
-        print '%.2f average DAIs per DA' % (sum([len(d) for d in das]) / float(len(das)))
-        print 'Max DA len: %d, max text len: %d' % (max([len(da) for da in das]),
-                                                    max([text.count(' ') + 1 for text in texts]))
-
-    # for multi-ref mode, group by the same conc DA
-    if args.multi_ref:
-        groups = OrderedDict()
-        for conc_da, da, conc, text, abst in zip(conc_das, das, concs, texts, absts):
-            group = groups.get(unicode(conc_da), {})
-            group['da'] = da
-            group['conc_da'] = conc_da
-            group['abst'] = group.get('abst', []) + [abst]
-            group['conc'] = group.get('conc', []) + [conc]
-            group['text'] = group.get('text', []) + [text]
-            groups[unicode(conc_da)] = group
-
-        conc_das, das, concs, texts, absts = [], [], [], [], []
-        for group in groups.itervalues():
-            conc_das.append(group['conc_da'])
-            das.append(group['da'])
-            concs.append("\n".join(group['conc']) + "\n")
-            texts.append("\n".join(group['text']) + "\n")
-            absts.append("\n".join(["\t".join([unicode(a) for a in absts_])
-                                    for absts_ in group['abst']]) + "\n")
-    else:
-        # convert abstraction instruction to string (coordinate output with multi-ref mode)
-        absts = ["\t".join([unicode(a) for a in absts_]) for absts_ in absts]
-
-    with codecs.open(args.out_name + '-das.txt', 'w', 'UTF-8') as fh:
-        for da in das:
-            fh.write(unicode(da) + "\n")
+        print '%.2f average DAIs per DA' % (dais_total / float(insts))
+        print 'Max DA len: %d, max text len: %d' % (max_da_len, max_text_len)
 
-    with codecs.open(args.out_name + '-conc_das.txt', 'w', 'UTF-8') as fh:
-        for conc_da in conc_das:
-            fh.write(unicode(conc_da) + "\n")
-
-    with codecs.open(args.out_name + '-conc.txt', 'w', 'UTF-8') as fh:
-        for conc in concs:
-            fh.write(conc + "\n")
-
-    with codecs.open(args.out_name + '-abst.txt', 'w', 'UTF-8') as fh:
-        for abst in absts:
-            fh.write(abst + "\n")
-
-    with codecs.open(args.out_name + '-text.txt', 'w', 'UTF-8') as fh:
-        for text in texts:
-            fh.write(text + "\n")
+        for group in groups.itervalues():
+            out.write(das=unicode(group['da']), conc_das=unicode(group['conc_da']),
+                      conc="\n".join(group['conc']) + "\n",
+                      text="\n".join(group['text']) + "\n",
+                      abst="\n".join(["\t".join([unicode(a) for a in absts_])
+                                      for absts_ in group['abst']]) + "\n")
 
 
 if __name__ == '__main__':
@@ -135,5 +130,7 @@ if __name__ == '__main__':
     argp.add_argument('-m', '--multi-ref',
                       help='Multiple reference mode: relexicalize all possible references', action='store_true')
     argp.add_argument('-n', '--slot-names', help='Include slot names in delexicalized texts', action='store_true')
+    argp.add_argument('-w', '--workers', type=int, default=1,
+                      help='Number of parallel processes used for conversion')
     args = argp.parse_args()
     convert(args)
@@ -16,8 +16,9 @@ candgen_train -- train candidate generator (probability distributions)
 
 percrank_train -- train perceptron global ranker
     - arguments: [-d debug-output] [-c candgen-model] [-s data-portion] [-j parallel-jobs] [-w parallel-work-dir] \\
-                 [-r rand_seed] [-e experiment_id] ranker-config train-das train-ttrees output-model
+                 [-b sge|local] [-r rand_seed] [-e experiment_id] ranker-config train-das train-ttrees output-model
                  * r = random seed is used as a string; no seed change if empty string is passed
+                 * b = run parallel jobs on the SGE cluster (default) or as local processes
 
 sample_gen -- sampling generation (oracle experiment; rather obsolete)
     - arguments: [-n trees-per-da] [-o oracle-eval-ttrees] [-w output-ttrees] candgen-model test-das
@@ -31,11 +32,23 @@ treecl_train -- train a tree classifier (part of candidate generator, accessible
 
 seq2seq_train -- train a seq2seq generator (via trees or strings)
     - arguments: [-d debug-output] [-s data-portion] [-r rand-seed] [-j parallel-models] [-w parallel-work-dir] \\
-                 [-e experiment-id] config train-das train-trees seq2seq-model
+                 [-b sge|local] [-e experiment-id] [-C compiled-corpus] config train-das train-trees seq2seq-model
+
+compile_corpus -- preprocess seq2seq generator training data into a compiled corpus (for faster training)
+    - arguments: [-s data-portion] [-c context-file] [-v valid-data] config train-das train-trees compiled-corpus
 
 seq2seq_gen -- evaluate the seq2seq generator
     - arguments: [-e eval-ttrees-file] [-r eval-ttrees-selector] [-t target-selector] [-d debug-output]
-                 [-w output-ttrees] [-b beam-size-override] seq2seq-model test-das
+                 [-w output-ttrees] [-b beam-size-override] [-B batch-size] [--eval-workers N]
+                 seq2seq-model test-das
+
+seq2seq_serve -- run a persistent seq2seq generation server (JSON lines on a Unix socket or stdin/stdout)
+    - arguments: [-s socket-path] [-b beam-size-override] [-B max-batch-size] [-W max-wait-ms]
+                 [-d debug-output] seq2seq-model
+
+seq2seq_freeze -- save the frozen inference graph of a trained seq2seq generator (used automatically
+        by seq2seq_gen and seq2seq_serve for faster loading, until the model is overwritten)
+    - arguments: seq2seq-model
 
 rerank_cl_train -- train the reranking classifier (part of seq2seq generator, accessible
         externally here for debugging purposes)
@@ -51,13 +64,18 @@ import sys
 from getopt import getopt
 import platform
 import os
+import time
+import threading
+import Queue
 from argparse import ArgumentParser
+from collections import deque, defaultdict
+from itertools import izip
 
 from tgen.config import Config
 from tgen.logf import log_info, set_debug_stream, log_debug, log_warn
 from tgen.futil import file_stream, read_das, read_ttrees, chunk_list, add_bundle_text, \
-    trees_from_doc, ttrees_from_doc, write_ttrees, tokens_from_doc, read_tokens, write_tokens, \
-    postprocess_tokens, create_ttree_doc
+    trees_from_doc, ttrees_from_doc, write_ttrees, read_tokens, write_tokens, \
+    postprocess_tokens, create_ttree_doc, iter_das, iter_tokens, tokens_from_file, chunk_iter
 from tgen.candgen import RandomCandidateGenerator
 from tgen.rank import PerceptronRanker
 from tgen.planner import ASearchPlanner, SamplingPlanner
@@ -164,13 +182,14 @@ def treecl_train(args):
 
 
 def percrank_train(args):
-    opts, files = getopt(args, 'c:d:s:j:w:e:r:')
+    opts, files = getopt(args, 'c:d:s:j:w:e:r:b:')
     candgen_model = None
     train_size = 1.0
     parallel = False
     jobs_number = 0
     work_dir = None
     experiment_id = None
+    backend = None
 
     for opt, arg in opts:
         if opt == '-d':
@@ -186,6 +205,8 @@ def percrank_train(args):
             work_dir = arg
         elif opt == '-e':
             experiment_id = arg
+        elif opt == '-b':
+            backend = arg
         elif opt == '-r' and arg:
             rnd.seed(arg)
 
@@ -213,6 +234,8 @@ def percrank_train(args):
         ranker = ranker_class(rank_config)
     else:
         rank_config['jobs_number'] = jobs_number
+        if backend:
+            rank_config['parallel_backend'] = backend
         if work_dir is None:
             work_dir, _ = os.path.split(fname_rank_config)
         ranker = ParallelRanker(rank_config, work_dir, experiment_id, ranker_class)
@@ -233,6 +256,8 @@ def seq2seq_train(args):
     ap.add_argument('-d', '--debug-logfile', type=str, help='Debug output file name')
     ap.add_argument('-j', '--jobs', type=int, help='Number of parallel jobs to use')
     ap.add_argument('-w', '--work-dir', type=str, help='Main working directory for parallel jobs')
+    ap.add_argument('-b', '--backend', type=str, choices=['sge', 'local'],
+                    help='Where to run parallel jobs: on the SGE cluster (default) or as local processes')
     ap.add_argument('-e', '--experiment-id', type=str,
                     help='Experiment ID for parallel jobs (used as job name prefix)')
     ap.add_argument('-r', '--random-seed', type=str,
@@ -246,6 +271,8 @@ def seq2seq_train(args):
                     'training lexic. instructions)')
     ap.add_argument('-t', '--tb-summary-dir', '--tensorboard-summary-dir', '--tensorboard', type=str,
                     help='Directory where Tensorboard summaries are saved during training')
+    ap.add_argument('-C', '--compiled-corpus', type=str,
+                    help='Compiled corpus with preprocessed training data (see compile_corpus)')
 
     ap.add_argument('seq2seq_config_file', type=str, help='Seq2Seq generator configuration file')
     ap.add_argument('da_train_file', type=str, help='Input training DAs')
@@ -266,8 +293,12 @@ def seq2seq_train(args):
 
     if args.tb_summary_dir:  # override Tensorboard setting
         config['tb_summary_dir'] = args.tb_summary_dir
+    if args.compiled_corpus:
+        config['compiled_corpus'] = os.path.abspath(args.compiled_corpus)
     if args.jobs:  # parallelize when training
         config['jobs_number'] = args.jobs
+        if args.backend:
+            config['parallel_backend'] = args.backend
         if not args.work_dir:
             work_dir, _ = os.path.split(args.seq2seq_config_file)
         generator = ParallelSeq2SeqTraining(config, args.work_dir or work_dir, args.experiment_id)
@@ -282,6 +313,32 @@ def seq2seq_train(args):
     generator.save_to_file(args.seq2seq_model_file)
 
 
+def compile_corpus(args):
+
+    ap = ArgumentParser(prog=' '.join(sys.argv[0:2]))
+
+    ap.add_argument('-s', '--train-size', type=float,
+                    help='Portion of the training data to use (default: 1.0)', default=1.0)
+    ap.add_argument('-c', '--context-file', type=str,
+                    help='Input ttree/text file with context utterances')
+    ap.add_argument('-v', '--valid-data', type=str,
+                    help='Validation data paths (2-3 comma-separated files: DAs, trees/sentences, contexts)')
+
+    ap.add_argument('seq2seq_config_file', type=str, help='Seq2Seq generator configuration file')
+    ap.add_argument('da_train_file', type=str, help='Input training DAs')
+    ap.add_argument('tree_train_file', type=str, help='Input training trees/sentences')
+    ap.add_argument('corpus_file', type=str, help='Output compiled corpus file (.npz)')
+
+    args = ap.parse_args(args)
+
+    log_info('Compiling training corpus for sequence-to-sequence generator...')
+
+    config = Config(args.seq2seq_config_file)
+    generator = Seq2SeqGen(config)
+    generator.compile_corpus(args.da_train_file, args.tree_train_file, args.train_size,
+                             args.context_file, args.valid_data, args.corpus_file)
+
+
 def sample_gen(args):
     from pytreex.core.document import Document
     opts, files = getopt(args, 'r:n:o:w:')
@@ -453,6 +510,11 @@ def seq2seq_gen(args):
                     help='Override beam size for beam search decoding')
     ap.add_argument('-c', '--context-file', type=str,
                     help='Input ttree/text file with context utterances')
+    ap.add_argument('-B', '--batch-size', type=int, default=20,
+                    help='Number of DAs decoded at once (batching is only used with greedy ' +
+                    'decoding or in-graph beam search)')
+    ap.add_argument('--eval-workers', type=int, default=1,
+                    help='Number of parallel processes for tree evaluation')
 
     ap.add_argument('seq2seq_model_file', type=str, help='Trained Seq2Seq generator model')
     ap.add_argument('da_test_file', type=str, help='Input DAs for generation')
@@ -463,35 +525,40 @@ def seq2seq_gen(args):
         set_debug_stream(file_stream(args.debug_logfile, mode='w'))
 
     # load the generator
-    tgen = Seq2SeqBase.load_from_file(args.seq2seq_model_file)
+    tgen = Seq2SeqBase.load_from_file(args.seq2seq_model_file, inference_only=True)
     if args.beam_size is not None:
         tgen.beam_size = args.beam_size
 
-    # read input files (DAs, contexts)
-    das = read_das(args.da_test_file)
+    # read input files (DAs, contexts) -- lazily
+    das = iter_das(args.da_test_file)
     if args.context_file:
         if not tgen.use_context and not tgen.context_bleu_weight:
             log_warn('Generator is not trained to use context, ignoring context input file.')
         else:
             if args.context_file.endswith('.txt'):
-                contexts = read_tokens(args.context_file)
+                contexts = iter_tokens(args.context_file)
             else:
-                contexts = tokens_from_doc(read_ttrees(args.context_file),
-                                           tgen.language, tgen.selector)
-            das = [(context, da) for context, da in zip(contexts, das)]
+                contexts = tokens_from_file(args.context_file, tgen.language, tgen.selector)
+            das = izip(contexts, das)
     elif tgen.use_context or tgen.context_bleu_weight:
         log_warn('Generator is trained to use context. ' +
                  'Using empty contexts, expect lower performance.')
-        das = [([], da) for da in das]
+        das = (([], da) for da in das)
+
+    # without evaluation and with text output, generate, lexicalize and write out the outputs
+    # as they come, so that memory use does not depend on the input size
+    if not args.eval_file and (args.output_file is None or args.output_file.endswith('.txt')):
+        seq2seq_gen_stream(tgen, das, args.da_test_file, args.abstr_file, args.output_file,
+                           args.batch_size)
+        return
 
     # generate
     log_info('Generating...')
-    gen_trees = []
-    for num, da in enumerate(das, start=1):
-        log_debug("\n\nTREE No. %03d" % num)
-        gen_trees.append(tgen.generate_tree(da))
-        if num % 100 == 0:
-            log_info("Generated tree %d" % num)
+    das = list(das)
+    timer = defaultdict(float)
+    gen_trees = list(generate_trees(tgen, das, args.batch_size, timer))
+    log_info('Decoding time: %.2f s (%.2f outputs/s)' % (timer['decode'],
+                                                        len(gen_trees) / max(timer['decode'], 1e-6)))
     log_info(tgen.get_slot_err_stats())
 
     # evaluate the generated trees against golden trees (delexicalized)
@@ -500,7 +567,8 @@ def seq2seq_gen(args):
         eval_doc = read_ttrees(args.eval_file)
         evaler = Evaluator()
         evaler.process_eval_doc(eval_doc, gen_trees, tgen.language, args.ref_selector,
-                                args.target_selector or tgen.selector)
+                                args.target_selector or tgen.selector,
+                                eval_file=args.eval_file, workers=args.eval_workers)
 
     # lexicalize, if required
     if args.abstr_file and tgen.lexicalizer:
@@ -529,6 +597,197 @@ def seq2seq_gen(args):
                          args.output_file)
 
 
+def seq2seq_serve(args):
+    """Persistent Seq2Seq generation server"""
+    from tgen.server import GenerationServer, serve_stdio, serve_unix_socket
+
+    ap = ArgumentParser(prog=' '.join(sys.argv[0:2]))
+
+    ap.add_argument('-s', '--socket', type=str,
+                    help='Unix domain socket path to listen on ' +
+                    '(default: read requests from stdin, write responses to stdout)')
+    ap.add_argument('-b', '--beam-size', type=int,
+                    help='Override beam size for beam search decoding')
+    ap.add_argument('-B', '--max-batch-size', type=int, default=20,
+                    help='Maximum number of requests decoded in one batch')
+    ap.add_argument('-W', '--max-wait', type=float, default=5.0,
+                    help='Maximum time to wait for a batch to fill up (milliseconds)')
+    ap.add_argument('-d', '--debug-logfile', type=str, help='Debug output file name')
+
+    ap.add_argument('seq2seq_model_file', type=str, help='Trained Seq2Seq generator model')
+
+    args = ap.parse_args(args)
+
+    if args.debug_logfile:
+        set_debug_stream(file_stream(args.debug_logfile, mode='w'))
+
+    # load the generator
+    tgen = Seq2SeqBase.load_from_file(args.seq2seq_model_file, inference_only=True)
+    if args.beam_size is not None:
+        tgen.beam_size = args.beam_size
+
+    server = GenerationServer(tgen, args.max_batch_size, args.max_wait / 1000.0)
+    server.start()
+    if args.socket:
+        serve_unix_socket(server, args.socket)
+    else:
+        log_info('Reading requests from standard input...')
+        serve_stdio(server)
+
+
+def seq2seq_freeze(args):
+    """Save the frozen inference graph of a trained Seq2Seq generator"""
+
+    ap = ArgumentParser(prog=' '.join(sys.argv[0:2]))
+    ap.add_argument('seq2seq_model_file', type=str, help='Trained Seq2Seq generator model')
+    args = ap.parse_args(args)
+
+    # load the full model (never an existing frozen graph)
+    tgen = Seq2SeqBase.load_from_file(args.seq2seq_model_file)
+    if not isinstance(tgen, Seq2SeqGen):
+        sys.exit('Frozen inference graphs are not supported for ensemble models.')
+    tgen.save_frozen_graph(args.seq2seq_model_file)
+
+
+def generate_batches(tgen, das, batch_size=1, timer=None):
+    """Generate trees for the given DAs lazily, in batches (with progress logging).
+    @param tgen: the Seq2Seq generator
+    @param das: iterable of input DAs (or context-DA pairs)
+    @param batch_size: number of DAs decoded at once
+    @param timer: a dictionary where the decoding time is accumulated (under 'decode'; optional)
+    @return: generator of pairs: list of output trees, list of the corresponding input DAs
+    """
+    num = 0
+    for batch in chunk_iter(das, batch_size):
+        log_debug("\n\nTREE No. %03d" % (num + 1) if len(batch) == 1 else
+                  "\n\nTREES No. %03d-%03d" % (num + 1, num + len(batch)))
+        start = time.time()
+        trees = tgen.generate_trees(batch)
+        if timer is not None:
+            timer['decode'] += time.time() - start
+        if (num + len(batch)) // 100 > num // 100:
+            log_info("Generated tree %d" % ((num + len(batch)) // 100 * 100))
+        num += len(batch)
+        yield trees, batch
+
+
+def generate_trees(tgen, das, batch_size=1, timer=None):
+    """Generate trees for the given DAs lazily, in batches, yielding them one by one
+    (see `generate_batches` for the parameters).
+    @return: generator of the output trees
+    """
+    for trees, _ in generate_batches(tgen, das, batch_size, timer):
+        for tree in trees:
+            yield tree
+
+
+def timed_iter(iterable, timer, stage):
+    """Iterate over the given iterable, adding the time spent waiting for its items to the
+    given stage in the timer dictionary."""
+    items = iter(iterable)
+    while True:
+        start = time.time()
+        try:
+            item = next(items)
+        finally:
+            timer[stage] += time.time() - start
+        yield item
+
+
+def seq2seq_gen_stream(tgen, das, da_file, abstr_file, output_file, batch_size=1):
+    """Streaming Seq2Seq generation: generate outputs for the given DAs, lexicalize them and
+    write them into a text file as they come, without holding all of them in memory.
+    DAs are decoded in batches in the main thread, lexicalization and writing of the outputs
+    run in a worker thread, so they overlap with decoding of the following batches.
+
+    @param tgen: the Seq2Seq generator
+    @param das: iterable of input DAs (or context-DA pairs)
+    @param da_file: the input DA file path (used to count the inputs for lexicalization)
+    @param abstr_file: lexicalization instructions file path (or None)
+    @param output_file: output text file path (or None for no output)
+    @param batch_size: number of DAs decoded at once
+    """
+    use_context = tgen.use_context or tgen.context_bleu_weight
+    lexicalize = abstr_file and tgen.lexicalizer
+    num_das = None
+    if lexicalize:
+        with file_stream(da_file) as fh:
+            num_das = sum(1 for _ in fh)
+
+    timer = defaultdict(float)
+    batches = Queue.Queue(maxsize=2)  # decoded batches waiting for the worker
+    worker_result = {}
+
+    def decoded_trees(out_das):
+        """Take decoded batches from the queue and yield the trees one by one, storing
+        the corresponding DAs in the given deque. Stops at the end sentinel (None)."""
+        while True:
+            start = time.time()
+            batch = batches.get()
+            timer['idle'] += time.time() - start
+            if batch is None:
+                worker_result['finished'] = True
+                return
+            for tree, da in izip(*batch):
+                out_das.append(da[1] if use_context else da)
+                yield tree
+
+    def process_outputs():
+        """Worker thread: lexicalize & postprocess the decoded trees, write them out."""
+        start = time.time()
+        try:
+            out_das = deque()
+            gen_trees = decoded_trees(out_das)
+            if lexicalize:
+                gen_trees = timed_iter(tgen.lexicalizer.lexicalize_stream(
+                    gen_trees, abstr_file, num_expected=num_das), timer, 'lexicalize')
+
+            def gen_tokens():
+                for tree in gen_trees:
+                    toks = tree.to_tok_list()
+                    postprocess_tokens([toks], [out_das.popleft()])
+                    yield toks
+
+            if output_file is not None:
+                worker_result['num_sents'] = write_tokens(gen_tokens(), output_file)
+            else:
+                worker_result['num_sents'] = sum(1 for _ in gen_tokens())
+        except:
+            worker_result['error'] = sys.exc_info()
+            while 'finished' not in worker_result:  # unblock the decoder
+                if batches.get() is None:
+                    worker_result['finished'] = True
+        timer['worker'] = time.time() - start
+
+    log_info('Generating' + (', lexicalizing' if lexicalize else '') +
+             (' and writing output' if output_file is not None else '') + ' on the fly...')
+    worker = threading.Thread(target=process_outputs, name='seq2seq_gen_output')
+    worker.start()
+    total_start = time.time()
+    try:
+        for batch in generate_batches(tgen, das, batch_size, timer):
+            if 'error' in worker_result:
+                break
+            batches.put(batch)
+    finally:
+        batches.put(None)
+        worker.join()
+    if 'error' in worker_result:
+        exc_type, exc_value, exc_tb = worker_result['error']
+        raise exc_type, exc_value, exc_tb
+    total_time = time.time() - total_start
+
+    # lexicalization time is measured including the wait for decoded trees
+    lexic_time = max(timer['lexicalize'] - timer['idle'], 0.0) if lexicalize else 0.0
+    write_time = timer['worker'] - timer['idle'] - lexic_time
+    num_sents = worker_result['num_sents']
+    log_info('Generated %d outputs.' % num_sents)
+    log_info('Timing: decoding %.2f s, lexicalization %.2f s, postprocessing & writing %.2f s, '
+             % (timer['decode'], lexic_time, write_time) +
+             'total %.2f s (%.2f outputs/s)' % (total_time, num_sents / max(total_time, 1e-6)))
+    log_info(tgen.get_slot_err_stats())
+
+
 def eval_tokens(das, eval_tokens, gen_tokens):
     """Evaluate generated tokens and print out statistics."""
     postprocess_tokens(eval_tokens, das)
@@ -596,6 +855,12 @@ if __name__ == '__main__':
         seq2seq_train(args)
     elif action == 'seq2seq_gen':
         seq2seq_gen(args)
+    elif action == 'seq2seq_serve':
+        seq2seq_serve(args)
+    elif action == 'seq2seq_freeze':
+        seq2seq_freeze(args)
+    elif action == 'compile_corpus':
+        compile_corpus(args)
     elif action == 'treecl_train':
         treecl_train(args)
     elif action == 'rerank_cl_train':
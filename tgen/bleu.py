@@ -6,7 +6,8 @@ BLEU measurements
 """
 
 from __future__ import unicode_literals
-from collections import defaultdict
+from collections import Counter
+from itertools import izip, islice
 import math
 
 from tgen.tree import TreeData
@@ -36,16 +37,68 @@ class BLEUMeasure(object):
         """Append a sentence for measurements, increase counters.
 
         @param pred_sent: the system output sentence (tree/tokens)
-        @param ref_sents: the corresponding reference sentences (list/tuple of trees/tokens)
+        @param ref_sents: the corresponding reference sentences (list/tuple of trees/tokens), \
+            or a BLEUReferences object precomputed by `get_references`
         """
-
+        hits, cand_lens, ref_len = self.sentence_stats(pred_sent, ref_sents)
         for i in xrange(self.max_ngram):
-            self.hits[i] += self.compute_hits(i+1, pred_sent, ref_sents)
-            self.cand_lens[i] += len(pred_sent) - i
+            self.hits[i] += hits[i]
+            self.cand_lens[i] += cand_lens[i]
+        self.ref_len += ref_len
+
+    def get_references(self, ref_sents):
+        """Precompute n-gram counts for the given reference sentences, so that many
+        candidate sentences can be scored against them without recounting.
+
+        @param ref_sents: reference sentences (list/tuple of trees/tokens)
+        @return: a BLEUReferences object, to be used in place of the references in `append`, \
+            `sentence_stats`, and `sentence_bleu`
+        """
+        return BLEUReferences([self.ngram_counts(n + 1, self.sent_items(ref_sent))
+                               for ref_sent in ref_sents for n in xrange(self.max_ngram)],
+                              [len(ref_sent) for ref_sent in ref_sents],
+                              self.max_ngram)
+
+    def sentence_stats(self, pred_sent, ref_sents):
+        """Compute clipped n-gram hits, candidate n-gram counts and the closest reference length
+        for a single sentence (without changing the accumulated counts).
+
+        @param pred_sent: the system output sentence (tree/tokens)
+        @param ref_sents: the corresponding reference sentences (list/tuple of trees/tokens), \
+            or a BLEUReferences object precomputed by `get_references`
+        @return: a tuple: list of hits for all n-gram orders, list of candidate lengths for \
+            all n-gram orders, closest reference length
+        """
+        if not isinstance(ref_sents, BLEUReferences):
+            ref_sents = self.get_references(ref_sents)
+        pred_items = self.sent_items(pred_sent)
+        pred_len = len(pred_sent)
+
+        hits = []
+        for n, ref_ngrams in enumerate(ref_sents.max_counts, start=1):
+            hits.append(sum(min(cnt, ref_ngrams[ngram])
+                            for ngram, cnt in self.ngram_counts(n, pred_items).iteritems()
+                            if ngram in ref_ngrams))
+        cand_lens = [pred_len - i for i in xrange(self.max_ngram)]
 
         # take the reference that is closest in length to the candidate
-        closest_ref = min(ref_sents, key=lambda ref_sent: abs(len(ref_sent) - len(pred_sent)))
-        self.ref_len += len(closest_ref)
+        ref_len = min(ref_sents.lens, key=lambda ref_len: abs(ref_len - pred_len))
+        return hits, cand_lens, ref_len
+
+    def sentence_bleu(self, pred_sent, ref_sents, metric='bleu'):
+        """Compute sentence-level BLEU score (smoothed in the same way as the corpus-level
+        score) for a single sentence, without changing the accumulated counts.
+
+        @param pred_sent: the system output sentence (tree/tokens)
+        @param ref_sents: the corresponding reference sentences (list/tuple of trees/tokens), \
+            or a BLEUReferences object precomputed by `get_references`
+        @param metric: 'bleu' or 'ngram_prec' (n-gram precision only, no brevity penalty)
+        @return: the sentence-level score, as a float
+        """
+        hits, cand_lens, ref_len = self.sentence_stats(pred_sent, ref_sents)
+        if metric == 'ngram_prec':
+            return self._ngram_precision(hits, cand_lens)
+        return self._bleu(hits, cand_lens, ref_len)
 
     def compute_hits(self, n, pred_sent, ref_sents):
         """Compute clipped n-gram hits for the given sentences and the given N
@@ -54,26 +107,42 @@ class BLEUMeasure(object):
         @param pred_sent: the system output sentence (tree/tokens)
         @param ref_sents: the corresponding reference sentences (list/tuple of trees/tokens)
         """
-        merged_ref_ngrams = {}
-
+        merged_ref_ngrams = Counter()
         for ref_sent in ref_sents:
-            ref_ngrams = defaultdict(int)
-
-            for ngram in self.ngrams(n, ref_sent):
-                ref_ngrams[ngram] += 1
-            for ngram, cnt in ref_ngrams.iteritems():
-                merged_ref_ngrams[ngram] = max((merged_ref_ngrams.get(ngram, 0), cnt))
-
-        pred_ngrams = defaultdict(int)
-        for ngram in self.ngrams(n, pred_sent):
-            pred_ngrams[ngram] += 1
+            merged_ref_ngrams |= self.ngram_counts(n, self.sent_items(ref_sent))
 
         hits = 0
-        for ngram, cnt in pred_ngrams.iteritems():
-            hits += min(merged_ref_ngrams.get(ngram, 0), cnt)
+        for ngram, cnt in self.ngram_counts(n, self.sent_items(pred_sent)).iteritems():
+            hits += min(merged_ref_ngrams[ngram], cnt)
 
         return hits
 
+    def sent_items(self, sent):
+        """Get the list of items from which n-grams are built for the given sentence (nodes for
+        trees, forms for tokens).
+
+        @param sent: the sentence (tree/tokens)
+        @return: list of nodes or forms
+        """
+        # with sents
+        if isinstance(sent, TreeData):
+            return sent.nodes
+        # with tokens (as lists of pairs form+tag, or plain forms only)
+        if sent and isinstance(sent[0], tuple):
+            return [form for (form, _) in sent]  # ignore tags, use just forms
+        return sent
+
+    def ngram_counts(self, n, items):
+        """Count n-grams of the given order in a list of items (see `sent_items`).
+
+        @param n: n-gram 'N' (1 for unigrams, 2 for bigrams etc.)
+        @param items: nodes or forms of the sentence
+        @return: a Counter of n-grams (tuples of nodes/forms)
+        """
+        if n == 1:
+            return Counter((item,) for item in items)
+        return Counter(izip(*[islice(items, i, None) for i in xrange(n)]))
+
     def ngrams(self, n, sent):
         """Given a sentence, return n-grams of nodes for the given N
 
@@ -81,35 +150,56 @@ class BLEUMeasure(object):
         @param sent: the sent in question
         @return: n-grams of nodes, as tuples of tuples (t-lemma & formeme)
         """
-        # with sents
-        if isinstance(sent, TreeData):
-            return zip(*[sent.nodes[i:] for i in range(n)])
-        # with tokens (as lists of pairs form+tag, or plain forms only)
-        if sent and isinstance(sent[0], tuple):
-            sent = [form for (form, _) in sent]  # ignore tags, use just forms
-        return zip(*[sent[i:] for i in range(n)])
+        items = self.sent_items(sent)
+        return zip(*[items[i:] for i in range(n)])
 
     def bleu(self):
         """Return the current BLEU score, according to the accumulated counts."""
+        return self._bleu(self.hits, self.cand_lens, self.ref_len)
+
+    def ngram_precision(self):
+        """Return the current n-gram precision (harmonic mean of n-gram precisions up to max_ngram)
+        according to the accumulated counts."""
+        return self._ngram_precision(self.hits, self.cand_lens)
+
+    def _bleu(self, hits, cand_lens, ref_len):
+        """Compute BLEU score from the given counts."""
 
         # brevity penalty (smoothed a bit: if candidate length is 0, we change it to 1e-5
         # to avoid division by zero)
         bp = 1.0
-        if (self.cand_lens[0] <= self.ref_len):
-            bp = math.exp(1.0 - self.ref_len /
-                          (float(self.cand_lens[0]) if self.cand_lens[0] else 1e-5))
+        if (cand_lens[0] <= ref_len):
+            bp = math.exp(1.0 - ref_len /
+                          (float(cand_lens[0]) if cand_lens[0] else 1e-5))
 
-        return bp * self.ngram_precision()
+        return bp * self._ngram_precision(hits, cand_lens)
 
-    def ngram_precision(self):
-        """Return the current n-gram precision (harmonic mean of n-gram precisions up to max_ngram)
-        according to the accumulated counts."""
+    def _ngram_precision(self, hits, cand_lens):
+        """Compute n-gram precision from the given counts."""
 
         # n-gram precision is smoothed a bit: 0 hits for a given n-gram count are
         # changed to 1e-5 to make BLEU defined everywhere
         prec_avg = sum(1.0 / self.max_ngram *
                        math.log((n_hits if n_hits != 0 else 1e-5) / float(max(n_lens, 1.0)))
-                       for n_hits, n_lens in zip(self.hits, self.cand_lens))
+                       for n_hits, n_lens in zip(hits, cand_lens))
 
         return math.exp(prec_avg)
 
+
+class BLEUReferences(object):
+    """Precomputed n-gram counts for a set of reference sentences (maximum count of each n-gram
+    over all references, for each n-gram order), plus reference lengths."""
+
+    __slots__ = ['max_counts', 'lens']
+
+    def __init__(self, ref_counts, lens, max_ngram):
+        """Merge n-gram counts of the individual references.
+
+        @param ref_counts: list of n-gram Counters, for each reference all n-gram orders in turn
+        @param lens: lengths of the references
+        @param max_ngram: maximum n-gram order
+        """
+        self.max_counts = [Counter() for _ in xrange(max_ngram)]
+        for i, counts in enumerate(ref_counts):
+            self.max_counts[i % max_ngram] |= counts
+        self.lens = lens
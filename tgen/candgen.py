@@ -104,7 +104,7 @@ class RandomCandidateGenerator(object):
         log_info('Reading ' + ttree_file)
         ttrees = ttrees_from_doc(read_ttrees(ttree_file), self.language, self.selector)
         log_info('Reading ' + das_file)
-        das = read_das(das_file)
+        das = read_das(das_file, intern=True)
 
         # collect counts
         log_info('Collecting counts')
@@ -17,7 +17,7 @@ from pytreex.core.util import file_stream
 
 from tgen.rnd import rnd
 from tgen.logf import log_debug, log_info, log_warn
-from tgen.futil import read_das, read_ttrees, trees_from_doc
+from tgen.futil import read_das, trees_from_file
 from tgen.features import Features
 from tgen.ml import DictVectorizer
 from tgen.nn import ClassifNN, FeedForward, Flatten, Conv1D, Pool1D, Embedding
@@ -50,6 +50,9 @@ class TreeClassifier(object):
 
         self.cur_da = None
         self.cur_da_bin = None
+        self.cur_cache = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
 
     @staticmethod
     def load_from_file(fname):
@@ -83,8 +86,24 @@ class TreeClassifier(object):
         else:
             X = self.tree_vect.transform([self.tree_feats.get_features(tree, {}) for tree in trees])
         # binarize the result
-        return np.array([[1. if r > 0.5 else 0. for r in result]
-                         for result in self.classif.classif(X)])
+        return (self.classif.classif(X) > 0.5).astype(float)
+
+    def _classify_cached(self, trees):
+        """Classify the trees, using the prediction cache for the current run (see `init_run`).
+        Only trees not classified previously in this run are passed to the network (all of
+        them in a single call).
+
+        @param trees: the trees to classify
+        @return: boolean 2D array, one binarized prediction per tree
+        """
+        cache = self.cur_cache
+        new_trees = list(set(tree for tree in trees if tree not in cache))
+        if new_trees:
+            for tree, pred in zip(new_trees, self.classify(new_trees) != 0):
+                cache[tree] = pred
+        self.cache_misses += len(new_trees)
+        self.cache_hits += len(trees) - len(new_trees)
+        return np.array([cache[tree] for tree in trees])
 
     def is_subset_of_da(self, da, trees):
         """Given a DA and an array of trees, this gives a boolean array indicating which
@@ -99,21 +118,32 @@ class TreeClassifier(object):
         # convert it to array of booleans
         da_bin = da_bin != 0
         # classify the trees
-        covered = self.classify(trees)
+        covered = self.classify(trees) != 0
         # decide whether 1's in their 1-hot vectors are subsets of True's in da_bin
-        return [((c != 0) | da_bin == da_bin).all() for c in covered]
+        return list(~(covered & ~da_bin).any(axis=1))
 
     def init_run(self, da):
-        """Remember the current DA for subsequent runs of `is_subset_of_cur_da`."""
+        """Remember the current DA for subsequent runs of `is_subset_of_cur_da`
+        and `corresponds_to_cur_da`, reset the prediction cache."""
         self.cur_da = da
         da_bin = self.da_vect.transform([self.da_feats.get_features(None, {'da': da})])[0]
         self.cur_da_bin = da_bin != 0
+        self.cur_cache = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def log_cache_stats(self):
+        """Log the prediction cache hit rate for the current run."""
+        total = self.cache_hits + self.cache_misses
+        log_debug('Classif cache: %d hits, %d misses (hit rate %.2f%%)' %
+                  (self.cache_hits, self.cache_misses,
+                   100.0 * self.cache_hits / total if total else 0.0))
 
     def is_subset_of_cur_da(self, trees):
-        """Same as `is_subset_of_da`, but using `self.cur_da` set via `init_run`."""
-        da_bin = self.cur_da_bin
-        covered = self.classify(trees)
-        return [((c != 0) | da_bin == da_bin).all() for c in covered]
+        """Same as `is_subset_of_da`, but using `self.cur_da` set via `init_run`
+        (and cached predictions)."""
+        covered = self._classify_cached(trees)
+        return list(~(covered & ~self.cur_da_bin).any(axis=1))
 
     def corresponds_to_cur_da(self, trees):
         """Given an array of trees, this gives a boolean array indicating which
@@ -122,9 +152,8 @@ class TreeClassifier(object):
         @param trees: the trees to test against the current DA
         @return: boolean array, with True where the tree covers/describes a subset of the current DA
         """
-        da_bin = self.cur_da_bin
-        covered = self.classify(trees)
-        return [((c != 0) == da_bin).all() for c in covered]
+        covered = self._classify_cached(trees)
+        return list((covered == self.cur_da_bin).all(axis=1))
 
     def _init_training(self, das_file, ttree_file, data_portion):
         """Initialize training.
@@ -134,10 +163,9 @@ class TreeClassifier(object):
         """
         # read input
         log_info('Reading DAs from ' + das_file + '...')
-        das = read_das(das_file)
+        das = read_das(das_file, intern=True)
         log_info('Reading t-trees from ' + ttree_file + '...')
-        ttree_doc = read_ttrees(ttree_file)
-        trees = trees_from_doc(ttree_doc, self.language, self.selector)
+        trees = trees_from_file(ttree_file, self.language, self.selector)
 
         # make training data smaller if necessary
         train_size = int(round(data_portion * len(trees)))
@@ -260,7 +288,7 @@ class TreeClassifier(object):
 
             results = self.classif.classif(self.X[tree_nos])
             cost_gcost = self.classif.update(self.X[tree_nos], self.y[tree_nos], self.alpha)
-            bin_result = np.array([[1. if r > 0.5 else 0. for r in result] for result in results])
+            bin_result = (results > 0.5).astype(float)
 
             log_debug('R: ' + str(bin_result))
             log_debug('COST: %f' % cost_gcost[0])
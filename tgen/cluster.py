@@ -12,6 +12,9 @@ import sys
 import re
 import time
 import collections
+import socket
+import subprocess
+import threading
 from tgen.logf import log_warn
 
 """\
@@ -400,7 +403,7 @@ from __future__ import unicode_literals
         """
         if self.__jobid is not None and other.__jobid is not None:
             return self.__jobid == other.__jobid
-        return self == other
+        return self is other
 
     def __str__(self):
         """\
@@ -408,3 +411,157 @@ from __future__ import unicode_literals
         """
         return (self.__class__.__name__ + ': ' +
                 self.name + ' (' + self.work_dir + ')')
+
+
+class LocalJob(Job):
+    """\
+    A job run as a subprocess on the local machine instead of the cluster.
+    Has the same interface as Job (the script is created in the same way,
+    in the working directory), but the qsub/qstat/qacct commands are not
+    used. The job output is written to <name>.log in the working directory.
+
+    Job completion is event-driven: a watcher thread waits for the process
+    to end, then calls all functions registered via add_callback() (with
+    the job as the only argument).
+
+    Memory, queue and dependency settings are ignored; the number of cores
+    is not enforced (it is up to the job code to respect it).
+    """
+
+    def __init__(self, code=None, header=Job.DEFAULT_HEADER,
+                 name=None, work_dir=None):
+        super(LocalJob, self).__init__(code, header, name, work_dir)
+        self.process = None
+        self.__finished = threading.Event()
+        self.__callbacks = []
+        self.__lock = threading.Lock()
+
+    def submit(self, memory=None, cores=None, work_dir=None, queue=None):
+        """\
+        Start the job as a local subprocess (running the current Python
+        interpreter, with the current module search path).
+        """
+        if cores is not None:
+            self.cores = cores
+        if not os.path.isdir(self.work_dir):
+            os.mkdir(self.work_dir)
+        script_fname = os.path.join(self.work_dir, self.name + '.py')
+        with codecs.open(script_fname, 'w', 'UTF-8') as script_fh:
+            print >> script_fh, self.get_script_text()
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(os.path.abspath(path)
+                                            for path in sys.path if path)
+        with open(os.path.join(self.work_dir, self.name + '.log'), 'w') as log_fh:
+            self.process = subprocess.Popen([sys.executable, script_fname],
+                                            cwd=self.work_dir, env=env,
+                                            stdout=log_fh,
+                                            stderr=subprocess.STDOUT)
+        self.submitted = True
+        watcher = threading.Thread(target=self.__watch,
+                                   name='LocalJob-' + self.name)
+        watcher.daemon = True
+        watcher.start()
+
+    def __watch(self):
+        """\
+        Wait for the process to finish, then call the registered callbacks.
+        (The process is only ever waited for here, Popen is not thread-safe.)
+        """
+        self.process.wait()
+        with self.__lock:
+            self.__finished.set()
+            callbacks = list(self.__callbacks)
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                log_warn('Job callback failed: ' + unicode(e))
+
+    def add_callback(self, callback):
+        """\
+        Register a function to be called (with the job as the argument)
+        once the job finishes. Called immediately if the job has already
+        finished, otherwise called from the job's watcher thread.
+        """
+        with self.__lock:
+            if not self.__finished.is_set():
+                self.__callbacks.append(callback)
+                return
+        callback(self)
+
+    @property
+    def state(self):
+        """\
+        Current job state ('r' = running, 'f' = finished).
+        """
+        if not self.submitted:
+            return None
+        return self.FINISH if self.__finished.is_set() else 'r'
+
+    @property
+    def report(self):
+        """\
+        No qacct reports for local jobs.
+        """
+        return None
+
+    @property
+    def exit_status(self):
+        """\
+        Return the exit status of the job's process. Throws an exception
+        if the job is still running.
+        """
+        if not self.submitted or not self.__finished.is_set():
+            raise RuntimeError('Job ' + self.name +
+                               ' is probably still running')
+        return self.process.returncode
+
+    def wait(self, poll_delay=None):
+        """\
+        Waits for the job to finish (no polling, poll_delay is ignored).
+        Will raise an exception if the job did not finish successfully.
+        """
+        # (waiting with a timeout, so that the main thread stays interruptible)
+        while not self.__finished.wait(self.TIME_POLL_DELAY):
+            pass
+        if self.exit_status != 0:
+            raise RuntimeError('Job ' + self.name + ' (' + self.jobid +
+                               ') did not finish successfully.')
+
+    @property
+    def host(self):
+        """\
+        Local jobs always run on this machine.
+        """
+        return socket.gethostname().split('.')[0] if self.submitted else None
+
+    @property
+    def jobid(self):
+        """\
+        Return the process id of the job (as a string).
+        """
+        return str(self.process.pid) if self.submitted else None
+
+    def delete(self):
+        """Kill this job if it is still running."""
+        if self.submitted and not self.__finished.is_set():
+            try:
+                self.process.kill()
+            except OSError as e:
+                log_warn('Could not delete job: ' + str(e))
+            # let the watcher thread finish
+            self.__finished.wait(self.TIME_QUERY_DELAY)
+
+
+# job classes for the individual parallel backends
+JOB_BACKENDS = {'sge': Job, 'local': LocalJob}
+
+
+def get_job_class(backend):
+    """\
+    Return the job class for the given parallel backend name ('sge' = Sun
+    Grid Engine cluster, 'local' = subprocesses on the local machine).
+    """
+    if backend not in JOB_BACKENDS:
+        raise ValueError('Unknown parallel backend: ' + backend)
+    return JOB_BACKENDS[backend]
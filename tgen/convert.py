@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Shared driver for the dataset conversion scripts (`<dataset>/input/convert.py`):
+processing data instances in parallel while keeping their order, and writing the output
+files incrementally.
+"""
+
+from __future__ import unicode_literals
+import codecs
+from multiprocessing import Pool
+
+from tgen.futil import chunk_iter
+
+
+def ordered_map(func, items, workers=1, initializer=None, initargs=(), chunk_size=50):
+    """Apply a function to all items lazily, yielding the results in the order of the items.
+
+    With more than one worker, the items are processed by a pool of worker processes, so
+    the function must be defined at module level and the items and results must be picklable.
+    Any per-process setup (models, settings) should be done by the initializer, which is
+    called once in each worker process (or once in the current process if no workers are used).
+    The items are read in windows of limited size, so that the whole input is never held
+    in memory.
+
+    @param func: the function to apply (takes one item)
+    @param items: an iterable of items to process
+    @param workers: number of worker processes (no parallelization if <= 1)
+    @param initializer: per-process initialization function (optional)
+    @param initargs: arguments for the initializer
+    @param chunk_size: number of items passed to a worker at once
+    @return: a generator of the results
+    """
+    if workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for item in items:
+            yield func(item)
+        return
+
+    pool = Pool(workers, initializer=initializer, initargs=initargs)
+    try:
+        for window in chunk_iter(items, workers * chunk_size * 4):
+            for result in pool.imap(func, window, chunksize=chunk_size):
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class OutputFiles(object):
+    """A set of UTF-8 output files, written incrementally, addressed by keys.
+    Use as a context manager to make sure all the files are closed."""
+
+    def __init__(self, **fnames):
+        """Open all the files for writing.
+        @param fnames: output file names for the individual keys
+        """
+        self._fhs = {}
+        try:
+            for key, fname in fnames.iteritems():
+                self._fhs[key] = codecs.open(fname, 'wb', 'UTF-8')
+        except:
+            self.close()
+            raise
+
+    def __getitem__(self, key):
+        """Return the output stream for the given key."""
+        return self._fhs[key]
+
+    def write(self, **lines):
+        """Write a line (text + newline) into each of the files given by the keys."""
+        for key, line in lines.iteritems():
+            self._fhs[key].write(line + "\n")
+
+    def close(self):
+        for fh in self._fhs.itervalues():
+            fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
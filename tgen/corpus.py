@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compiled training corpora -- preprocessed Seq2Seq generator training data (DAs, trees/sentences,
+embedding ID sequences, embedding dictionaries) stored in a binary columnar format, so that
+training does not need to re-read and re-process the source data files.
+
+The corpus is a NumPy .npz file (uncompressed). DAIs and tokens/tree nodes are interned
+(stored once in vocabulary arrays), DAs and sentences/trees are flat arrays of vocabulary IDs
+plus offset arrays marking where each of them starts. Embedding ID sequences are stored as
+2D matrices. Everything else (embedding extractors, validation data) is pickled into a single
+byte array.
+
+Each corpus is versioned by a hash of the configuration, source data files, and embedding
+dictionaries; it is only used if the configuration and source files match.
+"""
+
+from __future__ import unicode_literals
+import cPickle as pickle
+import hashlib
+import os
+from itertools import izip
+
+import numpy as np
+
+from tgen.data import DA, DAI
+from tgen.tree import TreeData, NodeData
+from tgen.futil import SeqInterner, vocab_from_arrays, decode_seqs
+
+
+# configuration settings that do not influence training data preprocessing
+# (they are ignored when checking if a compiled corpus matches the configuration)
+IGNORED_SETTINGS = frozenset([
+    'compiled_corpus', 'passes', 'min_passes', 'improve_interval', 'top_k', 'alpha',
+    'alpha_decay', 'batch_size', 'optimizer_type', 'max_cores', 'randomize', 'emb_size',
+    'num_hidden_units', 'cell_type', 'nn_type', 'dropout_prob', 'dropout_keep_prob',
+    'use_dec_cost', 'validation_freq', 'bleu_validation_weight', 'beam_size', 'sample_top_k',
+    'length_norm_weight', 'context_bleu_weight', 'context_bleu_metric', 'in_graph_beam_search',
+    'tb_summary_dir', 'jobs_number', 'average_models', 'average_models_top_k', 'scope_suffix',
+    'classif_filter', 'lexicalizer', 'misfit_penalty', 'parallel_backend', 'local_workers',
+    'poll_interval', 'port', 'job_memory', 'queue_settings',
+])
+
+
+def _canonical(obj):
+    """Return a canonical string representation of the given object (with sorted
+    dictionaries/sets and object attributes), to be used for hashing."""
+    if isinstance(obj, dict):
+        return '{' + ', '.join(sorted(_canonical(key) + ': ' + _canonical(val)
+                                      for key, val in obj.iteritems())) + '}'
+    if isinstance(obj, (set, frozenset)):
+        return 'set(' + ', '.join(sorted(_canonical(item) for item in obj)) + ')'
+    if isinstance(obj, (list, tuple)):
+        return '[' + ', '.join(_canonical(item) for item in obj) + ']'
+    if hasattr(obj, '__dict__'):
+        return obj.__class__.__name__ + _canonical(vars(obj))
+    return repr(obj)
+
+
+def config_digest(cfg, data_portion=1.0):
+    """Return a hash of all configuration settings relevant for data preprocessing.
+    @param cfg: the generator configuration (dictionary)
+    @param data_portion: portion of the training data to be used
+    @return: a SHA1 hex digest
+    """
+    relevant = {key: cfg[key] for key in cfg if key not in IGNORED_SETTINGS}
+    return hashlib.sha1(_canonical([relevant, data_portion]).encode('UTF-8')).hexdigest()
+
+
+def source_stats(fnames):
+    """Return identification (path, modification time and size) of the given source data files
+    (None for unused files)."""
+    stats = []
+    for fname in fnames:
+        if fname is None:
+            stats.append(None)
+            continue
+        stat = os.stat(fname)
+        stats.append((os.path.abspath(fname), stat.st_mtime, stat.st_size))
+    return stats
+
+
+def corpus_version(cfg_digest, sources, da_embs, tree_embs):
+    """Return the version hash of a compiled corpus, given the configuration hash, source files
+    identification, and the embedding extractors (including their dictionaries)."""
+    return hashlib.sha1(_canonical([cfg_digest, sources, da_embs, tree_embs])
+                        .encode('UTF-8')).hexdigest()
+
+
+def write_corpus(fname, version, meta, das, contexts, trees, enc_embs, dec_embs):
+    """Write a compiled corpus into a file (atomically, via a temporary file).
+
+    @param fname: output file name
+    @param version: corpus version hash (see `corpus_version`)
+    @param meta: dictionary of other data to be stored (pickled)
+    @param das: training DAs
+    @param contexts: training contexts (lists of form-tag pairs), or None if not used
+    @param trees: training trees (TreeData) or sentences (lists of form-tag pairs)
+    @param enc_embs: iterable of embedding ID sequences for the training DAs
+    @param dec_embs: iterable of embedding ID sequences for the training trees/sentences
+    """
+    arrays = {}
+    dais = SeqInterner()
+    arrays['da_ids'], arrays['da_offsets'] = dais.encode(
+        [(dai.da_type, dai.slot, dai.value) for dai in da] for da in das)
+    arrays['dai_types'], arrays['dai_slots'], arrays['dai_values'], arrays['dai_nones'] = \
+        dais.to_arrays(3)
+
+    items = SeqInterner()
+    is_trees = bool(trees) and isinstance(trees[0], TreeData)
+    if is_trees:
+        arrays['tree_ids'], arrays['tree_offsets'] = items.encode(
+            [tuple(node) for node in tree.nodes] for tree in trees)
+        arrays['tree_parents'] = np.array([idx for tree in trees for idx in tree.parents],
+                                          dtype=np.int32)
+    else:
+        arrays['tree_ids'], arrays['tree_offsets'] = items.encode(
+            [tuple(tok) for tok in sent] for sent in trees)
+    if contexts is not None:
+        arrays['context_ids'], arrays['context_offsets'] = items.encode(
+            [tuple(tok) for tok in context] for context in contexts)
+    arrays['item_firsts'], arrays['item_seconds'], arrays['item_nones'] = items.to_arrays(2)
+
+    arrays['enc_embs'] = np.array(list(enc_embs), dtype=np.int32)
+    arrays['dec_embs'] = np.array(list(dec_embs), dtype=np.int32)
+
+    meta = dict(meta, version=version, is_trees=is_trees, use_contexts=contexts is not None)
+    arrays['meta'] = np.frombuffer(pickle.dumps(meta, pickle.HIGHEST_PROTOCOL), dtype=np.uint8)
+
+    tmp_fname = fname + '.tmp-%d' % os.getpid()
+    with open(tmp_fname, 'wb') as fh:
+        np.savez(fh, **arrays)
+    os.rename(tmp_fname, fname)
+
+
+def read_corpus_meta(fname):
+    """Read just the pickled metadata of a compiled corpus (without decoding the data)."""
+    with np.load(fname) as data:
+        return pickle.loads(data['meta'].tobytes())
+
+
+def read_corpus(fname):
+    """Read a compiled corpus from a file.
+
+    @param fname: the compiled corpus file name
+    @return: a tuple of metadata dictionary (see `write_corpus`), training DAs (context-DA pairs \
+        if contexts are stored), trees/sentences, and 2D matrices of DA and tree embedding IDs
+    """
+    with np.load(fname) as data:
+        meta = pickle.loads(data['meta'].tobytes())
+
+        # DAIs are mutable, so each DA gets its own DAI objects
+        dais = vocab_from_arrays([data['dai_types'], data['dai_slots'], data['dai_values']],
+                                  data['dai_nones'])
+        das = []
+        for da_dais in decode_seqs(dais, data['da_ids'], data['da_offsets']):
+            da = DA()
+            da.dais = [DAI(*dai) for dai in da_dais]
+            das.append(da)
+
+        items = vocab_from_arrays([data['item_firsts'], data['item_seconds']],
+                                   data['item_nones'])
+        if meta['is_trees']:
+            nodes = [NodeData(*item) for item in items]
+            parents = data['tree_parents'].tolist()
+            offsets = data['tree_offsets'].tolist()
+            trees = [TreeData(tree_nodes, parents[start:end])
+                     for tree_nodes, start, end in izip(decode_seqs(nodes, data['tree_ids'],
+                                                                data['tree_offsets']),
+                                                        offsets, offsets[1:])]
+        else:
+            trees = list(decode_seqs(items, data['tree_ids'], data['tree_offsets']))
+        if meta['use_contexts']:
+            contexts = decode_seqs(items, data['context_ids'], data['context_offsets'])
+            das = [(context, da) for context, da in izip(contexts, das)]
+
+        return meta, das, trees, data['enc_embs'], data['dec_embs']
@@ -6,17 +6,38 @@ Helper data structures
 """
 
 import re
+import weakref
 
 
+# setting DAI attributes without resetting the cached hash
+_object_setattr = object.__setattr__
+
 class DAI(object):
-    """Simple representation of a single dialogue act item."""
+    """Simple representation of a single dialogue act item.
+
+    The hash is computed from a tuple of DA type, slot, and value, and it is cached (the cache
+    is reset whenever any of them changes)."""
 
-    __slots__ = ['da_type', 'slot', 'value']
+    __slots__ = ['da_type', 'slot', 'value', '_hash']
 
     def __init__(self, da_type, slot=None, value=None):
-        self.da_type = da_type
-        self.slot = slot
-        self.value = value
+        _object_setattr(self, 'da_type', da_type)
+        _object_setattr(self, 'slot', slot)
+        _object_setattr(self, 'value', value)
+        _object_setattr(self, '_hash', None)
+
+    def __setattr__(self, name, value):
+        _object_setattr(self, name, value)
+        _object_setattr(self, '_hash', None)
+
+    def __getstate__(self):
+        # same format as default pickling of objects with __slots__, just without the hash
+        return None, {'da_type': self.da_type, 'slot': self.slot, 'value': self.value}
+
+    def __setstate__(self, state):
+        for name, value in state[1].iteritems():
+            _object_setattr(self, name, value)
+        _object_setattr(self, '_hash', None)
 
     def __unicode__(self):
         if self.slot is None:
@@ -33,7 +54,9 @@ class DAI(object):
         return 'DAI.parse("' + str(self) + '")'
 
     def __hash__(self):
-        return hash(repr(self))
+        if self._hash is None:
+            _object_setattr(self, '_hash', hash((self.da_type, self.slot, self.value)))
+        return self._hash
 
     def __eq__(self, other):
         return (self.da_type == other.da_type and
@@ -63,7 +86,12 @@ class DAI(object):
 
     @staticmethod
     def parse(dai_text):
-        da_type, svp = dai_text[:-1].split('(', 1)
+        return DAI._parse_inner(dai_text[:-1])
+
+    @staticmethod
+    def _parse_inner(dai_text):
+        """Parse a DAI string without the closing bracket."""
+        da_type, svp = dai_text.split('(', 1)
 
         if not svp:  # no slot + value (e.g. 'hello()')
             return DAI(da_type)
@@ -79,8 +107,19 @@ class DAI(object):
         return DAI(da_type, slot, value)
 
 
+# regular expressions for parsing Cambridge-style DAs
+_CAMBRIDGE_DAI_RE = re.compile(r'(\??[a-z_]+)\(([^)]*)\)')
+_CAMBRIDGE_SVP_RE = re.compile('([^,;=\'"]+(?:=(?:[^"\',;]+))?)(?:[,;]|[\'"]$|$)')
+
+
 class DA(object):
-    """Dialogue act -- a list of DAIs with a few special functions for parsing etc.."""
+    """Dialogue act -- a list of DAIs with a few special functions for parsing etc..
+
+    The hash is cached; the cache is reset by all DA methods that change the DAIs (but
+    not if the DAIs are changed directly)."""
+
+    _hash = None  # cached hash
+    _interned = weakref.WeakValueDictionary()  # interning table (see `intern`)
 
     def __init__(self):
         self.dais = []
@@ -90,9 +129,16 @@ class DA(object):
 
     def __setitem__(self, idx, value):
         self.dais[idx] = value
+        self._hash = None
 
     def append(self, value):
         self.dais.append(value)
+        self._hash = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_hash', None)  # do not store the cached hash
+        return state
 
     def __unicode__(self):
         return '&'.join([unicode(dai) for dai in self.dais])
@@ -104,7 +150,9 @@ class DA(object):
         return 'DA.parse("' + str(self) + '")'
 
     def __hash__(self):
-        return hash(repr(self))
+        if self._hash is None:
+            self._hash = hash(tuple(self.dais))
+        return self._hash
 
     def __len__(self):
         return len(self.dais)
@@ -112,6 +160,8 @@ class DA(object):
     def __eq__(self, other):
         if not isinstance(other, DA):
             return NotImplemented
+        if self is other:  # shortcut for interned DAs
+            return True
         for self_dai, other_dai in zip(self.dais, other.dais):
             if self_dai != other_dai:
                 return False
@@ -122,13 +172,29 @@ class DA(object):
 
     def sort(self):
         self.dais.sort()
+        self._hash = None
+
+    @staticmethod
+    def intern(da):
+        """Return the interned copy of the given DA -- a single shared object for all equal
+        DAs (the given DA is interned if no equal DA has been interned so far). Interned
+        DAs must not be modified. The interning table only holds weak references.
+
+        @param da: the DA to be interned
+        @return: the interned DA object (equal to the given DA)
+        """
+        key = tuple([(dai.da_type, dai.slot, dai.value) for dai in da.dais])
+        interned = DA._interned.get(key)
+        if interned is None:
+            DA._interned[key] = da
+            interned = da
+        return interned
 
     @staticmethod
     def parse(da_text):
         """Parse a DA string into DAIs (DA types, slots, and values)."""
         da = DA()
-        for dai_text in da_text[:-1].split(')&'):
-            da.append(DAI.parse(dai_text + ')'))
+        da.dais = [DAI._parse_inner(dai_text) for dai_text in da_text[:-1].split(')&')]
         return da
 
     class TagQuotes(object):
@@ -151,8 +217,12 @@ class DA(object):
     @staticmethod
     def parse_cambridge_da(da_text):
         """Parse a Cambridge-style DA string a DA object."""
+        da_text = da_text.strip()
+        if '"' not in da_text and '\'' not in da_text and 'XXXQUOT' not in da_text:
+            return DA._parse_cambridge_da_plain(da_text)
+
         da = DA()
-        da_text, quoted = DA._protect_quotes(da_text.strip())
+        da_text, quoted = DA._protect_quotes(da_text)
         quoted_num = 1
 
         for dai_text in re.finditer(r'(\??[a-z_]+)\(([^)]*)\)', da_text):
@@ -184,6 +254,23 @@ class DA(object):
 
         return da
 
+    @staticmethod
+    def _parse_cambridge_da_plain(da_text):
+        """Parse a Cambridge-style DA string that contains no quotes (fast path for
+        `parse_cambridge_da`, with no need for handling quoted values)."""
+        da = DA()
+        for da_type, svps_text in _CAMBRIDGE_DAI_RE.findall(da_text):
+            if not svps_text:  # no slots/values (e.g. 'hello()')
+                da.dais.append(DAI(da_type, None, None))
+                continue
+            for svp in _CAMBRIDGE_SVP_RE.findall(svps_text):
+                if '=' not in svp:  # no value, e.g. '?request(near)'
+                    da.dais.append(DAI(da_type, svp, None))
+                    continue
+                slot, value = svp.split('=', 1)
+                da.dais.append(DAI(da_type, slot, value))
+        return da
+
     @staticmethod
     def parse_diligent_da(da_text):
         """Parse a Diligent-style flat MR (E2E NLG dataset) string into a DA object."""
@@ -224,6 +311,7 @@ class DA(object):
         for dai in self.dais:
             if dai.slot == slot:
                 dai.value = value
+                self._hash = None
                 break
 
     def get_delexicalized(self, delex_slots):
@@ -6,7 +6,6 @@ Delexicalization functions.
 """
 from __future__ import unicode_literals
 
-import numpy as np
 from unidecode import unidecode
 from tgen.data import DA, DAI, Abst
 from tgen.futil import tokenize
@@ -37,18 +36,54 @@ def find_substr(needle, haystack):
                 h += 1
 
 
-def tokenize_normalize(tokens):
+class NormalizedSent(object):
+    """Lowercased & transliterated (unidecoded) tokens of a sentence, their further
+    tokenization and character sets, as used by the tokenized and approximate matching.
+    Computed just once for each sentence (for all the values searched in it)."""
+
+    def __init__(self, tokens):
+        self.tokens = [unidecode(tok.lower()) for tok in tokens]
+        self.subtoks = [tokenize(tok).split(' ') for tok in self.tokens]
+        self.charsets = [frozenset(tok) for tok in self.tokens]
+
+    def masked(self, toks_mask):
+        """Return a copy with the tokens masked by the given boolean mask (used-up tokens
+        replaced by empty strings)."""
+        ret = NormalizedSent([])
+        ret.tokens = [tok if m else '' for tok, m in zip(self.tokens, toks_mask)]
+        ret.subtoks = [subtoks if m else [''] for subtoks, m in zip(self.subtoks, toks_mask)]
+        ret.charsets = [chars if m else frozenset() for chars, m in zip(self.charsets, toks_mask)]
+        return ret
+
+
+def tokenize_normalize(tokens, subtoks=None):
     """Perform further tokenization, normalize, lowercase.
-    Return subtokenized text + reverse mapping."""
-    subtoks = [tokenize(unidecode(tok.lower())).split(' ') for tok in tokens]
+    Return subtokenized text + reverse mapping.
+
+    @param tokens: the tokens to be normalized
+    @param subtoks: precomputed normalized subtokens for each token (optional, \
+        see `NormalizedSent`)
+    """
+    if subtoks is None:
+        subtoks = [tokenize(unidecode(tok.lower())).split(' ') for tok in tokens]
     rev_map = [pos for pos, tok in enumerate(subtoks) for _ in xrange(len(tok))]
     subtoks = [subtok for tok in subtoks for subtok in tok]
     return subtoks, rev_map
 
 
-def find_substr_tokenized(needle, haystack):
+def find_substr_tokenized(needle, haystack, haystack_norm=None):
+    """Find a sub-list in a list of tokens, after further tokenization and normalization
+    of both (see `tokenize_normalize`).
+
+    @param needle: the shorter list -- the list whose position is to be found
+    @param haystack: the longer list of tokens -- the list where we should search
+    @param haystack_norm: the haystack, already normalized (`NormalizedSent`; optional)
+    @return: a tuple of starting and ending position of needle in the haystack, \
+            or None if not found
+    """
     needle_tok, _ = tokenize_normalize(needle)
-    haystack_tok, haystack_revmap = tokenize_normalize(haystack)
+    haystack_tok, haystack_revmap = tokenize_normalize(
+        haystack, haystack_norm.subtoks if haystack_norm is not None else None)
     pos = find_substr(needle_tok, haystack_tok)
     haystack_revmap.append(len(haystack))  # need to have one past (since the end is always one past)
     if pos is not None:
@@ -61,39 +96,58 @@ def find_substr_tokenized(needle, haystack):
     return None
 
 
-def levenshtein_dist(s, t):
-    """Compute Levenshtein distance between two strings."""
-    def match(s, t, i, j):
-        """Simple match function (testing positions i,j in s,t respectively)."""
-        return 1 if s[i] == t[j] else 0
-
-    # creating traverse matrix
-    H = np.zeros((len(s) + 1, len(t) + 1), dtype=int)
-    for (j, tj) in enumerate(' ' + t):
-        for (i, si) in enumerate('_' + s):
-            # compute score for all directions
-            (left, up, diag) = (float('-Inf'), float('-Inf'), float('-Inf'))
-            if i > 0:  # look up
-                up = H[i - 1, j]
-            if j > 0:  # look left
-                left = H[i, j - 1]
-            if i > 0 and j > 0:  # look diagonally
-                diag = H[i - 1, j - 1] + match(s, t, i - 1, j - 1)
-            # find the best score and remember it along with the direction
-            best_score = max(left, up, diag)
-            if best_score > float('-Inf'):  # i.e. not upper-up corner
-                H[i, j] = best_score
-
-    # return the distance
-    return max(len(s), len(t)) - H[len(s), len(t)]
-
-
-def find_substr_approx(needle, haystack):
+def levenshtein_dist(s, t, max_dist=None):
+    """Compute edit distance between two strings -- the length of the longer string minus
+    the length of their longest common subsequence (i.e., substitutions and swaps cost 1,
+    as well as insertions and deletions).
+
+    Uses a bit-parallel algorithm (Allison & Dix, Hyyrö): each position of `s` is a bit,
+    each character of `t` is processed with a few integer operations.
+
+    @param s: the 1st string
+    @param t: the 2nd string
+    @param max_dist: if set, stop early as soon as the distance is known to exceed this \
+        threshold and return max_dist + 1
+    @return: the distance (or max_dist + 1 if it exceeds max_dist)
+    """
+    if max_dist is not None and abs(len(s) - len(t)) > max_dist:
+        return max_dist + 1
+    # bit masks of occurrences of each character in s
+    masks = {}
+    for pos, char in enumerate(s):
+        masks[char] = masks.get(char, 0) | (1 << pos)
+    full = (1 << len(s)) - 1
+    longest = max(len(s), len(t))
+    # zero bits in v mark the LCS so far (v has len(s) bits)
+    v = full
+    for pos, char in enumerate(t):
+        u = v & masks.get(char, 0)
+        v = ((v + u) | (v - u)) & full
+        if max_dist is not None:
+            # best possible LCS: the current one + all the remaining characters of t
+            lcs_bound = len(s) - bin(v).count('1') + len(t) - pos - 1
+            if longest - min(lcs_bound, len(s)) > max_dist:
+                return max_dist + 1
+    return longest - (len(s) - bin(v).count('1'))
+
+
+def find_substr_approx(needle, haystack, haystack_norm=None):
     """Try to find a sub-list in a list of tokens using fuzzy matching (skipping some
-    common prepositions and punctuation, checking for similar-length substrings)"""
+    common prepositions and punctuation, checking for similar-length substrings)
+
+    @param needle: the shorter list -- the list whose position is to be found
+    @param haystack: the longer list of tokens -- the list where we should search
+    @param haystack_norm: the haystack, already normalized (`NormalizedSent`; optional)
+    @return: a tuple of starting and ending position of needle in the haystack, \
+            or None if not found
+    """
     # lowercase both for ignore-case comparison, strip accented characters
     needle = [unidecode(tok.lower()) for tok in needle]
-    haystack = [unidecode(tok.lower()) for tok in haystack]
+    if haystack_norm is None:
+        haystack_norm = NormalizedSent(haystack)
+    haystack = haystack_norm.tokens
+    haystack_chars = haystack_norm.charsets
+    needle_chars = [frozenset(tok) for tok in needle]
     # some common 'meaningless words'
     stops = set(['and', 'or', 'in', 'of', 'the', 'to', ',', 'restaurant', '\'s'])
     h = 0
@@ -127,9 +181,12 @@ def find_substr_approx(needle, haystack):
             n += 1
             h += 1
         # allow one typo, with words longer than 3
+        # (prefilter: with one typo, each word has at most one character the other one lacks)
         elif (len(haystack[h]) >= 3 and len(needle[n]) >= 3 and
                 len(needle[n]) - 1 <= len(haystack[h]) <= len(needle[n]) + 1 and
-                levenshtein_dist(haystack[h], needle[n]) <= 1):
+                len(haystack_chars[h] - needle_chars[n]) <= 1 and
+                len(needle_chars[n] - haystack_chars[h]) <= 1 and
+                levenshtein_dist(haystack[h], needle[n], max_dist=1) <= 1):
             n += 1
             h += 1
         # nothing found
@@ -141,21 +198,25 @@ def find_substr_approx(needle, haystack):
                 match_start = h
 
 
-def find_value(value, toks, toks_mask):
+def find_value(value, toks, toks_mask, toks_norm=None):
     """try to find the value in the sentence (first exact, then fuzzy)
     while masking tokens of previously found values.
     @param value: the value to be find (string)
     @param toks: the sentence where to search (as tokens)
     @param toks_mask: boolean mask for used-up tokens (will be changed if something is found!)
+    @param toks_norm: normalized sentence tokens (`NormalizedSent`; optional, will be \
+        computed if not given)
     @return: a tuple of starting and ending position of the find, or -1, -1
     """
     val_toks = value.split(' ')
     masked_toks = [t if m else '' for t, m in zip(toks, toks_mask)]
     pos = find_substr(val_toks, masked_toks)
     if pos is None:
-        pos = find_substr_tokenized(val_toks, masked_toks)
-    if pos is None:
-        pos = find_substr_approx(val_toks, masked_toks)
+        masked_norm = (toks_norm.masked(toks_mask) if toks_norm is not None
+                       else NormalizedSent(masked_toks))
+        pos = find_substr_tokenized(val_toks, masked_toks, masked_norm)
+        if pos is None:
+            pos = find_substr_approx(val_toks, masked_toks, masked_norm)
     if pos is not None:
         for idx in xrange(pos[0], pos[1]):  # mask found things so they're not found twice
             toks_mask[idx] = False
@@ -187,6 +248,7 @@ def delex_sent(da, sent, delex_slots, use_slot_names=True, delex_slot_names=Fals
     absts = []
     abst_da = DA()
     toks_mask = [True] * len(toks)
+    toks_norm = NormalizedSent(toks)
 
     # find all values in the sentence, building the delexicalized DA along the way
     # search first for longer values (so that substrings don't block them)
@@ -202,7 +264,7 @@ def delex_sent(da, sent, delex_slots, use_slot_names=True, delex_slot_names=Fals
         found = 0
         pos = (-1, -1)
         while found < 1 or (repeated and pos != (-1, -1)):
-            pos = find_value(dai.value, toks, toks_mask)
+            pos = find_value(dai.value, toks, toks_mask, toks_norm)
             # if the value is to be delexicalize, replace the value in the delexicalized DAI
             # and save abstraction instruction (even if not found in the sentence)
             if (dai.slot in delex_slots and
@@ -220,7 +282,7 @@ def delex_sent(da, sent, delex_slots, use_slot_names=True, delex_slot_names=Fals
         for dai in sorted([dai for dai in da if dai.slot is not None],
                           key=lambda dai: len(dai.slot),
                           reverse=True):
-            pos = find_value(dai.slot.replace('_', ' '), toks, toks_mask)
+            pos = find_value(dai.slot.replace('_', ' '), toks, toks_mask, toks_norm)
             if dai.slot in delex_slots:
                 absts.append(Abst(dai.slot, None, surface_form=' '.join(toks[pos[0]:pos[1]]),
                                   start=pos[0], end=pos[1]))
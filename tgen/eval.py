@@ -8,9 +8,14 @@ Evaluation (t-tree comparison functions).
 from __future__ import unicode_literals
 from collections import defaultdict
 from enum import Enum
+from itertools import izip
+from multiprocessing import Pool
+import cPickle as pickle
+import os
+import re
 from tgen.logf import log_debug, log_warn, log_info
 from tgen.tree import TreeData, TreeNode
-from tgen.futil import add_bundle_text
+from tgen.futil import add_bundle_text, trees_from_doc, file_stream, chunk_list
 import numpy as np
 
 try:
@@ -47,6 +52,57 @@ def collect_counts(sent, eval_type=EvalTypes.NODE):
     return counts
 
 
+def collect_all_counts(sent, from_ttree=False):
+    """Collect counts for all evaluation types applicable to the given tree/sentence in a single
+    pass (NODE and DEP for trees, TOKEN for lists of tokens). The counts are the same as those of
+    `collect_counts` for the corresponding TreeNode, or for the original t-tree if `from_ttree`
+    is set (the technical root of a t-tree has no parent, so it is not right of its parent; the
+    technical root of a TreeNode is).
+
+    @param sent: the TreeData tree or list of tokens (form-tag pairs) to collect counts from
+    @param from_ttree: the tree has been converted from a t-tree (see above)
+    @rtype: dict
+    @return: a dict eval type -> counts (defaultdict)
+    """
+    if isinstance(sent, list):
+        counts = defaultdict(int)
+        for tok in sent:
+            counts[tok[0]] += 1  # for tokens, use form only (ignore tag)
+        return {EvalTypes.TOKEN: counts}
+
+    node_counts = defaultdict(int)
+    dep_counts = defaultdict(int)
+    nodes, parents = sent.nodes, sent.parents
+    root_right = not from_ttree
+    for idx in xrange(1, len(nodes)):
+        node = nodes[idx]
+        parent_idx = parents[idx]
+        parent = nodes[parent_idx]
+        node_id = (node.formeme, node.t_lemma, idx > parent_idx)
+        node_counts[node_id] += 1
+        dep_counts[node_id + (parent.formeme, parent.t_lemma,
+                              parent_idx > parents[parent_idx] if parent_idx > 0
+                              else root_right)] += 1
+    return {EvalTypes.NODE: node_counts, EvalTypes.DEP: dep_counts}
+
+
+def corr_pred_gold_from_counts(gold_counts, pred_counts):
+    """Count correctly predicted, all predicted, and all golden nodes/tokens, given node/token
+    counts collected from a golden and a predicted tree/sentence (see `corr_pred_gold`).
+
+    @param gold_counts: counts collected from the golden tree/sentence
+    @param pred_counts: counts collected from the predicted tree/sentence
+    @rtype: tuple
+    @return: numbers of correctly predicted, total predicted, and total golden nodes/tokens
+    """
+    ccount, pcount = 0, 0
+    for node_id, node_count in pred_counts.iteritems():
+        pcount += node_count
+        ccount += min(node_count, gold_counts.get(node_id, 0))
+    gcount = sum(node_count for node_count in gold_counts.itervalues())
+    return ccount, pcount, gcount
+
+
 def corr_pred_gold(gold, pred, eval_type=EvalTypes.NODE):
     """Given a golden tree/sentence and a predicted tree/sentence, this counts correctly
     predicted nodes/tokens (true positives), all predicted nodes/tokens (true + false
@@ -58,14 +114,8 @@ def corr_pred_gold(gold, pred, eval_type=EvalTypes.NODE):
     @rtype: tuple
     @return: numbers of correctly predicted, total predicted, and total golden nodes/tokens
     """
-    gold_counts = collect_counts(gold, eval_type)
-    pred_counts = collect_counts(pred, eval_type)
-    ccount, pcount = 0, 0
-    for node_id, node_count in pred_counts.iteritems():
-        pcount += node_count
-        ccount += min(node_count, gold_counts[node_id])
-    gcount = sum(node_count for node_count in gold_counts.itervalues())
-    return ccount, pcount, gcount
+    return corr_pred_gold_from_counts(collect_counts(gold, eval_type),
+                                      collect_counts(pred, eval_type))
 
 
 def precision(gold, pred, eval_type=EvalTypes.NODE):
@@ -119,21 +169,73 @@ def common_subtree_size(a, b):
 
 def max_common_subphrase_length(a, b):
     """Return the length of the longest common subphrase of a and b; where a and b are
-    lists of tokens (form+tag)."""
+    lists of tokens (form+tag). Uses dynamic programming over the common suffix lengths,
+    keeping just one row of the table (O(len(a) * len(b)) time, O(len(b)) memory)."""
+    # disregard tags for comparison
+    forms_b = [tok[0] for tok in b]
     longest = 0
-    for sp_a in xrange(len(a)):
-        for sp_b in xrange(len(b)):
-            pos_a = sp_a
-            pos_b = sp_b
-            # disregard tags for comparison
-            while pos_a < len(a) and pos_b < len(b) and a[pos_a][0] == b[pos_b][0]:
-                pos_a += 1
-                pos_b += 1
-            if pos_a - sp_a > longest:
-                longest = pos_a - sp_a
+    prev_row = [0] * (len(b) + 1)
+    for tok_a in a:
+        form_a = tok_a[0]
+        cur_row = [0] * (len(b) + 1)
+        for pos_b, form_b in enumerate(forms_b, start=1):
+            if form_a == form_b:
+                cur_row[pos_b] = prev_row[pos_b - 1] + 1
+                if cur_row[pos_b] > longest:
+                    longest = cur_row[pos_b]
+        prev_row = cur_row
     return longest
 
 
+def gold_trees_from_doc(eval_doc, language, selector, eval_file=None):
+    """Convert the golden t-trees in the given document to TreeData objects. If the document
+    file name is given, the converted trees are cached in a pickle file next to it (valid as long
+    as the document file's modification time and size stay the same).
+
+    @param eval_doc: reference t-tree document
+    @param language: language for the reference trees
+    @param selector: selector for the reference trees
+    @param eval_file: path to the file from which the document was loaded (optional)
+    @return: list of TreeData objects
+    """
+    if eval_file is None:
+        return trees_from_doc(eval_doc, language, selector)
+
+    cache_fname = re.sub(r'(\.yaml|\.pickle)?(\.gz)?$',
+                         '.%s_%s.gold.pickle' % (language, selector), eval_file)
+    stat = os.stat(eval_file)
+    cache_key = (stat.st_mtime, stat.st_size)
+    if os.path.isfile(cache_fname):
+        with file_stream(cache_fname, 'rb', encoding=None) as fh:
+            key, trees = pickle.load(fh)
+        if key == cache_key and len(trees) == len(eval_doc.bundles):
+            log_info('Using cached reference trees from %s...' % cache_fname)
+            return trees
+
+    trees = trees_from_doc(eval_doc, language, selector)
+    try:
+        tmp_fname = cache_fname + '.tmp%d' % os.getpid()
+        with file_stream(tmp_fname, 'wb', encoding=None) as fh:
+            pickle.dump((cache_key, trees), fh, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_fname, cache_fname)  # atomic, so that parallel runs don't clash
+    except (IOError, OSError) as e:
+        log_warn('Could not cache reference trees in %s: %s' % (cache_fname, unicode(e)))
+    return trees
+
+
+def _evaluate_shard(pairs):
+    """Evaluate a list of golden-predicted tree pairs (in a worker process, used by
+    `Evaluator.process_eval_doc`).
+
+    @return: a tuple: Evaluator object with the accumulated statistics, list of node counts \
+        (correct, predicted, gold) for each pair
+    """
+    evaler = Evaluator()
+    node_counts = [evaler.append(gold_tree, gen_tree, gold_from_ttree=True)[EvalTypes.NODE]
+                   for gold_tree, gen_tree in pairs]
+    return evaler, node_counts
+
+
 class Stats:
     """A set of important statistic values, with simple access and printing."""
 
@@ -167,7 +269,8 @@ class Evaluator(object):
         self.sizes = []
         self.scores = []
 
-    def process_eval_doc(self, eval_doc, gen_trees, language, ref_selector, target_selector):
+    def process_eval_doc(self, eval_doc, gen_trees, language, ref_selector, target_selector,
+                         eval_file=None, workers=1):
         """Evaluate generated trees against a reference document; save per-tree statistics
         in the reference document and print out global statistics.
 
@@ -178,18 +281,32 @@ class Evaluator(object):
         @param language: language for the reference document
         @param ref_selector: selector for reference trees in the reference document
         @param target_selector: selector for generated trees (used to save statistics)
+        @param eval_file: path to the reference document file; if given, converted reference \
+            trees are cached next to it (see `gold_trees_from_doc`)
+        @param workers: number of worker processes to use for the evaluation
         """
         log_info('Evaluating...')
-        for eval_bundle, gen_tree, in zip(eval_doc.bundles, gen_trees):
-            # add some stats about the tree directly into the output file
-            eval_ttree = eval_bundle.get_zone(language, ref_selector).ttree
-            gen_ttree = TreeNode(gen_tree)
-            add_bundle_text(eval_bundle, language, target_selector + 'Xscore',
-                            "P: %.4f R: %.4f F1: %.4f" %
-                            p_r_f1_from_counts(*corr_pred_gold(eval_ttree, gen_ttree)))
-            # collect overall stats
-            # TODO maybe add cost somehow?
-            self.append(eval_ttree, gen_ttree)
+        gold_trees = gold_trees_from_doc(eval_doc, language, ref_selector, eval_file)
+        pairs = zip(gold_trees, gen_trees)
+        if workers > 1 and len(pairs) > 1:
+            shard_size = (len(pairs) + workers - 1) // workers
+            pool = Pool(workers)
+            try:
+                results = pool.map(_evaluate_shard, list(chunk_list(pairs, shard_size)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_evaluate_shard(pairs)]
+
+        eval_bundles = iter(eval_doc.bundles)
+        for evaler, node_counts in results:
+            self.merge(evaler)
+            for (ccount, pcount, gcount), eval_bundle in izip(node_counts, eval_bundles):
+                # add some stats about the tree directly into the output file
+                add_bundle_text(eval_bundle, language, target_selector + 'Xscore',
+                                "P: %.4f R: %.4f F1: %.4f" %
+                                p_r_f1_from_counts(ccount, pcount, gcount))
 
         # print out the overall stats
         log_info("NODE precision: %.4f, Recall: %.4f, F1: %.4f" % self.p_r_f1())
@@ -199,40 +316,59 @@ class Evaluator(object):
         log_info("Common subtree stats:\n -- SIZE: %s\n -- ΔGLD: %s\n -- ΔPRD: %s" %
                  self.common_substruct_stats())
 
-    def append(self, gold, pred, gold_score=0.0, pred_score=0.0):
+    def append(self, gold, pred, gold_score=0.0, pred_score=0.0, gold_from_ttree=False):
         """Add a pair of golden and predicted tree/sentence to the current statistics.
 
-        @param gold: a T or TreeNode object representing the golden tree, or list of golden tokens
-        @param pred: a T or TreeNode object representing the predicted tree, or list of predicted \
-            tokens
+        @param gold: a T, TreeNode or TreeData object representing the golden tree, or list of \
+            golden tokens
+        @param pred: a T, TreeNode or TreeData object representing the predicted tree, or list \
+            of predicted tokens
+        @param gold_from_ttree: the golden TreeData tree has been converted from a t-tree \
+            (count it the same as the original t-tree, see `collect_all_counts`)
+        @return: a dict eval type -> counts (correct, predicted, gold) for the given pair
         """
-        if isinstance(gold, list):  # tokens
-            eval_types = [EvalTypes.TOKEN]
-            gold_len = len(gold)
-            pred_len = len(pred)
-            css = max_common_subphrase_length(gold, pred)
+        if isinstance(gold, (list, TreeData)):  # tokens or TreeData trees: single-pass counts
+            gold_counts = collect_all_counts(gold, gold_from_ttree)
+            pred_counts = collect_all_counts(pred)
+            pair_counts = {eval_type: corr_pred_gold_from_counts(gold_counts[eval_type],
+                                                                 pred_counts[eval_type])
+                           for eval_type in gold_counts}
+            if isinstance(gold, list):
+                gold_len = len(gold)
+                pred_len = len(pred)
+                css = max_common_subphrase_length(gold, pred)
+            else:
+                gold_len = len(gold) - 1  # do not count the technical root
+                pred_len = len(pred) - 1
+                css = gold.common_subtree_size(pred)
         else:  # trees
-            eval_types = [EvalTypes.NODE, EvalTypes.DEP]
             gold_len = len(gold.get_descendants())
             pred_len = len(pred.get_descendants())
             css = common_subtree_size(gold, pred)
+            pair_counts = {eval_type: corr_pred_gold(gold, pred, eval_type)
+                           for eval_type in [EvalTypes.NODE, EvalTypes.DEP]}
         self.sizes.append((gold_len, pred_len, css))
 
-        for eval_type in eval_types:
-            ccount, pcount, gcount = corr_pred_gold(gold, pred, eval_type)
+        for eval_type, (ccount, pcount, gcount) in pair_counts.iteritems():
             self.correct[eval_type] += ccount
             self.predicted[eval_type] += pcount
             self.gold[eval_type] += gcount
         self.scores.append((gold_score, pred_score))
+        return pair_counts
 
     def merge(self, other):
-        """Merge in statistics from another Evaluator object."""
+        """Merge in statistics from another Evaluator object (e.g. computed on another
+        part of the data in a different process).
+
+        @return: self, so that a list of Evaluators can be merged using `reduce`
+        """
         for eval_type in EvalTypes:
             self.correct[eval_type] += other.correct[eval_type]
             self.predicted[eval_type] += other.predicted[eval_type]
             self.gold[eval_type] += other.gold[eval_type]
         self.sizes.extend(other.sizes)
         self.scores.extend(other.scores)
+        return self
 
     def f1(self, eval_type=EvalTypes.NODE):
         return self.p_r_f1(eval_type)[2]
@@ -312,11 +448,14 @@ class ASearchListsAnalyzer(object):
             log_debug('GOLD TREE IS ON OPEN LIST')
 
     def merge(self, other):
-        """Merge in another ASearchListsAnalyzer object."""
+        """Merge in another ASearchListsAnalyzer object.
+        @return: self, so that a list of analyzers can be merged using `reduce`
+        """
         self.total += other.total
         self.gold_best += other.gold_best
         self.gold_on_close += other.gold_on_close
         self.gold_on_open += other.gold_on_open
+        return self
 
     def stats(self):
         """Return statistics (as percentages): gold tree was best, gold tree was on
@@ -356,6 +495,15 @@ class SlotErrAnalyzer(object):
         self.missing += len(slots_in_da - slots_in_sent)
         self.superfluous += len(slots_in_sent - slots_in_da)
 
+    def merge(self, other):
+        """Merge in another SlotErrAnalyzer object.
+        @return: self, so that a list of analyzers can be merged using `reduce`
+        """
+        self.missing += other.missing
+        self.superfluous += other.superfluous
+        self.total += other.total
+        return self
+
     def slot_error(self):
         """Return the currently accumulated slot error."""
         if self.total == 0:  # avoid zero division error
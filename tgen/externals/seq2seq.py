@@ -658,6 +658,115 @@ def embedding_attention_decoder(decoder_inputs, initial_state, attention_states,
         num_heads=num_heads, loop_function=loop_function)
 
 
+def embedding_attention_encoder(encoder_inputs, cell, num_encoder_symbols,
+                                embedding_size, dtype=dtypes.float32):
+  """Encoder of the embedding sequence-to-sequence model with attention.
+
+  This is the encoder part of `embedding_attention_seq2seq`; it must be called
+  in the variable scope of the whole model.
+
+  Args:
+    encoder_inputs: a list of 1D int32 Tensors of shape [batch_size].
+    cell: RNNCell defining the cell function and size.
+    num_encoder_symbols: integer; number of symbols on the encoder side.
+    embedding_size: integer, the length of the embedding vector for each symbol.
+    dtype: The dtype of the initial RNN state (default: tf.float32).
+
+  Returns:
+    A pair (encoder_state, attention_states) where encoder_state is the final
+      encoder state and attention_states is a 3D Tensor
+      [batch_size x attn_length x attn_size] of all encoder outputs.
+  """
+  encoder_cell = EmbeddingWrapper(cell, num_encoder_symbols, embedding_size)
+  encoder_outputs, encoder_states = rnn(
+      encoder_cell, encoder_inputs, dtype=dtype)
+
+  # First calculate a concatenation of encoder outputs to put attention on.
+  top_states = [array_ops.reshape(e, [-1, 1, cell.output_size])
+                for e in encoder_outputs]
+  attention_states = array_ops.concat(top_states, 1)
+  return encoder_states[-1], attention_states
+
+
+def embedding_attention_decoder_step(decoder_input, state, attns,
+                                     attention_states, cell, num_symbols,
+                                     embedding_size, num_heads=1,
+                                     output_size=None):
+  """A single step of `embedding_attention_decoder`.
+
+  The state and attention reads from the previous step are given explicitly, so
+  this can be used for decoding inside a `tf.while_loop`. It must be called in
+  the variable scope of the whole model (as used by `embedding_attention_seq2seq`),
+  with variable reuse -- it does not create any variables of its own.
+
+  Args:
+    decoder_input: 1D batch-sized int32 Tensor (decoder input for this step).
+    state: decoder cell state from the previous step (the final encoder state
+      for the first step).
+    attns: a list of num_heads 2D Tensors [batch_size x attn_size], attention
+      reads from the previous step (zeros for the first step).
+    attention_states: 3D Tensor [batch_size x attn_length x attn_size].
+    cell: RNNCell defining the cell function (including output projection).
+    num_symbols: integer, how many symbols come into the embedding.
+    embedding_size: integer, the length of the embedding vector for each symbol.
+    num_heads: number of attention heads that read from attention_states.
+    output_size: size of the output vectors; if None, use cell.output_size.
+
+  Returns:
+    A triple (output, new_state, new_attns) -- output for this step
+      [batch_size x output_size], the new cell state and the new attention reads.
+  """
+  if output_size is None:
+    output_size = cell.output_size
+
+  with vs.variable_scope("embedding_attention_decoder"):
+    with ops.device("/cpu:0"):
+      embedding = vs.get_variable("embedding", [num_symbols, embedding_size])
+    inp = embedding_ops.embedding_lookup(embedding, decoder_input)
+
+    with vs.variable_scope("attention_decoder"):
+      attn_length = attention_states.get_shape()[1].value
+      attn_size = attention_states.get_shape()[2].value
+      hidden = array_ops.reshape(
+          attention_states, [-1, attn_length, 1, attn_size])
+      hidden_features = []
+      v = []
+      attention_vec_size = attn_size
+      for a in xrange(num_heads):
+        k = vs.get_variable("AttnW_%d" % a,
+                            [1, 1, attn_size, attention_vec_size])
+        hidden_features.append(nn_ops.conv2d(hidden, k, [1, 1, 1, 1], "SAME"))
+        v.append(vs.get_variable("AttnV_%d" % a, [attention_vec_size]))
+
+      # Merge input and previous attentions, run the RNN.
+      input_size = inp.get_shape().with_rank(2)[1]
+      x = linear([inp] + attns, input_size, True)
+      cell_output, new_state = cell(x, state)
+      query = new_state
+      # flatten the dimensions in multi-layer LSTMs (concatenate all)
+      if isinstance(new_state, tuple) and isinstance(new_state[0], tuple):
+        query = array_ops.transpose(array_ops.concat(new_state, axis=0), [1, 0, 2])
+        query = array_ops.reshape(query, [-1, int(query.get_shape()[1] * query.get_shape()[2])])
+
+      # Run the attention mechanism (same as in `attention_decoder`).
+      new_attns = []
+      for a in xrange(num_heads):
+        with vs.variable_scope("Attention_%d" % a):
+          y = linear(query, attention_vec_size, True)
+          y = array_ops.reshape(y, [-1, 1, 1, attention_vec_size])
+          s = math_ops.reduce_sum(
+              v[a] * math_ops.tanh(hidden_features[a] + y), [2, 3])
+          mask = nn_ops.softmax(s)
+          d = math_ops.reduce_sum(
+              array_ops.reshape(mask, [-1, attn_length, 1, 1]) * hidden,
+              [1, 2])
+          new_attns.append(array_ops.reshape(d, [-1, attn_size]))
+      with vs.variable_scope("AttnOutputProjection"):
+        output = linear([cell_output] + new_attns, output_size, True)
+
+  return output, new_state, new_attns
+
+
 def embedding_attention_seq2seq(encoder_inputs, decoder_inputs, cell,
                                 num_encoder_symbols, num_decoder_symbols,
                                 embedding_size,
@@ -702,14 +811,8 @@ def embedding_attention_seq2seq(encoder_inputs, decoder_inputs, cell,
   """
   with vs.variable_scope(scope or "embedding_attention_seq2seq"):
     # Encoder.
-    encoder_cell = EmbeddingWrapper(cell, num_encoder_symbols, embedding_size)
-    encoder_outputs, encoder_states = rnn(
-        encoder_cell, encoder_inputs, dtype=dtype)
-
-    # First calculate a concatenation of encoder outputs to put attention on.
-    top_states = [array_ops.reshape(e, [-1, 1, cell.output_size])
-                  for e in encoder_outputs]
-    attention_states = array_ops.concat(top_states, 1)
+    encoder_state, attention_states = embedding_attention_encoder(
+        encoder_inputs, cell, num_encoder_symbols, embedding_size, dtype=dtype)
 
     # Decoder.
     output_size = None
@@ -719,17 +822,17 @@ def embedding_attention_seq2seq(encoder_inputs, decoder_inputs, cell,
 
     if isinstance(feed_previous, bool):
       return embedding_attention_decoder(
-          decoder_inputs, encoder_states[-1], attention_states, cell,
+          decoder_inputs, encoder_state, attention_states, cell,
           num_decoder_symbols, embedding_size, num_heads, output_size,
           output_projection, feed_previous)
     else:  # If feed_previous is a Tensor, we construct 2 graphs and use cond.
       outputs1, states1 = embedding_attention_decoder(
-          decoder_inputs, encoder_states[-1], attention_states, cell,
+          decoder_inputs, encoder_state, attention_states, cell,
           num_decoder_symbols, embedding_size, num_heads, output_size,
           output_projection, True)
       vs.get_variable_scope().reuse_variables()
       outputs2, states2 = embedding_attention_decoder(
-          decoder_inputs, encoder_states[-1], attention_states, cell,
+          decoder_inputs, encoder_state, attention_states, cell,
           num_decoder_symbols, embedding_size, num_heads, output_size,
           output_projection, False)
 
@@ -11,11 +11,18 @@ import codecs
 import gzip
 import regex
 import re
+import os
+import struct
+import zipfile
 from io import IOBase, BytesIO
+from itertools import islice, izip
 from codecs import StreamReader, StreamWriter
 
-from tree import TreeData
+import numpy as np
+
+from tree import TreeData, NodeData
 from data import Abst, DA
+from logf import log_info, log_debug, log_warn
 
 
 def file_stream(filename, mode='r', encoding='UTF-8'):
@@ -39,14 +46,36 @@ def file_stream(filename, mode='r', encoding='UTF-8'):
     return fh
 
 
-def read_das(da_file):
-    """Read dialogue acts from a file, one-per-line."""
-    das = []
-    with file_stream(da_file) as fh:
-        for line in fh:
-            da = DA.parse(line.strip())
-            das.append(da)
-    return das
+def read_das(da_file, intern=False):
+    """Read dialogue acts from a file, one-per-line.
+    @param da_file: path to the file containing DAs (or an open stream)
+    @param intern: intern the DAs (see `DA.intern`) -- equal DAs are then parsed just once \
+        and shared, so they must not be modified
+    """
+    return list(iter_das(da_file, intern=intern))
+
+
+def iter_das(da_file, chunk_size=None, intern=False):
+    """Read dialogue acts from a file lazily, one-per-line.
+    @param da_file: path to the file containing DAs (or an open stream)
+    @param chunk_size: if set, yield lists of up to this number of DAs instead of single DAs
+    @param intern: intern the DAs (see `DA.intern`) -- equal DAs are then parsed just once \
+        and shared, so they must not be modified
+    @return: generator of DAs (or lists of DAs)
+    """
+    if intern:
+        parsed = {}
+
+        def parse_line(line):
+            line = line.strip()
+            da = parsed.get(line)
+            if da is None:
+                da = parsed[line] = DA.intern(DA.parse(line))
+            return da
+    else:
+        parse_line = lambda line: DA.parse(line.strip())
+    das = _iter_lines(da_file, parse_line)
+    return chunk_iter(das, chunk_size) if chunk_size else das
 
 
 def read_absts(abst_file):
@@ -54,16 +83,36 @@ def read_absts(abst_file):
     @param abst_file: path to the file containing lexicalization instructions
     @return: list of list of Abst objects, representing the instructions
     """
-    abstss = []
-    with file_stream(abst_file) as fh:
+    return list(iter_absts(abst_file))
+
+
+def iter_absts(abst_file, chunk_size=None):
+    """Read abstraction/lexicalization instructions from a file lazily, one sentence per line.
+    @param abst_file: path to the file containing lexicalization instructions (or an open stream)
+    @param chunk_size: if set, yield lists of up to this number of sentences' instructions
+    @return: generator of lists of Abst objects (or lists of such lists)
+    """
+    abstss = _iter_lines(abst_file, parse_absts)
+    return chunk_iter(abstss, chunk_size) if chunk_size else abstss
+
+
+def _iter_lines(fname, parse_func):
+    """Open the given file and yield the parsed contents of each line (using the given function)."""
+    with file_stream(fname) as fh:
         for line in fh:
-            line = line.strip()
-            absts = []
-            if line:  # empty lines = empty abstraction instructions
-                for abst_str in line.split("\t"):
-                    absts.append(Abst.parse(abst_str))
-            abstss.append(absts)
-    return abstss
+            yield parse_func(line)
+
+
+def parse_absts(line):
+    """Parse abstraction/lexicalization instructions for one sentence (one line of an
+    abstraction file, instructions separated by tabs).
+    @param line: the line to parse (empty line = no instructions)
+    @return: list of Abst objects
+    """
+    line = line.strip()
+    if not line:
+        return []
+    return [Abst.parse(abst_str) for abst_str in line.split("\t")]
 
 
 def smart_load_absts(fname, num_expected=None):
@@ -96,6 +145,47 @@ def smart_load_absts(fname, num_expected=None):
             return read_absts(buf)
 
 
+def smart_iter_absts(fname, num_expected=None):
+    """Read lexicalization instructions lazily, one sentence at a time. This is a streaming
+    version of `smart_load_absts`, with the same detection of DA files and multi-reference mode
+    (the file is scanned once upfront to detect its format, memory use does not depend on the
+    file size).
+    @param fname: path to the abstraction instructions file (or DA file)
+    @param num_expected: expected number of sentences (used to detect multi-reference mode)
+    @return: generator of lists of Abst objects, one per sentence
+    """
+    has_tab, has_empty, num_lines = False, False, 0
+    with file_stream(fname) as fh:
+        for line in fh:
+            if '\t' in line:
+                has_tab = True
+            if num_lines > 0 and not line.rstrip('\r\n'):
+                has_empty = True
+            num_lines += 1
+
+    with file_stream(fname) as fh:
+        # read DAs and convert them to Absts
+        if not has_tab:
+            for line in fh:
+                yield [Abst(dai.slot, dai.value) for dai in DA.parse(line.strip())
+                       if dai.value not in [None, 'dont_care', 'dontcare']]
+        # multi-reference mode: only output Absts for 1st reference of each instance
+        # (unless there's 1:1 length correspondence, then assume 1 reference)
+        elif has_empty and num_lines != num_expected:
+            ref1st = True
+            for line in fh:
+                absts = parse_absts(line)
+                if not absts:
+                    ref1st = True
+                elif ref1st:
+                    yield absts
+                    ref1st = False
+        # plain 1-reference abstraction file
+        else:
+            for line in fh:
+                yield parse_absts(line)
+
+
 def read_ttrees(ttree_file):
     """Read t-trees from a YAML/Pickle file."""
     from pytreex.block.read.yaml import YAML as YAMLReader
@@ -116,6 +206,245 @@ def read_ttrees(ttree_file):
     return ttrees
 
 
+def trees_from_file(ttree_file, language, selector, start=0, end=None):
+    """Read t-trees from a YAML/Pickle file and return them as TreeData objects, using
+    a t-tree cache (see `ttree_cache`).
+    @param ttree_file: t-tree file path
+    @param language: language of the t-trees
+    @param selector: selector(s) of the t-trees (comma-separated)
+    @param start: index of the first tree to return
+    @param end: index after the last tree to return (defaults to the end of the file)
+    @return: list of TreeData objects
+    """
+    return _projection_from_file('trees', ttree_file, language, selector, start, end)
+
+
+def tokens_from_file(ttree_file, language, selector, start=0, end=None):
+    """Read t-trees from a YAML/Pickle file and return their tokens (lists of form-tag pairs),
+    using a t-tree cache (see `ttree_cache` and `tokens_from_doc`; parameters are the same as
+    for `trees_from_file`)."""
+    return _projection_from_file('tokens', ttree_file, language, selector, start, end)
+
+
+def tagged_lemmas_from_file(ttree_file, language, selector, start=0, end=None):
+    """Read t-trees from a YAML/Pickle file and return their tagged lemmas (lists of lemma-tag
+    pairs), using a t-tree cache (see `ttree_cache` and `tagged_lemmas_from_doc`; parameters
+    are the same as for `trees_from_file`)."""
+    return _projection_from_file('tagged_lemmas', ttree_file, language, selector, start, end)
+
+
+def _projection_from_file(kind, ttree_file, language, selector, start, end):
+    """Return the given projection ('trees', 'tokens', or 'tagged_lemmas') of a range of trees
+    from a t-tree file, via the t-tree cache (or directly from the t-tree document if the
+    projection could not be cached). Only the part of the cache needed for the given range
+    is read, and only the vocabulary items used in the range are decoded."""
+    cache = ttree_cache(ttree_file, language, selector)
+    if kind + '_ids' not in cache:
+        doc = read_ttrees(ttree_file)
+        func = {'trees': trees_from_doc, 'tokens': tokens_from_doc,
+                'tagged_lemmas': tagged_lemmas_from_doc}[kind]
+        return func(doc, language, selector)[start:end]
+
+    offsets = cache[kind + '_offsets'][start:end + 1 if end is not None else None]
+    if not len(offsets):
+        return []
+    used_ids = np.unique(cache[kind + '_ids'][offsets[0]:offsets[-1]])
+    vocab = dict(izip(used_ids.tolist(),
+                      vocab_from_arrays([cache['item_firsts'][used_ids],
+                                         cache['item_seconds'][used_ids]],
+                                        cache['item_nones'][used_ids])))
+    if kind != 'trees':
+        return list(decode_seqs(vocab, cache[kind + '_ids'], cache[kind + '_offsets'],
+                                start, end))
+    nodes = {idx: NodeData(*item) for idx, item in vocab.iteritems()}
+    parents = cache['trees_parents'][offsets[0]:offsets[-1]].tolist()
+    offsets = (offsets - offsets[0]).tolist()
+    return [TreeData(tree_nodes, parents[tree_start:tree_end])
+            for tree_nodes, tree_start, tree_end in izip(
+                decode_seqs(nodes, cache['trees_ids'], cache['trees_offsets'], start, end),
+                offsets, offsets[1:])]
+
+
+def ttree_cache(ttree_file, language, selector):
+    """Return the t-tree cache for the given t-tree file, language and selector. The cache only
+    contains projections of the t-trees used in training and evaluation (TreeData nodes and
+    parents, tokens and tagged lemmas; interned, as flat arrays + offsets) and is stored in an
+    .npz file next to the t-tree file. It is valid as long as the t-tree file's modification
+    time and size stay the same; it is (re)built from the t-tree document if needed. Arrays
+    of an existing cache file are memory-mapped (see `mmap_npz`), so only the parts actually
+    used are read.
+
+    @param ttree_file: t-tree file path
+    @param language: language of the t-trees
+    @param selector: selector(s) of the t-trees (comma-separated)
+    @return: a dictionary with the cached arrays
+    """
+    cache_fname = re.sub(r'(\.yaml|\.pickle)?(\.gz)?$',
+                         '.%s_%s.ttcache.npz' % (language, selector), ttree_file)
+    stat = os.stat(ttree_file)
+    cache_key = np.array([stat.st_mtime, stat.st_size], dtype=np.float64)
+    if os.path.isfile(cache_fname):
+        try:
+            data = mmap_npz(cache_fname)
+            if np.array_equal(data['key'], cache_key):
+                log_info('Using cached t-tree data from %s...' % cache_fname)
+                return data
+        except (IOError, ValueError, KeyError, zipfile.BadZipfile, struct.error) as e:
+            log_warn('Could not read t-tree cache %s: %s' % (cache_fname, unicode(e)))
+
+    doc = read_ttrees(ttree_file)
+    cache = {'key': cache_key}
+    items = SeqInterner()
+    for kind, func in [('trees', trees_from_doc), ('tokens', tokens_from_doc),
+                       ('tagged_lemmas', tagged_lemmas_from_doc)]:
+        try:
+            sents = func(doc, language, selector)
+        except Exception as e:  # e.g. no a-trees in the document
+            log_debug('Could not cache %s for %s: %s' % (kind, ttree_file, unicode(e)))
+            continue
+        if kind == 'trees':
+            cache['trees_parents'] = np.array([idx for tree in sents for idx in tree.parents],
+                                              dtype=np.int32)
+            sents = [[tuple(node) for node in tree.nodes] for tree in sents]
+        cache[kind + '_ids'], cache[kind + '_offsets'] = items.encode(
+            [tuple(tok) for tok in sent] for sent in sents)
+    cache['item_firsts'], cache['item_seconds'], cache['item_nones'] = items.to_arrays(2)
+
+    try:
+        tmp_fname = cache_fname + '.tmp%d' % os.getpid()
+        with open(tmp_fname, 'wb') as fh:
+            np.savez(fh, **cache)
+        os.rename(tmp_fname, cache_fname)  # atomic, so that parallel runs don't clash
+    except (IOError, OSError) as e:
+        log_warn('Could not cache t-tree data in %s: %s' % (cache_fname, unicode(e)))
+    return cache
+
+
+def mmap_npz(fname):
+    """Memory-map all arrays stored in an uncompressed .npz file (as written by `np.savez`).
+    Members that cannot be mapped (e.g. empty arrays) are read directly.
+
+    @param fname: path to the .npz file
+    @return: dictionary of read-only arrays (keys = names without the .npy extension)
+    """
+    arrays = {}
+    with zipfile.ZipFile(fname) as zf, open(fname, 'rb') as fh:
+        for info in zf.infolist():
+            name = re.sub(r'\.npy$', '', info.filename)
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError('Member %s of %s is compressed' % (name, fname))
+            # skip the local file header (its name and extra field lengths are at bytes 26-29)
+            fh.seek(info.header_offset)
+            name_len, extra_len = struct.unpack(b'<HH', fh.read(30)[26:30])
+            fh.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(fh)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fh)
+            elif version == (2, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fh)
+            else:
+                raise ValueError('Unsupported .npy format version %s in %s' % (str(version), fname))
+            if dtype.hasobject:
+                raise ValueError('Member %s of %s contains Python objects' % (name, fname))
+            if not np.prod(shape, dtype=np.int64):
+                arrays[name] = np.zeros(shape, dtype=dtype)
+                continue
+            arrays[name] = np.memmap(fname, dtype=dtype, mode='r', offset=fh.tell(), shape=shape,
+                                     order='F' if fortran_order else 'C')
+    return arrays
+
+
+class SeqInterner(object):
+    """Interning of hashable items (e.g. DAIs, form-tag pairs, tree nodes) into a vocabulary,
+    with sequences of items stored as flat ID arrays + offsets."""
+
+    def __init__(self):
+        self.vocab = {}
+
+    def encode(self, seqs):
+        """Encode the given sequences of items, return a pair of arrays: item IDs and offsets
+        of the individual sequences."""
+        ids = []
+        offsets = [0]
+        for seq in seqs:
+            for item in seq:
+                ids.append(self.vocab.setdefault(item, len(self.vocab)))
+            offsets.append(len(ids))
+        return np.array(ids, dtype=np.int32), np.array(offsets, dtype=np.int64)
+
+    def to_arrays(self, width):
+        """Return the vocabulary as a list of arrays, one for each of the `width` item fields
+        (unicode strings), plus an array of bit masks marking None values."""
+        items = [None] * len(self.vocab)
+        for item, idx in self.vocab.iteritems():
+            items[idx] = item
+        fields = [np.array([item[pos] or '' for item in items], dtype=np.unicode_)
+                  for pos in xrange(width)]
+        nones = np.array([sum(1 << pos for pos in xrange(width) if item[pos] is None)
+                          for item in items], dtype=np.uint8)
+        return fields + [nones]
+
+
+def vocab_from_arrays(fields, nones):
+    """Reconstruct a vocabulary (list of tuples) from arrays created by `SeqInterner.to_arrays`."""
+    fields = [field.tolist() for field in fields]
+    return [tuple(None if mask & (1 << pos) else val for pos, val in enumerate(vals))
+            for vals, mask in izip(izip(*fields), nones.tolist())]
+
+
+def decode_seqs(vocab, ids, offsets, start=0, end=None):
+    """Yield lists of vocabulary items for sequences stored in the given ID/offset arrays
+    (created by `SeqInterner.encode`), optionally just for the given range of sequences."""
+    offsets = offsets[start:end + 1 if end is not None else None].tolist()
+    if not offsets:
+        return
+    ids = ids[offsets[0]:offsets[-1]].tolist()
+    base = offsets[0]
+    for seq_start, seq_end in izip(offsets, offsets[1:]):
+        yield [vocab[idx] for idx in ids[seq_start - base:seq_end - base]]
+
+
+def write_flat_arrays(fname, arrays, align=64):
+    """Write a dictionary of numpy arrays into a single flat binary file (raw array data, no
+    pickling), so that it can be memory-mapped by `read_flat_arrays`. The file is written
+    atomically (via a temporary file).
+
+    @param fname: target file name
+    @param arrays: dictionary of numpy arrays (keys = names)
+    @param align: alignment of the individual arrays' data in the file (bytes)
+    @return: index of the file contents -- a dictionary: name -> (dtype, shape, offset)
+    """
+    index = {}
+    tmp_fname = fname + '.tmp-%d' % os.getpid()
+    with open(tmp_fname, 'wb') as fh:
+        offset = 0
+        for name in sorted(arrays.keys()):
+            arr = np.ascontiguousarray(arrays[name])
+            if offset % align:
+                fh.write(b'\0' * (align - offset % align))
+                offset += align - offset % align
+            index[name] = (arr.dtype.str, arr.shape, offset)
+            arr.tofile(fh)
+            offset += arr.nbytes
+    os.rename(tmp_fname, fname)
+    return index
+
+
+def read_flat_arrays(fname, index):
+    """Map a file created by `write_flat_arrays` into memory, return the arrays it contains
+    as read-only views into the mapped file.
+
+    @param fname: file name
+    @param index: index of the file contents, as returned by `write_flat_arrays`
+    @return: dictionary of numpy arrays (keys = names)
+    """
+    if os.path.getsize(fname) == 0:  # empty files cannot be mapped
+        return {name: np.zeros(shape, dtype=dtype) for name, (dtype, shape, _) in index.iteritems()}
+    buf = np.memmap(fname, dtype=np.uint8, mode='r')
+    return {name: np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset)
+            for name, (dtype, shape, offset) in index.iteritems()}
+
+
 def write_ttrees(ttree_doc, fname):
     """Write a t-tree Document object to a YAML file."""
     from pytreex.block.write.yaml import YAML as YAMLWriter
@@ -143,8 +472,111 @@ def create_ttree_doc(trees, base_doc, language, selector):
     return base_doc
 
 
+# punctuation (except ,.-) runs, and commas/periods that are not surrounded by numbers on both
+# sides (numbers that will not be separated as punctuation themselves)
+_TOK_PUNCT_RE = regex.compile(r'(([^\p{IsAlnum}\s\.\,−\-])\2*'
+                              r'|(?<![\p{N}&&\p{IsAlnum}])[,.]|[,.](?![\p{N}&&\p{IsAlnum}]))',
+                              regex.V1)
+# commas/periods close to each other -- need to be handled by the original rule sequence
+_TOK_CLOSE_PUNCT_RE = regex.compile(r'[,.].?[,.]', regex.DOTALL)
+_TOK_PUNCT_SLOW_RES = [(regex.compile(r'(([^\p{IsAlnum}\s\.\,−\-])\2*)'), r' \1 '),
+                       (regex.compile(r'([^\p{N}])([,.])([^\p{N}])'), r'\1 \2 \3'),
+                       (regex.compile(r'([^\p{N}])([,.])([\p{N}])'), r'\1 \2 \3'),
+                       (regex.compile(r'([\p{N}])([,.])([^\p{N}])'), r'\1 \2 \3')]
+_TOK_HYPHEN_RES = [(regex.compile(r'(–-)([^\p{N}])'), r'\1 \2'),
+                   (regex.compile(r'(\p{N} *|[^ ])(-)'), r'\1\2 ')]
+_TOK_APOS_RE = regex.compile(r'([\'’´]) (s|m|d|ll|re|ve)\s|(n [\'’´]) (t\s)')
+# Treex contractions, in the order of application in `tokenize_reference`
+_TOK_CONTRACTIONS = [(r'([Cc])annot', r'\1an not'),
+                     (r'([Dd]) \' ye', r'\1\' ye'),
+                     (r'([Gg])imme', r'\1im me'),
+                     (r'([Gg])onna', r'\1on na'),
+                     (r'([Gg])otta', r'\1ot ta'),
+                     (r'([Ll])emme', r'\1em me'),
+                     (r'([Mm])ore\'n', r'\1ore \'n'),
+                     (r'\' ([Tt])is', r'\'\1 is'),
+                     (r'\' ([Tt])was', r'\'\1 was'),
+                     (r'([Ww])anna', r'\1an na')]
+_TOK_CONTRACTIONS_RE = regex.compile(r'(?<=\s)(?:' +
+                                     '|'.join('(?P<c%d>%s)' % (num, pat)
+                                              for num, (pat, _) in enumerate(_TOK_CONTRACTIONS)) +
+                                     r')(?=\s)')
+_TOK_SPACE_RE = regex.compile(r'\s+')
+
+
 def tokenize(text):
-    """Tokenize the given text (i.e., insert spaces around all tokens)"""
+    """Tokenize the given text (i.e., insert spaces around all tokens).
+
+    This gives the same results as `tokenize_reference`, but merges most of the rules into a few
+    compiled regular expressions that are applied in a single pass each (and skips rules
+    that cannot apply)."""
+    toks = ' ' + text + ' '  # for easier regexes
+
+    # enforce space around all punct
+    if _TOK_CLOSE_PUNCT_RE.search(toks):  # rare case: the rules for ,. interact
+        for pat, repl in _TOK_PUNCT_SLOW_RES:
+            toks = pat.sub(repl, toks)
+    else:
+        toks = _TOK_PUNCT_RE.sub(r' \1 ', toks)
+    if '-' in toks:
+        for pat, repl in _TOK_HYPHEN_RES:
+            toks = pat.sub(repl, toks)
+        toks = toks.replace('-', ' -')
+    if '−' in toks:
+        toks = toks.replace('−', ' −')
+
+    # keep apostrophes together with words in most common contractions
+    if '\'' in toks or '’' in toks or '´' in toks:
+        toks = _TOK_APOS_RE.sub(_tokenize_apos, toks)
+
+    # other contractions, as implemented in Treex
+    toks = _TOK_CONTRACTIONS_RE.sub(_ContractionReplacer(toks), toks)
+
+    # clean extra space
+    return _TOK_SPACE_RE.sub(' ', toks).strip()
+
+
+def _tokenize_apos(match):
+    """Replacement function for apostrophes in common contractions in `tokenize`
+    (I ' m -> I 'm, do n ' t -> do n't)."""
+    if match.group(1) is not None:
+        return ' ' + match.group(1) + match.group(2) + ' '
+    return ' ' + match.group(3) + match.group(4) + ' '
+
+
+class _ContractionReplacer(object):
+    """Replacement function for Treex contractions in `tokenize`. The contractions are found
+    in a single pass, but this emulates applying the rules one after another, as in
+    `tokenize_reference`: each rule there consumes the whitespace following a match (which
+    is then not available as a preceding space for the same rule), and replaces it with
+    a plain space (which is then available to the following rules)."""
+
+    def __init__(self, toks):
+        self.toks = toks
+        self.last_end = -1
+        self.last_rule = None  # rule of the last applied match
+
+    def __call__(self, match):
+        rule = int(match.lastgroup[1:])
+        start = match.start()
+        if self.last_rule is not None and self.last_end == start - 1:
+            if rule == self.last_rule:
+                applied = False
+            else:
+                applied = rule > self.last_rule or self.toks[start - 1] == ' '
+        else:
+            applied = self.toks[start - 1] == ' '
+        self.last_end = match.end()
+        self.last_rule = rule if applied else None
+        if not applied:
+            return match.group(0)
+        pat, repl = _TOK_CONTRACTIONS[rule]
+        return regex.sub(pat, repl, match.group(0))
+
+
+def tokenize_reference(text):
+    """Tokenize the given text (i.e., insert spaces around all tokens) -- the original
+    implementation applying all rules one by one, kept as a reference for `tokenize`."""
     toks = ' ' + text + ' '  # for easier regexes
 
     # enforce space around all punct
@@ -181,45 +613,84 @@ def tokenize(text):
 def read_tokens(tok_file, ref_mode=False, do_tokenize=False):
     """Read sentences (one per line) from a file and return them as a list of tokens
     (forms with undefined POS tags)."""
-    tokens = []
+    return list(iter_tokens(tok_file, ref_mode, do_tokenize))
+
+
+def iter_tokens(tok_file, ref_mode=False, do_tokenize=False, chunk_size=None):
+    """Read sentences (one per line) from a file lazily, yielding them as lists of tokens
+    (forms with undefined POS tags). In reference mode, if the file contains empty lines,
+    they separate groups of references, and each group is yielded as a list of sentences
+    (the file is scanned once upfront to find out).
+
+    @param tok_file: path to the file containing the sentences (or an open stream)
+    @param ref_mode: reference mode -- regroup references separated by empty lines?
+    @param do_tokenize: tokenize the sentences before splitting them on spaces?
+    @param chunk_size: if set, yield lists of up to this number of sentences (reference groups)
+    @return: generator of lists of tokens (or reference groups, or lists of these)
+    """
+    toks = _iter_tokens(tok_file, ref_mode, do_tokenize)
+    return chunk_iter(toks, chunk_size) if chunk_size else toks
+
+
+def _iter_tokens(tok_file, ref_mode, do_tokenize):
+    """Generator used by `iter_tokens` (without chunking)."""
+
+    def parse_line(line):
+        # split to tokens + ingore consecutive spaces (no empty tokens)
+        # empty line results in empty list
+        line = line.strip()
+        if do_tokenize:
+            line = tokenize(line)
+        # TODO apply Morphodita here ?
+        return [(form, None) for form in line.split(' ') if form]
+
+    # in reference mode, find out if there are any empty lines first
     empty_lines = False
-    # read all lines from the file
-    with file_stream(tok_file) as fh:
-        for line in fh:
-            # split to tokens + ingore consecutive spaces (no empty tokens)
-            # empty line results in empty list
-            line = line.strip()
-            if do_tokenize:
-                line = tokenize(line)
-            line = filter(bool, line.split(' '))
-            if not line:
-                empty_lines = True
-            # TODO apply Morphodita here ?
-            tokens.append([(form, None) for form in line])
+    sents = None
+    if ref_mode:
+        if isinstance(tok_file, basestring):
+            with file_stream(tok_file) as fh:
+                empty_lines = any(not line.strip() for line in fh)
+        else:  # streams can't be re-read, so they are read whole
+            with file_stream(tok_file) as fh:
+                lines = fh.readlines()
+            empty_lines = any(not line.strip() for line in lines)
+            sents = (parse_line(line) for line in lines)
+    if sents is None:
+        sents = _iter_lines(tok_file, parse_line)
+
+    if not empty_lines:
+        for toks in sents:
+            yield toks
+        return
 
     # empty lines separate references from each other: regroup references by empty lines
-    if ref_mode and empty_lines:
-        refs = []
-        cur_ref = []
-        for toks in tokens:
-            if not toks:  # empty line separates references
-                refs.append(cur_ref)
-                cur_ref = []
-            else:
-                cur_ref.append(toks)
-        if cur_ref:
-            refs.append(cur_ref)
-        tokens = refs
-    return tokens
+    cur_ref = []
+    for toks in sents:
+        if not toks:  # empty line separates references
+            yield cur_ref
+            cur_ref = []
+        else:
+            cur_ref.append(toks)
+    if cur_ref:
+        yield cur_ref
 
 
 def write_tokens(doc, tok_file):
-    """Write all sentences from a document into a text file."""
+    """Write all sentences from a document into a text file. The sentences may be given lazily
+    (as any iterable, e.g. a generator), they are written out one by one as they come.
+    @param doc: iterable of sentences (lists of form-tag pairs)
+    @param tok_file: output file path (or an open stream)
+    @return: number of sentences written
+    """
+    num_sents = 0
     with file_stream(tok_file, 'w') as fh:
         for sent in doc:
             toks = [tok for (tok, _) in sent]
             # TODO some nice detokenization etc.
             print >> fh, ' '.join(toks)
+            num_sents += 1
+    return num_sents
 
 
 def chunk_list(l, n):
@@ -228,6 +699,16 @@ def chunk_list(l, n):
         yield l[i:i + n]
 
 
+def chunk_iter(iterable, n):
+    """Yield successive n-sized chunks (as lists) from any iterable, reading it lazily
+    (the last chunk may be shorter)."""
+    it = iter(iterable)
+    chunk = list(islice(it, n))
+    while chunk:
+        yield chunk
+        chunk = list(islice(it, n))
+
+
 def ttrees_from_doc(ttree_doc, language, selector):
     """Given a Treex document full of t-trees, return just the array of t-trees."""
     selectors = selector.split(',')
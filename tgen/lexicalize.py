@@ -16,26 +16,43 @@ import datetime
 import shutil
 import codecs
 import operator
+import os
+import hashlib
+from collections import deque
 from subprocess import Popen, PIPE
 import tensorflow as tf
+from tensorflow.python.util import nest
 import sys
 import math
 import kenlm
 
 from tgen.tree import NodeData, TreeData
 from tgen.rnd import rnd
-from tgen.futil import file_stream, read_absts, smart_load_absts
+from tgen.futil import file_stream, read_absts, smart_iter_absts
 from tgen.logf import log_warn, log_info, log_debug
 from tgen.tf_ml import TFModel
 from tgen.ml import softmax
 import tgen.externals.seq2seq as tf06s2s
 
 
+class ScoringSession(object):
+    """Incremental form selection state for one sentence (kept by form selectors across
+    all placeholders in the sentence)."""
+
+    __slots__ = ['sentence', 'pos', 'state', 'logprobs']
+
+    def __init__(self, sentence, pos=0, state=None, logprobs=None):
+        self.sentence = sentence
+        self.pos = pos
+        self.state = state
+        self.logprobs = logprobs
+
+
 class FormSelect(object):
     """Interface for all surface form selector classes."""
 
     def __init__(self, cfg=None):
-        pass
+        self._sessions = {}
 
     def get_surface_form(self, sentence, pos, possible_forms):
         """Return a suitable surface form for the given position in the given sentence,
@@ -48,6 +65,43 @@ class FormSelect(object):
         """
         raise NotImplementedError()
 
+    def get_surface_forms(self, queries):
+        """Batch version of `get_surface_form`, selecting forms for positions in several
+        different sentences at once.
+
+        @param queries: list of triples (sentence, position, possible forms), one per sentence
+        @return: list of selected surface forms
+        """
+        return [self.get_surface_form(sentence, pos, possible_forms)
+                for sentence, pos, possible_forms in queries]
+
+    def init_sentences(self, sentences):
+        """Start selecting forms for new sentences. Form selectors may keep incremental
+        state across all placeholders of the same sentence (which is expected to be filled
+        in from left to right). States for any previous sentences are discarded.
+
+        @param sentences: input sentences (lists of tokens)
+        """
+        self._sessions = {}
+        for sentence in sentences:
+            self._sessions[id(sentence)] = self._init_session(sentence)
+
+    def _init_session(self, sentence):
+        """Create the incremental scoring state for a new sentence (to be overridden by
+        form selectors that keep any)."""
+        return ScoringSession(sentence)
+
+    def _get_session(self, sentence, pos):
+        """Get the incremental scoring state for the given sentence. A new one is started if
+        the sentence has not been initialized or if the position goes back."""
+        session = self._sessions.get(id(sentence))
+        if session is None or session.sentence is not sentence or pos < session.pos:
+            if session is None:  # not using `init_sentences`, discard all previous states
+                self._sessions = {}
+            session = self._init_session(sentence)
+            self._sessions[id(sentence)] = session
+        return session
+
 
 class RandomFormSelect(FormSelect):
     """A dummy form surface selector, selecting a form at random from the offered choice."""
@@ -111,20 +165,61 @@ class KenLMFormSelect(FormSelect):
     def __init__(self, cfg):
         super(KenLMFormSelect, self).__init__(cfg)
         self._sample = cfg.get('form_sample', False)
+        self._lookahead = cfg.get('form_lookahead', True)
         self._trained_model = None
+        self._norm_forms = {}
         np.random.seed(rnd.randint(0, 2**32 - 1))
 
-    def get_surface_form(self, sentence, pos, possible_forms):
-        state, dummy_state = kenlm.State(), kenlm.State()
+    def _init_session(self, sentence):
+        state = kenlm.State()
         self._lm.BeginSentenceWrite(state)
-        for idx in xrange(pos):
-            self._lm.BaseScore(state, sentence[idx].encode('utf-8'), state)
+        return ScoringSession(sentence, state=state)
+
+    def _normalize(self, form):
+        """Convert the given token/surface form to the LM vocabulary format (lowercased,
+        multi-word forms joined with "^"). Results are cached."""
+        norm = self._norm_forms.get(form)
+        if norm is None:
+            norm = form.lower().replace(' ', '^').encode('utf-8')
+            self._norm_forms[form] = norm
+        return norm
+
+    def _advance_state(self, sentence, pos):
+        """Get the LM state for the given position in the sentence, advancing the state kept
+        for this sentence."""
+        session = self._get_session(sentence, pos)
+        state = session.state
+        for idx in xrange(session.pos, pos):
+            self._lm.BaseScore(state, self._normalize(sentence[idx]), state)
+        session.pos = pos
+        return state
+
+    def _right_context(self, sentence, pos):
+        """Get the (normalized) right context of the given position to be scored along with
+        the candidate forms (up to LM order - 1 tokens, stopping at further placeholders)."""
+        if not self._lookahead:
+            return []
+        context = []
+        for tok in sentence[pos + 1:pos + self._lm.order]:
+            if tok and tok.startswith('X-'):
+                return context
+            context.append(self._normalize(tok))
+        if pos + self._lm.order > len(sentence):
+            context.append(b'</s>')
+        return context
+
+    def get_surface_form(self, sentence, pos, possible_forms):
+        state = self._advance_state(sentence, pos)
+        right_context = self._right_context(sentence, pos)
+        out_state, next_state = kenlm.State(), kenlm.State()
         best_form_idx = 0
         best_score = float('-inf')
         scores = []
         for form_idx, possible_form in enumerate(possible_forms):
-            possible_form = possible_form.lower().replace(' ', '^').encode('utf-8')
-            score = self._lm.BaseScore(state, possible_form, dummy_state)
+            score = self._lm.BaseScore(state, self._normalize(possible_form), out_state)
+            for tok in right_context:
+                score += self._lm.BaseScore(out_state, tok, next_state)
+                out_state, next_state = next_state, out_state
             scores.append(score)
             if score > best_score:
                 best_score = score
@@ -198,7 +293,10 @@ class RNNLMFormSelect(FormSelect, TFModel):
         self.max_cores = cfg.get('max_cores', 4)
         self.alpha_decay = cfg.get('alpha_decay', 0.0)
         self.validation_freq = cfg.get('validation_freq', 1)
+        self.valid_batch_size = cfg.get('valid_batch_size', 1000)
         self.min_passes = cfg.get('min_passes', self.passes / 2)
+        # checkpoints larger than this (in MB) are stored on disk instead of in memory
+        self.checkpoint_mem_limit = cfg.get('checkpoint_mem_limit', 256)
         self.vocab = {'<VOID>': self.VOID, '<GO>': self.GO,
                       '<STOP>': self.STOP, '<UNK>': self.UNK}
         self.reverse_dict = {self.VOID: '<VOID>', self.GO: '<GO>',
@@ -206,6 +304,7 @@ class RNNLMFormSelect(FormSelect, TFModel):
         self.vocab_size = None
         self._checkpoint_params = None
         self._checkpoint_settings = None
+        self._checkpoint_path = None
         np.random.seed(rnd.randint(0, 2**32 - 1))
         tf.set_random_seed(rnd.randint(-sys.maxint, sys.maxint))
 
@@ -260,8 +359,8 @@ class RNNLMFormSelect(FormSelect, TFModel):
             yield inputs, targets
 
     def _valid_batches(self):
-        for batch_start in xrange(0, len(self._valid_data), self.batch_size):
-            batch_end = min(batch_start + self.batch_size, len(self._valid_data))
+        for batch_start in xrange(0, len(self._valid_data), self.valid_batch_size):
+            batch_end = min(batch_start + self.valid_batch_size, len(self._valid_data))
             sents = [self._valid_data[idx] for idx in xrange(batch_start, batch_end)]
             inputs = np.array([sent[:-1] for sent in sents], dtype=np.int32)
             targets = np.array([sent[1:] for sent in sents], dtype=np.int32)
@@ -298,6 +397,36 @@ class RNNLMFormSelect(FormSelect, TFModel):
                                       tf.get_variable("W", [self.emb_size, self.vocab_size])) +
                             tf.get_variable("b", [self.vocab_size]))
 
+            # stateful scoring: the same RNN, running from a given state for a given number of steps
+            with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+                self._step_inputs = tf.placeholder(tf.int32, [None, self.max_sent_len],
+                                                   name='step_inputs')
+                self._step_lens = tf.placeholder(tf.int32, [None], name='step_lens')
+                self._step_init_state = nest.pack_sequence_as(
+                        self._cell.state_size,
+                        [tf.placeholder(tf.float32, [None, size], name='step_init_state')
+                         for size in nest.flatten(self._cell.state_size)])
+                step_inputs = [tf.squeeze(input_, [1])
+                               for input_ in tf.split(axis=1, num_or_size_splits=self.max_sent_len,
+                                                      value=self._step_inputs)]
+                step_outputs, step_state = tf.contrib.rnn.static_rnn(
+                        emb_cell, step_inputs, initial_state=self._step_init_state,
+                        sequence_length=self._step_lens)
+                self._step_state = nest.flatten(step_state)
+                # log-probabilities for all steps, and for the last step of each sequence
+                step_outputs = tf.stack(step_outputs, axis=1)  # batch x time x emb_size
+                step_W = tf.get_variable("W", [self.emb_size, self.vocab_size])
+                step_b = tf.get_variable("b", [self.vocab_size])
+                self._step_logprobs = tf.reshape(
+                        tf.nn.log_softmax(tf.matmul(tf.reshape(step_outputs, [-1, self.emb_size]),
+                                                    step_W) + step_b),
+                        [-1, self.max_sent_len, self.vocab_size])
+                last_outputs = tf.gather_nd(step_outputs,
+                                            tf.stack([tf.range(tf.shape(self._step_lens)[0]),
+                                                      self._step_lens - 1], axis=1))
+                self._step_last_logprobs = tf.nn.log_softmax(tf.matmul(last_outputs, step_W) +
+                                                             step_b)
+
             # cost
             targets_1d = tf.reshape(self._targets, [-1])
             self._loss = tf06s2s.sequence_loss_by_example(
@@ -305,6 +434,11 @@ class RNNLMFormSelect(FormSelect, TFModel):
                     [tf.ones_like(targets_1d, dtype=tf.float32)], self.vocab_size)
             self._cost = tf.reduce_mean(self._loss)
 
+            # total log-likelihood and number of tokens (ignoring padding), for validation
+            valid_mask = tf.to_float(tf.not_equal(targets_1d, self.VOID))
+            self._logprob_sum = -tf.reduce_sum(self._loss * valid_mask)
+            self._num_tokens = tf.reduce_sum(valid_mask)
+
             # optimizer
             self._learning_rate = tf.placeholder(tf.float32, name="learning_rate")
             if self.optimizer_type == 'sgd':
@@ -369,15 +503,18 @@ class RNNLMFormSelect(FormSelect, TFModel):
         """
         pass_start_time = time.time()
         pass_cost = 0
+        pass_toks = 0
         for inputs, targets in self._train_batches():
             cost, _ = self.session.run([self._cost, self._train_func],
                                        {self._inputs: inputs,
                                         self._targets: targets,
                                         self._learning_rate: pass_alpha, })
             pass_cost += cost
-        duration = str(datetime.timedelta(seconds=(time.time() - pass_start_time)))
-        log_info("Pass %d: alpha %.3f, duration %s, cost %.3f" % (pass_no, pass_alpha,
-                                                                  duration, pass_cost))
+            pass_toks += np.sum(targets != self.VOID)
+        pass_secs = time.time() - pass_start_time
+        duration = str(datetime.timedelta(seconds=pass_secs))
+        log_info("Pass %d: alpha %.3f, duration %s, cost %.3f, %.1f words/sec" %
+                 (pass_no, pass_alpha, duration, pass_cost, pass_toks / max(pass_secs, 1e-6)))
         return pass_cost
 
     def load_model(self, model_fname_pattern):
@@ -396,48 +533,154 @@ class RNNLMFormSelect(FormSelect, TFModel):
             pickle.dump(self.get_model_params(), fh, pickle.HIGHEST_PROTOCOL)
 
     def _valid_perplexity(self):
-        """Compute perplexity of the RNNLM on validation data."""
-        perp = 0
+        """Compute perplexity of the RNNLM on validation data (padding is ignored)."""
+        start_time = time.time()
+        logprob = 0.0
         n_toks = 0
         for inputs, targets in self._valid_batches():
-            logits = self.session.run([self._logits], {self._inputs: inputs})[0]
-            probs = softmax(logits)  # logits combine all sentences behind each other -- dimension
-                                     # is (self.max_sent_len * self.batch_size, self.vocab_size)
-            for tok_no in xrange(len(probs)):
-                perp += np.log2(probs[tok_no, targets[tok_no / self.max_sent_len,
-                                                      tok_no % self.max_sent_len]])
-            n_toks += np.prod(inputs.shape)
+            batch_logprob, batch_toks = self.session.run([self._logprob_sum, self._num_tokens],
+                                                         {self._inputs: inputs,
+                                                          self._targets: targets})
+            logprob += batch_logprob
+            n_toks += batch_toks
+        log_info("Validation: %.1f words/sec" % (n_toks / max(time.time() - start_time, 1e-6)))
         # perp = exp( -1/N * sum_i=1^N log p(x_i) )
-        return np.exp2(- perp / float(n_toks))
+        return np.exp(- logprob / max(n_toks, 1.0))
 
     def _save_checkpoint(self):
-        """Store current model parameters in memory."""
+        """Store current model parameters in memory, or in a temporary file on disk if they are
+        larger than `checkpoint_mem_limit`."""
         self._checkpoint_settings = self.get_all_settings()
         self._checkpoint_params = self.get_model_params()
+        params_size = sum(val.nbytes for val in self._checkpoint_params.values())
+        if params_size > self.checkpoint_mem_limit * 1024 ** 2:
+            if not self._checkpoint_path:
+                fd, self._checkpoint_path = tempfile.mkstemp(suffix='.params', prefix='formselect-')
+                os.close(fd)
+            log_info('Saving checkpoint to %s' % self._checkpoint_path)
+            with file_stream(self._checkpoint_path, 'wb', encoding=None) as fh:
+                pickle.dump(self._checkpoint_params, fh, pickle.HIGHEST_PROTOCOL)
+            self._checkpoint_params = None
 
     def _restore_checkpoint(self):
-        """Retrieve previously stored model parameters from memory (or do nothing if there are
-        no stored parameters."""
+        """Retrieve previously stored model parameters from memory or disk (or do nothing if
+        there are no stored parameters). Removes the checkpoint file if there is one."""
+        if self._checkpoint_path:
+            with file_stream(self._checkpoint_path, 'rb', encoding=None) as fh:
+                self._checkpoint_params = pickle.load(fh)
+            os.remove(self._checkpoint_path)
+            self._checkpoint_path = None
         if not self._checkpoint_params:
             return
         self.load_all_settings(self._checkpoint_settings)
         self.set_model_params(self._checkpoint_params)
 
+    def _init_session(self, sentence):
+        # no input consumed yet (position -1 -- the <GO> token comes first)
+        state = [np.zeros(size, dtype=np.float32) for size in nest.flatten(self._cell.state_size)]
+        return ScoringSession(sentence, pos=-1, state=state)
+
+    def _run_steps(self, states, inputs, fetch_all=False):
+        """Run the RNN LM from the given states over the given token ID sequences (one
+        session call per `max_sent_len` steps).
+
+        @param states: list of RNN states (lists of numpy arrays, as flattened by `nest`)
+        @param inputs: list of token ID sequences (lists of integers, non-empty) to be fed
+        @param fetch_all: return log-probabilities for all steps? (only the first \
+            `max_sent_len` steps of each sequence are used in that case)
+        @return: tuple: new states, log-probabilities of the next token (after the last \
+            step), log-probabilities for all steps (None if not requested)
+        """
+        states = list(states)
+        last_logprobs = [None] * len(inputs)
+        all_logprobs = None
+        offset = 0
+        while True:
+            rows = [i for i, ids in enumerate(inputs) if len(ids) > offset]
+            if not rows:
+                break
+            step_inputs = np.zeros((len(rows), self.max_sent_len), dtype=np.int32)
+            step_lens = np.zeros(len(rows), dtype=np.int32)
+            for row_no, i in enumerate(rows):
+                ids = inputs[i][offset:offset + self.max_sent_len]
+                step_inputs[row_no, :len(ids)] = ids
+                step_lens[row_no] = len(ids)
+            fd = {self._step_inputs: step_inputs, self._step_lens: step_lens}
+            for comp_no, placeholder in enumerate(nest.flatten(self._step_init_state)):
+                fd[placeholder] = np.array([states[i][comp_no] for i in rows])
+            fetches = [self._step_state, self._step_last_logprobs]
+            if fetch_all:
+                fetches.append(self._step_logprobs)
+            results = self.session.run(fetches, feed_dict=fd)
+            for row_no, i in enumerate(rows):
+                states[i] = [comp[row_no] for comp in results[0]]
+                last_logprobs[i] = results[1][row_no]
+            if fetch_all:
+                all_logprobs = results[2]
+                break
+            offset += self.max_sent_len
+        return states, last_logprobs, all_logprobs
+
+    def _form_to_ids(self, form):
+        """Convert a surface form into token IDs (as a single token if known, otherwise as
+        multiple tokens split on spaces)."""
+        form = form.lower()
+        if form in self.vocab or ' ' not in form:
+            return [self.vocab.get(form, self.UNK)]
+        return [self.vocab.get(tok, self.UNK) for tok in form.split(' ')][:self.max_sent_len]
+
     def get_surface_form(self, sentence, pos, possible_forms):
-        log_debug("Pos: %d, forms: %s" % (pos, unicode(", ".join(possible_forms))))
-        # get unnormalized scores for the whole vocabulary
-        if pos >= self.max_sent_len:  # don't use whole sentence if it's too long
-            pos -= pos - self.max_sent_len + 1
-            sentence = sentence[pos - self.max_sent_len + 1:]
-        inputs = np.array([self._sent_to_ids(sentence)[:-1]], dtype=np.int32)
-        logits = self.session.run([self._logits], {self._inputs: inputs})
-        # pick out scores for possible forms
-        scores = [logits[0][pos][self.vocab.get(form.lower(), self.vocab.get('<UNK>'))]
-                  for form in possible_forms]
+        return self.get_surface_forms([(sentence, pos, possible_forms)])[0]
+
+    def get_surface_forms(self, queries):
+        # advance all sentences' states up to the given positions (in one batch)
+        sessions, inputs = [], []
+        for sentence, pos, _ in queries:
+            session = self._get_session(sentence, pos)
+            if session.pos < 0:
+                ids = [self.GO]
+                session.pos = 0
+            else:
+                ids = []
+            ids.extend(self.vocab.get(tok.lower(), self.UNK)
+                       for tok in sentence[session.pos:pos])
+            session.pos = pos
+            sessions.append(session)
+            inputs.append(ids)
+        to_advance = [i for i, ids in enumerate(inputs) if ids]
+        if to_advance:
+            states, logprobs, _ = self._run_steps([sessions[i].state for i in to_advance],
+                                                  [inputs[i] for i in to_advance])
+            for i, state, lps in zip(to_advance, states, logprobs):
+                sessions[i].state = state
+                sessions[i].logprobs = lps
+
+        # score all possible forms: 1st token by the current prediction
+        form_ids = [[self._form_to_ids(form) for form in possible_forms]
+                    for _, _, possible_forms in queries]
+        scores = [[session.logprobs[ids[0]] for ids in cur_form_ids]
+                  for session, cur_form_ids in zip(sessions, form_ids)]
+        # multi-token forms: further tokens scored by running from the current state (one batch)
+        multi = [(query_no, form_no)
+                 for query_no, cur_form_ids in enumerate(form_ids)
+                 for form_no, ids in enumerate(cur_form_ids) if len(ids) > 1]
+        if multi:
+            _, _, all_logprobs = self._run_steps(
+                    [sessions[query_no].state for query_no, _ in multi],
+                    [form_ids[query_no][form_no][:-1] for query_no, form_no in multi],
+                    fetch_all=True)
+            for row_no, (query_no, form_no) in enumerate(multi):
+                ids = form_ids[query_no][form_no]
+                scores[query_no][form_no] += sum(all_logprobs[row_no, step, tok_id]
+                                                 for step, tok_id in enumerate(ids[1:]))
+
+        return [self._select_form(pos, possible_forms, cur_scores)
+                for (_, pos, possible_forms), cur_scores in zip(queries, scores)]
+
+    def _select_form(self, pos, possible_forms, scores):
+        """Select one of the possible forms, given their scores (log-probabilities)."""
         probs = softmax(scores)
-        log_debug("Vocab: %s" % unicode(", ".join([unicode(self.vocab.get(form.lower(),
-                                                                          self.vocab.get('<UNK>')))
-                                                   for f in possible_forms])))
+        log_debug("Pos: %d, forms: %s" % (pos, unicode(", ".join(possible_forms))))
         log_debug("Scores: %s, Probs: %s" % (unicode(", ".join(["%.3f" % s for s in scores])),
                                              unicode(", ".join(["%.3f" % p for p in probs]))))
         # sample from the prob. dist.
@@ -464,7 +707,15 @@ class Lexicalizer(object):
         self._sf_all = {}
         self._sf_by_formeme = {}
         self._sf_by_tag = {}
+        self._sf_tags = {}
         self._lemma_for_sf = {}
+        self.use_form_index = cfg.get('use_form_index', True)
+        self._form_index = None
+        self._sf_digest = None
+        self._sf_fname = None
+        self._formeme_norm = {}
+        self._value_coord = {}
+        self._value_nums = {}
         self._form_select = RandomFormSelect()
         if 'form_select_type' in cfg:
             if cfg['form_select_type'] == 'frequency':
@@ -511,6 +762,25 @@ class Lexicalizer(object):
         except StopIteration:
             return None
 
+    def _index_absts(self, absts):
+        """Index abstraction instructions for one sentence by slot (for `_next_abst`).
+        @return: dict slot -> deque of abstraction instructions, in the original order"""
+        abst_idx = {}
+        for abst in absts:
+            abst_idx.setdefault(abst.slot, deque()).append(abst)
+        return abst_idx
+
+    def _next_abst(self, abst_idx, slot):
+        """Get the next abstraction instruction for a specific slot from the index, put it back
+        to the end of the slot's queue (same order as `_first_abst`). If there is no matching
+        abstraction instruction, return None."""
+        absts = abst_idx.get(slot)
+        if not absts:
+            return None
+        abst = absts[0]
+        absts.rotate(-1)
+        return abst
+
     def _prepare_train_toks(self, train_trees, train_abstr_fname,
                             valid_trees=None, valid_abstr_fname=None):
         """Prepare training data for form selection LM. Use training trees/tagged lemmas/tokens,
@@ -591,6 +861,7 @@ class Lexicalizer(object):
             sf_all = {}
             sf_formeme = {}
             sf_tag = {}
+            tags = set()
             lemma_for_sf = {}
             if slot == 'street':  # this is domain-specific: street names -> street name + number
                 slot = 'address'  # TODO change this in the surface form file
@@ -600,24 +871,27 @@ class Lexicalizer(object):
                     value += ' _'  # TODO change this in the surface form file
                 for surface_form in values[orig_value]:
                     lemma, form, tag = surface_form.split("\t")
+                    tags.add(tag)
                     if slot == 'address':  # add street number placeholders to addresses
                         lemma += ' _'  # TODO change this in the surface form file
                         form += ' _'
                     # store the value globally + for all possible tag subsets/formemes
                     # store lemmas for formemes, forms for tags/global
-                    sf_all[value] = sf_all.get(value, []) + [form]
-                    sf_tag[value] = sf_tag.get(value, {})
-                    sf_formeme[value] = sf_formeme.get(value, {})
+                    sf_all.setdefault(value, []).append(form)
+                    value_sf_tag = sf_tag.setdefault(value, {})
+                    value_sf_formeme = sf_formeme.setdefault(value, {})
                     for tag_subset in self._get_tag_subsets(tag):
-                        sf_tag[value][tag_subset] = sf_tag[value].get(tag_subset, []) + [form]
+                        value_sf_tag.setdefault(tag_subset, []).append(form)
                     for formeme in self._get_compatible_formemes(tag):
-                        sf_formeme[value][formeme] = sf_formeme[value].get(formeme, []) + [lemma]
+                        value_sf_formeme.setdefault(formeme, []).append(lemma)
                     # store lemma for form (for lexicalizing training sentences with trees)
                     lemma_for_sf[form] = lemma
             self._sf_all[slot] = sf_all
             self._sf_by_formeme[slot] = sf_formeme
             self._sf_by_tag[slot] = sf_tag
+            self._sf_tags[slot] = tags
             self._lemma_for_sf[slot] = lemma_for_sf
+        self._build_form_index()
 
     def _get_tag_subsets(self, tag):
         """Select important tag subsets along which surface forms should be matched.
@@ -652,68 +926,304 @@ class Lexicalizer(object):
             return ['v:fin']
         return ['x']
 
-    def lexicalize(self, gen_trees, abst_file):
+    def _build_form_index(self):
+        """Precompile the surface form tables into a flat index of tuples keyed by (slot, value,
+        tag, formeme), with the tag/formeme fallback chain already resolved for all tags and
+        formemes seen with the given slot in the surface forms file. Entries keyed by (slot,
+        value, tag subset) are stored as well, so that other tags can be resolved using the
+        index only (see `_resolve_indexed_forms`). All strings in the index are interned."""
+        if not self.use_form_index:
+            return
+        strings = {}
+        intern = lambda string: strings.setdefault(string, string)
+        index = {}
+        for slot, sf_all in self._sf_all.iteritems():
+            slot = intern(slot)
+            sf_formeme = self._sf_by_formeme.get(slot, {})
+            sf_tag = self._sf_by_tag.get(slot, {})
+            slot_formemes = set([intern(formeme) for value_sf_formeme in sf_formeme.itervalues()
+                                 for formeme in value_sf_formeme])
+            slot_tags = [intern(tag) for tag in self._sf_tags.get(slot, [])]
+            for value, forms in sf_all.iteritems():
+                value = intern(value)
+                all_forms = tuple([intern(form) for form in forms])
+                index[(slot, value, None, None)] = all_forms
+                value_sf_formeme = sf_formeme.get(value, {})
+                for formeme in slot_formemes:
+                    if formeme in value_sf_formeme:
+                        index[(slot, value, None, formeme)] = tuple([intern(lemma) for lemma
+                                                                     in value_sf_formeme[formeme]])
+                    else:
+                        index[(slot, value, None, formeme)] = all_forms
+                for tag_sub, tag_forms in sf_tag.get(value, {}).iteritems():
+                    index[(slot, value, intern(tag_sub))] = tuple([intern(form)
+                                                                   for form in tag_forms])
+                for tag in slot_tags:
+                    index[(slot, value, tag, None)] = self._resolve_indexed_forms(
+                        index, slot, value, tag, None)
+        self._form_index = index
+
+    def _resolve_indexed_forms(self, index, slot, value, tag, formeme):
+        """Go through the fallback chain (by tag subsets, by formeme, all forms) in the flat
+        surface form index (the same chain as in `_lookup_possible_forms`).
+        @return: a tuple of possible surface forms (None if there are no forms for the value)
+        """
+        if tag is not None:
+            for tag_sub in self._get_tag_subsets(tag):
+                if (slot, value, tag_sub) in index:
+                    return index[(slot, value, tag_sub)]
+        if formeme is not None and (slot, value, None, formeme) in index:
+            return index[(slot, value, None, formeme)]
+        return index.get((slot, value, None, None))
+
+    def _normalize_formeme(self, formeme):
+        """Normalize formeme for surface form lookup (ignore prepositions/conjunctions and
+        finite/infinite verb distinction); memoized."""
+        try:
+            return self._formeme_norm[formeme]
+        except KeyError:
+            norm = re.sub(r':.*\+', ':', formeme)  # ignore prepositions/conjunctions
+            norm = re.sub(r':inf', r':fin', norm)  # ignore finite/infinite verb distinction
+            self._formeme_norm[formeme] = norm
+            return norm
+
+    def lexicalize(self, gen_trees, abst_file, batch_size=None):
         """Lexicalize nodes in the generated trees (which may represent trees, tokens, or tagged lemmas).
         Expects lexicalization file (and surface forms file) to be loaded in the Lexicalizer object,
         otherwise nothing will happen. The actual operation depends on the generator mode.
 
         @param gen_trees: list of TreeData objects representing generated trees/tokens/tagged lemmas
         @param abst_file: abstraction/delexicalization instructions file path
+        @param batch_size: number of sentences for which surface forms are selected at once \
+            (defaults to the `lexicalize_batch_size` configuration setting, or 1)
+        @return: None
+        """
+        for _ in self.lexicalize_stream(gen_trees, abst_file, batch_size, len(gen_trees)):
+            pass
+
+    def lexicalize_stream(self, gen_trees, abst_file, batch_size=None, num_expected=None):
+        """Lexicalize generated trees lazily, as they come. Lexicalization instructions are read
+        from the file along with the trees, so memory use does not grow with the data size if
+        the trees are produced and consumed lazily as well.
+
+        @param gen_trees: iterable of TreeData objects (generated trees/tokens/tagged lemmas)
+        @param abst_file: abstraction/delexicalization instructions file path
+        @param batch_size: number of sentences for which surface forms are selected at once \
+            (defaults to the `lexicalize_batch_size` configuration setting, or 1)
+        @param num_expected: expected number of trees, if known (used to detect multi-reference \
+            abstraction files, see `smart_iter_absts`)
+        @return: generator of the same TreeData objects, lexicalized in-place (trees beyond \
+            the end of the abstraction instructions file are left untouched)
+        """
+        if batch_size is None:
+            batch_size = self.cfg.get('lexicalize_batch_size', 1)
+        abstss = smart_iter_absts(abst_file, num_expected)
+        batch_trees, batch_absts = [], []
+        sent_no = 0
+        for tree in gen_trees:
+            absts = next(abstss, None)
+            if absts is not None:
+                batch_trees.append(tree)
+                batch_absts.append(absts)
+                if len(batch_trees) < batch_size:
+                    continue
+            if batch_trees:
+                self._lexicalize_batch(batch_trees, batch_absts, sent_no)
+                sent_no += len(batch_trees)
+                for lex_tree in batch_trees:
+                    yield lex_tree
+                batch_trees, batch_absts = [], []
+            if absts is None:
+                yield tree
+        if batch_trees:
+            self._lexicalize_batch(batch_trees, batch_absts, sent_no)
+            for lex_tree in batch_trees:
+                yield lex_tree
+
+    def lexicalize_trees(self, gen_trees, abstss):
+        """Lexicalize the given generated trees in-place (as a single batch), using the given
+        lexicalization instructions instead of reading them from a file.
+
+        @param gen_trees: list of TreeData objects (generated trees/tokens/tagged lemmas)
+        @param abstss: list of lists of Abst objects, one for each tree
         @return: None
         """
-        abstss = smart_load_absts(abst_file, len(gen_trees))
-        for sent_no, (tree, absts) in enumerate(zip(gen_trees, abstss)):
-            log_debug("Lexicalizing sentence %d: %s" % ((sent_no + 1), unicode(tree)))
+        if gen_trees:
+            self._lexicalize_batch(gen_trees, [list(absts) for absts in abstss])
+
+    def _lexicalize_batch(self, trees, abstss, first_sent_no=0):
+        """Lexicalize a batch of generated trees, selecting surface forms for the k-th
+        placeholder of all sentences at once.
+
+        @param trees: list of TreeData objects representing generated trees/tokens/tagged lemmas
+        @param abstss: list of lists of abstraction instructions corresponding to the trees
+        @param first_sent_no: number of the first sentence in the batch (for logging)
+        """
+        abst_idxs = [self._index_absts(absts) for absts in abstss]
+        sents = []
+        for sent_no, tree in enumerate(trees, start=first_sent_no + 1):
+            log_debug("Lexicalizing sentence %d: %s" % (sent_no, unicode(tree)))
             sent = self._tree_to_sentence(tree)
             log_debug(unicode(sent))
-            for idx, tok in enumerate(sent):
-                if tok and tok.startswith('X-'):  # we would like to lexicalize
+            sents.append(sent)
+        self._form_select.init_sentences(sents)
+
+        next_idxs = [0] * len(sents)
+        while True:
+            queries = []
+            pending = []
+            for sent_no, (tree, sent, abst_idx) in enumerate(zip(trees, sents, abst_idxs)):
+                for idx in xrange(next_idxs[sent_no], len(sent)):
+                    tok = sent[idx]
+                    if not tok or not tok.startswith('X-'):  # we would like to lexicalize
+                        continue
                     slot = tok[2:]
                     # check if we have a value to substitute; if yes, do it
-                    abst = self._first_abst(absts, slot)
-                    if abst:
-                        # tagged lemmas: one token with appropriate value
-                        if self.mode == 'tagged_lemmas':
-                            tag = sent[idx+1] if idx < len(sent) - 1 else None
-                            val = self.get_surface_form(sent, idx, slot, abst.value, tag=tag)
-                            tree.nodes[idx+1] = NodeData(t_lemma=val, formeme='x')
-                        # trees: one node with appropriate value, keep formeme
-                        elif self.mode == 'trees':
-                            formeme = sent[idx+1] if idx < len(sent) - 1 else None
-                            val = self.get_surface_form(sent, idx, slot, abst.value,
-                                                        formeme=formeme)
-                            tree.nodes[idx/2+1] = NodeData(t_lemma=val,
-                                                           formeme=tree[idx/2+1].formeme)
-                        # tokens: one token with all words from the value (postprocessed below)
-                        else:
-                            val = self.get_surface_form(sent, idx, slot, abst.value)
-                            tree.nodes[idx+1] = NodeData(t_lemma=val, formeme='x')
-                        sent[idx] = val  # save value to be used in LM next time
-            # postprocess tokens (split multi-word nodes)
-            if self.mode == 'tokens':
-                idx = 1
-                while idx < len(tree):
-                    if ' ' in tree[idx].t_lemma:
-                        value = tree[idx].t_lemma
-                        tree.remove_node(idx)
-                        for shift, tok in enumerate(value.split(' ')):
-                            tree.create_child(0, idx + shift,
-                                              NodeData(t_lemma=tok, formeme='x'))
-                        idx += shift
-                    idx += 1
+                    abst = self._next_abst(abst_idx, slot)
+                    if not abst:
+                        continue
+                    # tagged lemmas: use tag for selection; trees: use formeme
+                    tag, formeme = None, None
+                    if self.mode == 'tagged_lemmas':
+                        tag = sent[idx + 1] if idx < len(sent) - 1 else None
+                    elif self.mode == 'trees':
+                        formeme = sent[idx + 1] if idx < len(sent) - 1 else None
+                    # coordinated values need multiple selections -- do them directly
+                    if self._is_coordinated(slot, abst.value):
+                        val = self.get_surface_form(sent, idx, slot, abst.value,
+                                                    tag=tag, formeme=formeme)
+                        self._set_lexicalized_value(tree, sent, idx, val)
+                        continue
+                    value, nums = self._abstract_numbers(abst.value)
+                    possible_forms = self._get_possible_forms(slot, value, tag, formeme)
+                    # backoff to the actual value (no surface form replacement)
+                    if not possible_forms:
+                        self._set_lexicalized_value(tree, sent, idx,
+                                                    self._put_numbers_back(value, nums))
+                        continue
+                    # let the form selector decide (for all sentences at once)
+                    queries.append((sent, idx, possible_forms))
+                    pending.append((tree, sent, idx, nums))
+                    next_idxs[sent_no] = idx + 1
+                    break
+                else:
+                    next_idxs[sent_no] = len(sent)
+            if not queries:
+                break
+            for (tree, sent, idx, nums), form in zip(pending,
+                                                     self._form_select.get_surface_forms(queries)):
+                self._set_lexicalized_value(tree, sent, idx, self._put_numbers_back(form, nums))
+
+        # postprocess tokens (split multi-word nodes)
+        if self.mode == 'tokens':
+            for tree in trees:
+                self._split_multiword_nodes(tree)
+
+    def _set_lexicalized_value(self, tree, sent, idx, val):
+        """Replace the placeholder at the given position by the given value (in the tree and in
+        the corresponding sentence, where it will be used by the LM next time)."""
+        # tagged lemmas: one token with appropriate value
+        if self.mode == 'tagged_lemmas':
+            tree.nodes[idx+1] = NodeData(t_lemma=val, formeme='x')
+        # trees: one node with appropriate value, keep formeme
+        elif self.mode == 'trees':
+            tree.nodes[idx/2+1] = NodeData(t_lemma=val, formeme=tree[idx/2+1].formeme)
+        # tokens: one token with all words from the value (postprocessed later)
+        else:
+            tree.nodes[idx+1] = NodeData(t_lemma=val, formeme='x')
+        sent[idx] = val  # save value to be used in LM next time
+
+    def _split_multiword_nodes(self, tree):
+        """Split multi-word nodes into separate nodes (in tokens mode)."""
+        idx = 1
+        while idx < len(tree):
+            if ' ' in tree[idx].t_lemma:
+                value = tree[idx].t_lemma
+                tree.remove_node(idx)
+                for shift, tok in enumerate(value.split(' ')):
+                    tree.create_child(0, idx + shift,
+                                      NodeData(t_lemma=tok, formeme='x'))
+                idx += shift
+            idx += 1
+
+    def _is_coordinated(self, slot, value):
+        """Check if the given value is coordinated (and needs to be lexicalized by parts);
+        memoized for each slot and value."""
+        try:
+            return self._value_coord[(slot, value)]
+        except KeyError:
+            non_num_value, _ = self._abstract_numbers(value)
+            if self._form_index is not None:
+                has_forms = (slot, non_num_value, None, None) in self._form_index
+            else:
+                has_forms = non_num_value in self._sf_all.get(slot, [])
+            coord = len(re.split(r'\s+(and|or)\s+', value)) > 1 and not has_forms
+            self._value_coord[(slot, value)] = coord
+            return coord
+
+    def _abstract_numbers(self, value):
+        """Abstract away from numbers in the given value (memoized).
+        @return: a tuple: the value with numbers replaced by "_", list of the numbers"""
+        try:
+            return self._value_nums[value]
+        except KeyError:
+            nums = re.findall(r'(?:^|\s+)([0-9]+)(?:$|\s+)', value)
+            ret = re.sub(r'(^|\s+)([0-9]+)($|\s+)', r'\1_\3', value), nums
+            self._value_nums[value] = ret
+            return ret
+
+    def _put_numbers_back(self, form, nums):
+        """Replace "_" in the given form with the given numbers (opposite of `_abstract_numbers`)."""
+        for num in nums:
+            form = re.sub(r'_', num, form, count=1)
+        return form
+
+    def _get_possible_forms(self, slot, value, tag=None, formeme=None):
+        """Find the list of possible surface forms for the given slot and value (with numbers
+        abstracted). Use morphological tag and/or formeme restrictions to select matching ones,
+        backoff to any form. Uses the flat surface form index if it is enabled.
+        @return: list/tuple of possible surface forms (None if there are no forms for the value)
+        """
+        if formeme is not None:
+            formeme = self._normalize_formeme(formeme)
+        if self._form_index is None:
+            return self._lookup_possible_forms(slot, value, tag, formeme)
+        key = (slot, value, tag, formeme)
+        try:
+            return self._form_index[key]
+        except KeyError:
+            forms = self._resolve_indexed_forms(self._form_index, slot, value, tag, formeme)
+            self._form_index[key] = forms
+            return forms
+
+    def _lookup_possible_forms(self, slot, value, tag=None, formeme=None):
+        """Go through the fallback chain in the nested surface form tables (by tag subsets,
+        by formeme, all forms) to find the possible surface forms (see `_get_possible_forms`).
+        The formeme is expected to be normalized already."""
+        if tag is not None:
+            if slot in self._sf_by_tag and value in self._sf_by_tag[slot]:
+                for tag_sub in self._get_tag_subsets(tag):
+                    if tag_sub in self._sf_by_tag[slot][value]:
+                        return self._sf_by_tag[slot][value][tag_sub]
+
+        if formeme is not None:
+            if slot in self._sf_by_formeme and value in self._sf_by_formeme[slot]:
+                if formeme in self._sf_by_formeme[slot][value]:
+                    return self._sf_by_formeme[slot][value][formeme]
+
+        if slot in self._sf_all and value in self._sf_all[slot]:
+            return self._sf_all[slot][value]
+        return None
 
     def get_surface_form(self, tree, idx, slot, value, tag=None, formeme=None):
         """Get the appropriate surface form for the given slot and value. Use morphological tag
         and/or formeme restrictions to select a matching one. Selects among matching forms using
         the current form selection module (random, RNNLM, KenLM, frequency).
         """
-        non_num_value = re.sub(r'(^|\s+)([0-9]+)($|\s+)', r'\1_\3', value)
-
         # handle coordinated values
-        value_parts = re.split(r'\s+(and|or)\s+', value)
-        if len(value_parts) > 1 and non_num_value not in self._sf_all.get(slot, []):
+        if self._is_coordinated(slot, value):
             out_value = []
-            for value_part in value_parts:
+            for value_part in re.split(r'\s+(and|or)\s+', value):
                 if value_part == 'and':
                     out_value.append(self.AND_STRING.get(self.language, 'and'))
                 elif value_part == 'or':
@@ -724,45 +1234,24 @@ class Lexicalizer(object):
             return ' '.join(out_value)
 
         # abstract away from numbers
-        nums = re.findall(r'(?:^|\s+)([0-9]+)(?:$|\s+)', value)
-        value = non_num_value
-        form = None
+        value, nums = self._abstract_numbers(value)
 
         # find the appropriate form (by tag, formeme, backoff to any form)
-        if tag is not None:
-            if slot in self._sf_by_tag and value in self._sf_by_tag[slot]:
-                for tag_sub in self._get_tag_subsets(tag):
-                    if tag_sub in self._sf_by_tag[slot][value]:
-                        form = self._form_select.get_surface_form(
-                                tree, idx, self._sf_by_tag[slot][value][tag_sub])
-                        if form:
-                            break
-
-        if form is None and formeme is not None:
-            formeme = re.sub(r':.*\+', ':', formeme)  # ignore prepositions/conjunctions
-            formeme = re.sub(r':inf', r':fin', formeme)  # ignore finite/infinite verb distinction
-            if slot in self._sf_by_formeme and value in self._sf_by_formeme[slot]:
-                if formeme in self._sf_by_formeme[slot][value]:
-                    form = self._form_select.get_surface_form(
-                            tree, idx, self._sf_by_formeme[slot][value][formeme])
-
-        if form is None:
-            if slot in self._sf_all and value in self._sf_all[slot]:
-                form = self._form_select.get_surface_form(tree, idx, self._sf_all[slot][value])
-
+        possible_forms = self._get_possible_forms(slot, value, tag, formeme)
+        if possible_forms:
+            form = self._form_select.get_surface_form(tree, idx, possible_forms)
         # backoff to the actual value (no surface form replacement)
-        if form is None:
+        else:
             form = value
 
         # put numbers back
-        for num in nums:
-            form = re.sub(r'_', num, form, count=1)
-
-        return form
+        return self._put_numbers_back(form, nums)
 
     @staticmethod
     def load_from_file(lexicalizer_fname):
-        """Load the lexicalizer model from a file (and a second file with the LM, if needed)."""
+        """Load the lexicalizer model from a file (and a second file with the LM, if needed).
+        If the surface form index is used and the index file matches the surface form tables
+        (by their digest), the tables themselves are not loaded."""
         log_info("Loading lexicalizer from %s..." % lexicalizer_fname)
         with file_stream(lexicalizer_fname, 'rb', encoding=None) as fh:
             data = pickle.load(fh)
@@ -770,25 +1259,74 @@ class Lexicalizer(object):
             ret.__dict__.update(data)
             ret._form_select = ret._form_select(data['cfg'])
 
+            # surface form tables are stored separately (not in older models)
+            if '_sf_all' not in data:
+                if ret.use_form_index:
+                    ret._form_index = ret._load_form_index(lexicalizer_fname)
+                if ret._form_index is None:
+                    ret._sf_all, ret._sf_by_formeme, ret._sf_by_tag, ret._sf_tags = pickle.load(fh)
+                else:
+                    ret._sf_fname = lexicalizer_fname
+        if ret.use_form_index and ret._form_index is None:
+            ret._build_form_index()
+
         if not isinstance(ret._form_select, RandomFormSelect):
             ret._form_select.load_model(lexicalizer_fname)
         return ret
 
+    def _load_form_index(self, lexicalizer_fname):
+        """Load the surface form index from the file next to the lexicalizer model file.
+        @return: the index, or None if the index file does not exist or was built from \
+            different surface form tables
+        """
+        index_fname = re.sub(r'(.pickle)?(.gz)?$', '.lexidx', lexicalizer_fname)
+        if not os.path.isfile(index_fname):
+            return None
+        with file_stream(index_fname, 'rb', encoding=None) as fh:
+            data = pickle.load(fh)
+        if not isinstance(data, dict) or data.get('digest') != self._sf_digest:
+            log_warn('Surface form index %s does not match the lexicalizer model, rebuilding.'
+                     % index_fname)
+            return None
+        return data['index']
+
+    def _load_sf_tables(self):
+        """Load the surface form tables if they were skipped when loading the model (since
+        the surface form index was used)."""
+        if not self._sf_fname:
+            return
+        with file_stream(self._sf_fname, 'rb', encoding=None) as fh:
+            pickle.load(fh)  # skip the other settings
+            self._sf_all, self._sf_by_formeme, self._sf_by_tag, self._sf_tags = pickle.load(fh)
+        self._sf_fname = None
+
     def save_to_file(self, lexicalizer_fname):
-        """Save the lexicalizer model to a file (and a second file with the LM, if needed)."""
+        """Save the lexicalizer model to a file (and a second file with the LM, if needed).
+        The surface form tables are stored after all other settings; the surface form index
+        is stored in a separate file, along with the digest of the tables."""
         log_info("Saving lexicalizer to %s..." % lexicalizer_fname)
+        self._load_sf_tables()
+        sf_tables = pickle.dumps((self._sf_all, self._sf_by_formeme, self._sf_by_tag,
+                                  self._sf_tags), protocol=pickle.HIGHEST_PROTOCOL)
+        self._sf_digest = hashlib.md5(sf_tables).hexdigest()
         with file_stream(lexicalizer_fname, 'wb', encoding=None) as fh:
             pickle.dump(self.get_all_settings(), fh, protocol=pickle.HIGHEST_PROTOCOL)
+            fh.write(sf_tables)
+
+        if self._form_index is not None:
+            index_fname = re.sub(r'(.pickle)?(.gz)?$', '.lexidx', lexicalizer_fname)
+            with file_stream(index_fname, 'wb', encoding=None) as fh:
+                pickle.dump({'digest': self._sf_digest, 'index': self._form_index}, fh,
+                            protocol=pickle.HIGHEST_PROTOCOL)
 
         if not isinstance(self._form_select, RandomFormSelect):
             self._form_select.save_model(lexicalizer_fname)
 
     def get_all_settings(self):
-        """Get all settings except the trained model parameters (to be stored in a pickle)."""
+        """Get all settings except the trained model parameters and surface form tables
+        (to be stored in a pickle)."""
         data = {'cfg': self.cfg,
                 'mode': self.mode,
-                '_sf_all': self._sf_all,
-                '_sf_by_formeme': self._sf_by_formeme,
-                '_sf_by_tag': self._sf_by_tag,
+                '_sf_digest': self._sf_digest,
                 '_form_select': type(self._form_select)}
         return data
@@ -4,12 +4,13 @@
 """
 Parallel training for Perceptron ranker (using Qsub & RPyC).
 
+Workers may also run as subprocesses on the local machine (`parallel_backend: 'local'`),
+they communicate with the head over RPyC in the same way.
+
 When run as main, this file will start a worker and register with the address given
 in command-line parameters.
 
 Usage: ./parallel_percrank_train.py <head-address> <head-port>
-
-@todo: Local training on multiple cores should not be hard to implement.
 """
 
 from __future__ import unicode_literals
@@ -22,10 +23,12 @@ import time
 import datetime
 import os
 import tempfile
+import Queue
 import numpy as np
 
 from rpyc import Service, connect, async
 from rpyc.utils.server import ThreadPoolServer
+from rpyc.utils.helpers import BgServingThread
 
 from pytreex.core.util import file_stream
 
@@ -33,7 +36,7 @@ from logf import log_info, set_debug_stream, log_debug
 from tgen.logf import log_warn, is_debug_stream
 from tgen.rnd import rnd
 from tgen.rank import Ranker, PerceptronRanker
-from tgen.cluster import Job
+from tgen.cluster import get_job_class
 
 
 class ServiceConn(namedtuple('ServiceConn', ['host', 'port', 'conn'])):
@@ -81,13 +84,15 @@ def get_worker_registrar_for(head):
             # initiate connection in the other direction
             log_info('Worker %s:%d connected, initializing training.' % (host, port))
             conn = connect(host, port, config={'allow_pickle': True})
+            # serve the connection in the background, so that results arrive as soon as ready
+            BgServingThread(conn)
             # initialize the remote server (with training data etc.)
             init_func = async(conn.root.init_training)
             req = init_func(ranker_dump_path)
             # add it to the list of running services
             sc = ServiceConn(host, port, conn)
             head.services.add(sc)
-            head.pending_requests.add((sc, None, req))
+            head._add_pending_request(sc, None, req)
             log_info('Worker %s:%d initialized.' % (host, port))
 
     return WorkerRegistrarService, ranker_dump_path
@@ -109,12 +114,14 @@ class ParallelRanker(Ranker):
         self.port = cfg.get('port', self.DEFAULT_PORT)
         self.host = socket.getfqdn()
         self.poll_interval = cfg.get('poll_interval', 1)
+        self.job_class = get_job_class(cfg.get('parallel_backend', 'sge'))
         self.experiment_id = experiment_id if experiment_id is not None else ''
         # this will be needed when running
         self.server = None
         self.server_thread = None
         self.jobs = None
         self.pending_requests = None
+        self.finished_requests = None
         self.services = None
         self.free_services = None
         self.results = None
@@ -131,11 +138,11 @@ class ParallelRanker(Ranker):
         self._init_server()
         # spawn training jobs
         log_info('Spawning jobs...')
-        host_short, _ = self.host.split('.', 1)  # short host name for job names
+        host_short = self.host.split('.')[0]  # short host name for job names
         for j in xrange(self.jobs_number):
             # set up debugging logfile only if we have it on the head
             debug_logfile = ('"PRT%02d.debug-out.txt.gz"' % j) if is_debug_stream() else 'None'
-            job = Job(header='from tgen.parallel_percrank_train import run_worker',
+            job = self.job_class(header='from tgen.parallel_percrank_train import run_worker',
                       code=('run_worker("%s", %d, %s)' %
                             (self.host, self.port, debug_logfile)),
                       name=self.experiment_id + ("PRT%02d-%s-%d" % (j, host_short, self.port)),
@@ -158,12 +165,6 @@ class ParallelRanker(Ranker):
                 while cur_portion < self.data_portions or self.pending_requests:
                     log_debug('Starting loop over services.')
 
-                    # check if some of the pending computations have finished
-                    for sc, req_portion, req in list(self.pending_requests):
-                        res = self._check_pending_request(iter_no, sc, req_portion, req)
-                        if res:
-                            results[req_portion] = res
-
                     # check for free services and assign new computation
                     while cur_portion < self.data_portions and self.free_services:
                         log_debug('Assigning request %d' % cur_portion)
@@ -173,12 +174,16 @@ class ParallelRanker(Ranker):
                         train_func = async(sc.conn.root.training_pass)
                         req = train_func(w_dump, iter_no, rnd_seeds[cur_portion],
                                          * self._get_portion_bounds(cur_portion))
-                        self.pending_requests.add((sc, cur_portion, req))
+                        self._add_pending_request(sc, cur_portion, req)
                         cur_portion += 1
                         log_debug('Assigned %d' % cur_portion)
-                    # sleep for a while
-                    log_debug('Sleeping.')
-                    time.sleep(self.poll_interval)
+
+                    # wait until some of the pending computations finishes (or a worker registers)
+                    log_debug('Waiting.')
+                    sc, req_portion, req = self._wait_for_finished_request()
+                    res = self._check_pending_request(iter_no, sc, req_portion, req)
+                    if res:
+                        results[req_portion] = res
 
                 # delete the temporary ranker dump when the 1st iteration is complete
                 if self.ranker_dump_path:
@@ -205,6 +210,31 @@ class ParallelRanker(Ranker):
             for job in self.jobs:
                 job.delete()
 
+    def _add_pending_request(self, sc, req_portion, req):
+        """Add a request to the list of pending requests; once it finishes, it will be put
+        into the queue of finished requests (from the connection's background serving thread).
+
+        @param sc: a ServiceConn object that stores the worker connection parameters
+        @param req_portion: data portion number (is None for jobs loading)
+        @param req: the request itself (RPyC AsyncResult)
+        """
+        self.pending_requests.add((sc, req_portion, req))
+        req.add_callback(lambda _: self.finished_requests.put((sc, req_portion, req)))
+
+    def _wait_for_finished_request(self):
+        """Block until a pending request finishes, return it. Waits in `poll_interval` steps
+        so that the main thread stays interruptible (a request is returned as soon as it is
+        finished).
+
+        @return: a tuple (ServiceConn, data portion number, request) as given to \
+            `_add_pending_request`
+        """
+        while True:
+            try:
+                return self.finished_requests.get(timeout=self.poll_interval)
+            except Queue.Empty:
+                pass
+
     def _check_pending_request(self, iter_no, sc, req_portion, req):
         """Check whether the given request has finished (i.e., job is loaded or job has
         processed the given data portion.
@@ -270,6 +300,7 @@ class ParallelRanker(Ranker):
         self.services = set()
         self.free_services = deque()
         self.pending_requests = set()
+        self.finished_requests = Queue.Queue()
         self.jobs = []
         self.server_thread = Thread(target=self.server.start)
         self.server_thread.setDaemon(True)
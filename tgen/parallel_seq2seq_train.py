@@ -12,15 +12,17 @@ import cPickle as pickle
 import time
 import os
 from collections import deque
+from multiprocessing import cpu_count
 import shutil
 import re
 import sys
+import glob
 import hashlib
+import Queue
 
 from rpyc import Service, connect, async
 from rpyc.utils.server import ThreadPoolServer
-
-from pytreex.core.util import file_stream
+from rpyc.utils.helpers import BgServingThread
 
 from logf import log_info, set_debug_stream, log_debug
 from tgen.logf import log_warn, is_debug_stream
@@ -28,7 +30,8 @@ from tgen.rnd import rnd
 from tgen.parallel_percrank_train import ServiceConn
 from tgen.seq2seq import Seq2SeqGen
 from tgen.seq2seq_ensemble import Seq2SeqEnsemble
-from tgen.cluster import Job
+from tgen.cluster import Job, LocalJob
+from tgen.futil import file_stream, write_flat_arrays, read_flat_arrays
 
 
 def get_worker_registrar_for(head):
@@ -42,6 +45,8 @@ def get_worker_registrar_for(head):
             # initiate connection in the other direction
             log_info('Worker %s:%d connected, initializing training.' % (host, port))
             conn = connect(host, port, config={'allow_pickle': True})
+            # serve the connection in the background, so that results arrive as soon as ready
+            BgServingThread(conn)
             # initialize the remote server (with training data etc.)
             init_func = async(conn.root.init_training)
             # add unique 'scope suffix' so that the models don't clash in ensembles
@@ -50,7 +55,7 @@ def get_worker_registrar_for(head):
             # add it to the list of running services
             sc = ServiceConn(host, port, conn)
             head.services.add(sc)
-            head.pending_requests.add((sc, None, req))
+            head._add_pending_request(sc, None, req)
             log_info('Worker %s:%d initialized.' % (host, port))
 
     return WorkerRegistrarService
@@ -58,7 +63,11 @@ def get_worker_registrar_for(head):
 
 class ParallelSeq2SeqTraining(object):
     """Main (head) that handles parallel Seq2Seq generator training, submitting training jobs and
-    collecting their results"""
+    collecting their results.
+
+    Jobs are either submitted to the SGE cluster (and communicate with the head over RPyC), or
+    run as local subprocesses (`parallel_backend: 'local'`), which hand back their results
+    in files -- model parameters are stored as flat, memory-mapped binary files."""
 
     DEFAULT_PORT = 25125
     TEMPFILE_NAME = 'seq2seq_temp_dump.pickle.gz'
@@ -78,27 +87,43 @@ class ParallelSeq2SeqTraining(object):
         self.poll_interval = cfg.get('poll_interval', 1)
         self.average_models = cfg.get('average_models', False)
         self.average_models_top_k = cfg.get('average_models_top_k', 0)
+        self.backend = cfg.get('parallel_backend', 'sge')
+        if self.backend not in ['sge', 'local']:
+            raise ValueError('Unknown parallel backend: %s' % self.backend)
+        self.local_workers = cfg.get('local_workers', min(self.jobs_number, cpu_count()))
         self.experiment_id = experiment_id if experiment_id is not None else ''
         # this will be needed when running
         self.server = None
         self.server_thread = None
         self.jobs = None
         self.pending_requests = None
+        self.finished_requests = None
         self.services = None
         self.free_services = None
         self.results = None
         # this is needed for saving the model
         self.model_temp_path = None
 
-    def train(self, das_file, ttree_file, data_portion=1.0, context_file=None, validation_files=None):
-        """Run parallel perceptron training, start and manage workers."""
+    def train(self, das_file, ttree_file, data_portion=1.0, context_file=None, validation_files=None,
+              lexic_files=None):
+        """Run parallel training, start and manage workers."""
+        if self.backend == 'local':
+            self._train_local(das_file, ttree_file, data_portion, context_file,
+                              validation_files, lexic_files)
+        else:
+            self._train_sge(das_file, ttree_file, data_portion, context_file,
+                            validation_files, lexic_files)
+
+    def _train_sge(self, das_file, ttree_file, data_portion, context_file, validation_files,
+                   lexic_files):
+        """Run the training using SGE jobs which communicate with the head over RPyC."""
         # initialize the ranker instance
         log_info('Initializing...')
         # run server to process registering clients
         self._init_server()
         # spawn training jobs
         log_info('Spawning jobs...')
-        host_short, _ = self.host.split('.', 1)  # short host name for job names
+        host_short = self.host.split('.')[0]  # short host name for job names
         for j in xrange(self.jobs_number):
             # set up debugging logfile only if we have it on the head
             debug_logfile = ('"PRT%02d.debug-out.txt.gz"' % j) if is_debug_stream() else 'None'
@@ -120,20 +145,11 @@ class ParallelSeq2SeqTraining(object):
             while cur_assign < self.jobs_number or self.pending_requests:
                 log_debug('Starting loop over services.')
 
-                # check if some of the pending computations have finished
-                for sc, job_no, req in list(self.pending_requests):
-                    res = self._check_pending_request(sc, job_no, req)
-                    if res is not None:
-                        results[job_no] = res, sc
-
                 # check for free services and assign new computation
                 while cur_assign < self.jobs_number and self.free_services:
                     log_debug('Assigning request %d' % cur_assign)
                     sc = self.free_services.popleft()
                     log_info('Assigning request %d to %s:%d' % (cur_assign, sc.host, sc.port))
-                    if validation_files is not None:
-                        validation_files = ','.join([os.path.relpath(f, self.work_dir)
-                                                     for f in validation_files.split(',')])
                     train_func = async(sc.conn.root.train)
                     req = train_func(rnd_seeds[cur_assign],
                                      os.path.relpath(das_file, self.work_dir),
@@ -141,14 +157,18 @@ class ParallelSeq2SeqTraining(object):
                                      data_portion,
                                      os.path.relpath(context_file, self.work_dir)
                                      if context_file else None,
-                                     validation_files)
-                    self.pending_requests.add((sc, cur_assign, req))
+                                     self._rel_paths(validation_files),
+                                     self._rel_paths(lexic_files))
+                    self._add_pending_request(sc, cur_assign, req)
                     cur_assign += 1
                     log_debug('Assigned %d' % cur_assign)
 
-                # sleep for a while
-                log_debug('Sleeping.')
-                time.sleep(self.poll_interval)
+                # wait until some of the pending computations finishes (or a worker registers)
+                log_debug('Waiting.')
+                sc, job_no, req = self._wait_for_finished_request()
+                res = self._check_pending_request(sc, job_no, req)
+                if res is not None:
+                    results[job_no] = res, sc
 
             log_info("Results:\n" + "\n".join("%.5f %s:%d" % (cost, sc.host, sc.port)
                                               for cost, sc in results))
@@ -162,7 +182,8 @@ class ParallelSeq2SeqTraining(object):
                 results_for_ensemble = (results[:self.average_models_top_k]
                                         if self.average_models_top_k > 0
                                         else results)
-                ensemble_model = self.build_ensemble_model(results_for_ensemble)
+                ensemble_model = self.build_ensemble_model(
+                    *self._get_remote_models(results_for_ensemble))
                 log_info('Saving the ensemble model temporarily to %s...' % self.model_temp_path)
                 ensemble_model.save_to_file(self.model_temp_path)
             # select the best result on devel data + save it
@@ -178,6 +199,183 @@ class ParallelSeq2SeqTraining(object):
             for job in self.jobs:
                 job.delete()
 
+    def _rel_paths(self, files):
+        """Convert comma-separated file paths to paths relative to the working directory
+        (or return None if no paths are given)."""
+        if files is None:
+            return None
+        return ','.join([os.path.relpath(f, self.work_dir) for f in files.split(',')])
+
+    def _train_local(self, das_file, ttree_file, data_portion, context_file, validation_files,
+                     lexic_files):
+        """Run the training using local subprocesses (at most `local_workers` at a time).
+        Each job gets its task in a pickle file and stores its results into files in the
+        working directory; model parameters are passed as memory-mapped flat binary files."""
+        log_info('Spawning %d local jobs (max. %d at a time)...' %
+                 (self.jobs_number, self.local_workers))
+        if not os.path.isdir(self.work_dir):
+            os.makedirs(self.work_dir)
+        abspath = lambda fname: os.path.abspath(fname) if fname else None
+        abspaths = lambda files: (','.join([os.path.abspath(f) for f in files.split(',')])
+                                  if files else None)
+        self.jobs = []
+        waiting = deque()
+        for j in xrange(self.jobs_number):
+            name = self.experiment_id + ('PRT%02d-local' % j)
+            cfg = {key: self.cfg[key] for key in self.cfg}
+            # add unique 'scope suffix' so that the models don't clash in ensembles
+            cfg['scope_suffix'] = hashlib.md5(name).hexdigest()
+            # avoid oversubscribing the CPU cores by the concurrently running jobs
+            if not cfg.get('max_cores'):
+                cfg['max_cores'] = max(1, cpu_count() // self.local_workers)
+            task = {'cfg': cfg,
+                    'rnd_seed': rnd.random(),
+                    'das_file': abspath(das_file),
+                    'ttree_file': abspath(ttree_file),
+                    'data_portion': data_portion,
+                    'context_file': abspath(context_file),
+                    'validation_files': abspaths(validation_files),
+                    'lexic_files': abspaths(lexic_files),
+                    'out_prefix': name,
+                    'save_model': not self.average_models,
+                    'debug_out': (name + '.debug-out.txt.gz') if is_debug_stream() else None}
+            # remove stale results from previous runs
+            if os.path.isfile(os.path.join(self.work_dir, name + '.result.pickle.gz')):
+                os.remove(os.path.join(self.work_dir, name + '.result.pickle.gz'))
+            with file_stream(os.path.join(self.work_dir, name + '.task.pickle.gz'), 'wb',
+                             encoding=None) as fh:
+                pickle.dump(task, fh, protocol=pickle.HIGHEST_PROTOCOL)
+            waiting.append(LocalJob(header='from tgen.parallel_seq2seq_train import run_local_training',
+                                    code='run_local_training("%s")' % (name + '.task.pickle.gz'),
+                                    name=name, work_dir=self.work_dir))
+        try:
+            results = []
+            running = []
+            finished_jobs = Queue.Queue()
+            while waiting or running:
+                # start new jobs if there are free workers
+                while waiting and len(running) < self.local_workers:
+                    job = waiting.popleft()
+                    job.add_callback(finished_jobs.put)
+                    job.submit(cores=self.cfg.get('max_cores'))
+                    log_info('Started job %s (PID %s)' % (job.name, job.jobid))
+                    self.jobs.append(job)
+                    running.append(job)
+                # wait for a job to finish, collect its results
+                job = self._wait_for(finished_jobs)
+                running.remove(job)
+                res = self._get_local_result(job)
+                if res is not None:
+                    results.append(res)
+
+            if not results:
+                raise RuntimeError('All training jobs failed, see logs in %s' % self.work_dir)
+            log_info("Results:\n" + "\n".join("%.5f %s" % (res['cost'], res['name'])
+                                              for res in results))
+            results.sort(key=lambda res: res['cost'])
+            if self.average_models:
+                log_info('Creating ensemble models...')
+                results_for_ensemble = (results[:self.average_models_top_k]
+                                        if self.average_models_top_k > 0
+                                        else results)
+                ensemble_model = self.build_ensemble_model(
+                    *self._get_local_models(results_for_ensemble))
+                self.model_temp_path = os.path.join(self.work_dir, self.TEMPFILE_NAME)
+                log_info('Saving the ensemble model temporarily to %s...' % self.model_temp_path)
+                ensemble_model.save_to_file(self.model_temp_path)
+            else:
+                # the best model has already been saved by its job
+                best = results[0]
+                log_info('Best cost: %f (computed by %s).' % (best['cost'], best['name']))
+                self.model_temp_path = os.path.join(self.work_dir, best['model_file'])
+
+        # kill all jobs that may still be running
+        finally:
+            for job in self.jobs:
+                job.delete()
+
+    def _get_local_result(self, job):
+        """Load the results of a finished local job (return None and log a warning if the job
+        has failed)."""
+        res_fname = os.path.join(self.work_dir, job.name + '.result.pickle.gz')
+        if job.exit_status != 0 or not os.path.isfile(res_fname):
+            log_warn('Job %s failed (exit status %d), see %s.' %
+                     (job.name, job.exit_status, os.path.join(self.work_dir, job.name + '.log')))
+            return None
+        with file_stream(res_fname, 'rb', encoding=None) as fh:
+            res = pickle.load(fh)
+        log_info('Job %s finished, cost: %f' % (job.name, res['cost']))
+        res['name'] = job.name
+        return res
+
+    def _get_local_models(self, results):
+        """Load model settings and (memory-mapped) parameters stored by local jobs.
+
+        @param results: list of result dictionaries, as returned by `_get_local_result`
+        @return: a tuple: list of (settings, parameters) for all models, reranker settings \
+            and parameters (of the first model, or None)
+        """
+        def load(res, key):
+            with file_stream(os.path.join(self.work_dir, res[key + '_settings_file']), 'rb',
+                             encoding=None) as fh:
+                settings = pickle.load(fh)
+            params = read_flat_arrays(os.path.join(self.work_dir, res[key + '_params_file']),
+                                      res[key + '_params_index'])
+            return settings, params
+
+        models = [load(res, 'model') for res in results]
+        rerank_settings, rerank_params = None, None
+        if results[0].get('rerank_settings_file'):
+            rerank_settings, rerank_params = load(results[0], 'rerank')
+        return models, rerank_settings, rerank_params
+
+    def _get_remote_models(self, results):
+        """Retrieve model settings and parameters from the workers over RPyC.
+
+        @param results: list of tuples (cost, ServiceConn object), where cost is not used
+        @return: a tuple: list of (settings, parameters) for all models, reranker settings \
+            and parameters (of the first model, or None)
+        """
+        models = []
+        for _, sc in results:
+            models.append((pickle.loads(sc.conn.root.get_all_settings()),
+                           pickle.loads(sc.conn.root.get_model_params())))
+
+        rerank_settings = results[0][1].conn.root.get_rerank_settings()
+        if rerank_settings is not None:
+            rerank_settings = pickle.loads(rerank_settings)
+        rerank_params = results[0][1].conn.root.get_rerank_params()
+        if rerank_params is not None:
+            rerank_params = pickle.loads(rerank_params)
+        return models, rerank_settings, rerank_params
+
+    def _add_pending_request(self, sc, job_no, req):
+        """Add a request to the list of pending requests; once it finishes, it will be put
+        into the queue of finished requests (from the connection's background serving thread).
+
+        @param sc: a ServiceConn object that stores the worker connection parameters
+        @param job_no: current job number (is None for jobs loading)
+        @param req: the request itself (RPyC AsyncResult)
+        """
+        self.pending_requests.add((sc, job_no, req))
+        req.add_callback(lambda _: self.finished_requests.put((sc, job_no, req)))
+
+    def _wait_for_finished_request(self):
+        """Block until a pending request finishes, return it.
+        @return: a tuple (ServiceConn, job number, request) as given to `_add_pending_request`
+        """
+        return self._wait_for(self.finished_requests)
+
+    def _wait_for(self, queue):
+        """Block until an item is available in the given queue, return it. Waits in
+        `poll_interval` steps so that the main thread stays interruptible (an item is returned
+        as soon as it is available)."""
+        while True:
+            try:
+                return queue.get(timeout=self.poll_interval)
+            except Queue.Empty:
+                pass
+
     def _check_pending_request(self, sc, job_no, req):
         """Check whether the given request has finished (i.e., job is loaded or job has
         processed the given data portion.
@@ -236,6 +434,7 @@ class ParallelSeq2SeqTraining(object):
         self.services = set()
         self.free_services = deque()
         self.pending_requests = set()
+        self.finished_requests = Queue.Queue()
         self.jobs = []
         self.server_thread = Thread(target=self.server.start)
         self.server_thread.setDaemon(True)
@@ -243,43 +442,48 @@ class ParallelSeq2SeqTraining(object):
 
     def save_to_file(self, model_fname):
         """This will actually just move the best generator (which is saved in a temporary file)
-        to the final location."""
+        to the final location, along with all its TF session files, the reranking classifier
+        and the lexicalizer."""
         log_info('Moving generator to %s...' % model_fname)
         orig_model_fname = self.model_temp_path
-        shutil.move(orig_model_fname, model_fname)
-        orig_tf_session_fname = re.sub(r'(.pickle)?(.gz)?$', '.tfsess', orig_model_fname)
-        tf_session_fname = re.sub(r'(.pickle)?(.gz)?$', '.tfsess', model_fname)
-        if os.path.isfile(orig_tf_session_fname):
-            shutil.move(orig_tf_session_fname, tf_session_fname)
+        self._move_tf_model(orig_model_fname, model_fname)
 
         # move the reranking classifier model files as well, if they exist
         orig_clfilter_fname = re.sub(r'((.pickle)?(.gz)?)$', r'.tftreecl\1', orig_model_fname)
-        orig_clfilter_tf_fname = re.sub(r'((.pickle)?(.gz)?)$', r'.tfsess', orig_clfilter_fname)
-
-        if os.path.isfile(orig_clfilter_fname) and os.path.isfile(orig_clfilter_tf_fname):
+        if os.path.isfile(orig_clfilter_fname):
             clfilter_fname = re.sub(r'((.pickle)?(.gz)?)$', r'.tftreecl\1', model_fname)
-            clfilter_tf_fname = re.sub(r'((.pickle)?(.gz)?)$', r'.tfsess', clfilter_fname)
-            shutil.move(orig_clfilter_fname, clfilter_fname)
-            shutil.move(orig_clfilter_tf_fname, clfilter_tf_fname)
-
-    def build_ensemble_model(self, results):
-        """Load the models computed by the individual jobs and compose them into a single
-        ensemble model.
-
-        @param results: list of tuples (cost, ServiceConn object), where cost is not used"""
+            self._move_tf_model(orig_clfilter_fname, clfilter_fname)
+
+        # move the lexicalizer and its form index, if they exist
+        orig_lexic_fname = re.sub(r'((.pickle)?(.gz)?)$', r'.lexic\1', orig_model_fname)
+        if os.path.isfile(orig_lexic_fname):
+            lexic_fname = re.sub(r'((.pickle)?(.gz)?)$', r'.lexic\1', model_fname)
+            shutil.move(orig_lexic_fname, lexic_fname)
+            orig_index_fname = re.sub(r'(.pickle)?(.gz)?$', '.lexidx', orig_lexic_fname)
+            if os.path.isfile(orig_index_fname):
+                shutil.move(orig_index_fname, re.sub(r'(.pickle)?(.gz)?$', '.lexidx', lexic_fname))
+
+    def _move_tf_model(self, orig_fname, fname):
+        """Move a model pickle and all files of its TF session (TF saves the session into \
+        several files: .tfsess.index, .tfsess.meta, .tfsess.data-*).
+
+        @param orig_fname: current path to the model pickle
+        @param fname: target path to the model pickle
+        """
+        shutil.move(orig_fname, fname)
+        orig_tf_session_fname = re.sub(r'(.pickle)?(.gz)?$', '.tfsess', orig_fname)
+        tf_session_fname = re.sub(r'(.pickle)?(.gz)?$', '.tfsess', fname)
+        for orig_tf_fname in glob.glob(orig_tf_session_fname + '*'):
+            shutil.move(orig_tf_fname,
+                        tf_session_fname + orig_tf_fname[len(orig_tf_session_fname):])
+
+    def build_ensemble_model(self, models, rerank_settings=None, rerank_params=None):
+        """Compose the models computed by the individual jobs into a single ensemble model.
+
+        @param models: list of tuples (settings, parameter set) of all models
+        @param rerank_settings: settings of the reranking classifier (or None)
+        @param rerank_params: parameters of the reranking classifier (or None)"""
         ensemble = Seq2SeqEnsemble(self.cfg)
-        models = []
-        for _, sc in results:
-            models.append((pickle.loads(sc.conn.root.get_all_settings()),
-                           pickle.loads(sc.conn.root.get_model_params())))
-
-        rerank_settings = results[0][1].conn.root.get_rerank_settings()
-        if rerank_settings is not None:
-            rerank_settings = pickle.loads(rerank_settings)
-        rerank_params = results[0][1].conn.root.get_rerank_params()
-        if rerank_params is not None:
-            rerank_params = pickle.loads(rerank_params)
-
         ensemble.build_ensemble(models, rerank_settings, rerank_params)
         return ensemble
 
@@ -299,14 +503,16 @@ class Seq2SeqTrainingService(Service):
         self.seq2seq = Seq2SeqGen(cfg)
         log_info('Training initialized. Time taken: %f secs.' % (time.time() - tstart))
 
-    def exposed_train(self, rnd_seed, das_file, ttree_file, data_portion, context_file, validation_files):
+    def exposed_train(self, rnd_seed, das_file, ttree_file, data_portion, context_file,
+                      validation_files, lexic_files=None):
         """Run the whole training.
         """
         rnd.seed(rnd_seed)
         log_info('Random seed: %f' % rnd_seed)
         tstart = time.time()
         log_info('Starting training...')
-        self.seq2seq.train(das_file, ttree_file, data_portion, context_file, validation_files)
+        self.seq2seq.train(das_file, ttree_file, data_portion, context_file, validation_files,
+                           lexic_files)
         log_info('Training finished -- time taken: %f secs.' % (time.time() - tstart))
         top_cost = self.seq2seq.top_k_costs[0]
         log_info('Best cost: %f' % top_cost)
@@ -377,6 +583,65 @@ def run_training(head_host, head_port, debug_out=None):
     server_thread.join()
 
 
+def run_local_training(task_fname):
+    """Main routine of a local training job: train a generator according to the task stored
+    in the given file and save the results to files in the working directory -- either the
+    whole model, or its settings (as a pickle) and parameters (as a flat binary file to be
+    memory-mapped by the head). The result file containing the cost and paths to the other
+    files is written last.
+
+    @param task_fname: path to the task file (pickled dictionary, see \
+        `ParallelSeq2SeqTraining._train_local`)
+    """
+    with file_stream(task_fname, 'rb', encoding=None) as fh:
+        task = pickle.load(fh)
+    # setup debugging output, if applicable
+    if task['debug_out'] is not None:
+        set_debug_stream(file_stream(task['debug_out'], mode='w'))
+
+    rnd.seed(task['rnd_seed'])
+    log_info('Random seed: %f' % task['rnd_seed'])
+    tstart = time.time()
+    log_info('Starting training...')
+    seq2seq = Seq2SeqGen(task['cfg'])
+    seq2seq.train(task['das_file'], task['ttree_file'], task['data_portion'],
+                  task['context_file'], task['validation_files'], task['lexic_files'])
+    log_info('Training finished -- time taken: %f secs.' % (time.time() - tstart))
+    res = {'cost': seq2seq.top_k_costs[0]}
+    log_info('Best cost: %f' % res['cost'])
+
+    prefix = task['out_prefix']
+    if task['save_model']:
+        # use a separate directory for each job so that TF checkpoint state files don't clash
+        if not os.path.isdir(prefix):
+            os.makedirs(prefix)
+        res['model_file'] = os.path.join(prefix, 'model.pickle.gz')
+        seq2seq.save_to_file(res['model_file'])
+    else:
+        # use the best parameters found (the same as when saving the model)
+        if seq2seq.checkpoint_path:
+            seq2seq.saver.restore(seq2seq.session, seq2seq.checkpoint_path)
+            shutil.rmtree(os.path.dirname(seq2seq.checkpoint_path))
+            seq2seq.checkpoint_path = None
+        models = [('model', seq2seq)]
+        if seq2seq.classif_filter:
+            models.append(('rerank', seq2seq.classif_filter))
+        for key, model in models:
+            res[key + '_settings_file'] = prefix + '.' + key + '.settings.pickle.gz'
+            with file_stream(res[key + '_settings_file'], 'wb', encoding=None) as fh:
+                pickle.dump(model.get_all_settings(), fh, protocol=pickle.HIGHEST_PROTOCOL)
+            res[key + '_params_file'] = prefix + '.' + key + '.params.bin'
+            res[key + '_params_index'] = write_flat_arrays(res[key + '_params_file'],
+                                                           model.get_model_params())
+
+    res_fname = prefix + '.result.pickle.gz'
+    tmp_fname = re.sub(r'\.gz$', '.tmp-%d.gz' % os.getpid(), res_fname)
+    with file_stream(tmp_fname, 'wb', encoding=None) as fh:
+        pickle.dump(res, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_fname, res_fname)
+    log_info('Results saved to %s.' % res_fname)
+
+
 if __name__ == '__main__':
     try:
         host = sys.argv[1]
@@ -315,6 +315,8 @@ class ASearchPlanner(SentencePlanner):
         # main search loop
         while not self.check_finalize():
             self.run_iter()
+        if self.candgen.classif:
+            self.candgen.classif.log_cache_stats()
 
     def run_iter(self):
         """Run one iteration of the A*-search generation algorithm. Move the best candidate(s)
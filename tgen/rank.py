@@ -108,7 +108,7 @@ class BasePerceptronRanker(Ranker):
         and planner)"""
         # read input
         log_info('Reading DAs from ' + das_file + '...')
-        das = read_das(das_file)
+        das = read_das(das_file, intern=True)
         log_info('Reading t-trees from ' + ttree_file + '...')
         ttree_doc = read_ttrees(ttree_file)
         sents = sentences_from_doc(ttree_doc, self.language, self.selector)
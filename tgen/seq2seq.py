@@ -4,10 +4,12 @@
 from __future__ import unicode_literals
 
 import re
+import glob
 import numpy as np
 import tensorflow as tf
+from tensorflow.python.util import nest
 import cPickle as pickle
-from itertools import izip_longest, groupby
+from itertools import izip, izip_longest, groupby, islice
 import sys
 import math
 import tempfile
@@ -18,8 +20,8 @@ from functools import partial
 from pytreex.core.util import file_stream
 
 from tgen.logf import log_info, log_debug, log_warn
-from tgen.futil import read_das, read_ttrees, trees_from_doc, tokens_from_doc, chunk_list, \
-    read_tokens, tagged_lemmas_from_doc
+from tgen.futil import read_das, iter_das, chunk_list, read_tokens, trees_from_file, \
+    tokens_from_file, tagged_lemmas_from_file
 from tgen.embeddings import DAEmbeddingSeq2SeqExtract, TokenEmbeddingSeq2SeqExtract, \
     TreeEmbeddingSeq2SeqExtract, ContextDAEmbeddingSeq2SeqExtract, \
     TaggedLemmasEmbeddingSeq2SeqExtract
@@ -32,6 +34,8 @@ from tgen.tfclassif import RerankingClassifier
 from tgen.tf_ml import TFModel, embedding_attention_seq2seq_context
 from tgen.ml import softmax
 from tgen.lexicalize import Lexicalizer
+from tgen.corpus import config_digest, source_stats, corpus_version, write_corpus, \
+    read_corpus, read_corpus_meta
 import tgen.externals.seq2seq as tf06s2s
 
 
@@ -64,9 +68,11 @@ class Seq2SeqBase(SentencePlanner):
         self.beam_size = cfg.get('beam_size', 1)
         self.sample_top_k = cfg.get('sample_top_k', 1)
         self.length_norm_weight = cfg.get('length_norm_weight', 0.0)
+        self.in_graph_beam_search = cfg.get('in_graph_beam_search', False)
         self.context_bleu_weight = cfg.get('context_bleu_weight', 0.0)
         self.context_bleu_metric = cfg.get('context_bleu_metric', 'bleu')
         self.slot_err_stats = None
+        self._valid_bleu_refs = None
 
         self.classif_filter = None
         if 'classif_filter' in cfg:
@@ -192,6 +198,17 @@ class Seq2SeqBase(SentencePlanner):
                   " ".join(self.tree_embs.ids_to_strings(
                       [out_tok[0] for out_tok in self._greedy_decoding(enc_inputs, None)[0]])))
 
+        if self.in_graph_beam_search:
+            paths = self._beam_search_in_graph(enc_inputs)[0]
+        else:
+            paths = self._beam_search_paths(enc_inputs)
+
+        return self._select_path(paths, da)
+
+    def _beam_search_paths(self, enc_inputs):
+        """Run beam search decoding step-by-step, calling the network for each path
+        at each step. Return the final n-best list of decoding paths."""
+
         # initialize
         self._init_beam_search(enc_inputs)
         empty_tree_emb = self.tree_embs.get_embeddings(TreeData())
@@ -223,6 +240,12 @@ class Seq2SeqBase(SentencePlanner):
                                  " ".join(self.tree_embs.ids_to_strings([inp[0] for inp in p.dec_inputs]))
                                  for p in paths]) + "\n")
 
+        return paths
+
+    def _select_path(self, paths, da):
+        """Select the output of beam search from the n-best list of paths (after reranking
+        and slot error measurement, if applicable). Return the selected path as token IDs."""
+
         # rerank paths by their distance to the input DA
         if self.classif_filter or self.context_bleu_weight:
             paths = self._rerank_paths(paths, da)
@@ -245,6 +268,9 @@ class Seq2SeqBase(SentencePlanner):
     def _init_beam_search(self, enc_inputs):
         raise NotImplementedError()
 
+    def _beam_search_in_graph(self, enc_inputs):
+        raise NotImplementedError()
+
     def _beam_search_step(self, dec_inputs, dec_states):
         raise NotImplementedError()
 
@@ -258,13 +284,11 @@ class Seq2SeqBase(SentencePlanner):
         # rerank using BLEU against context if set to do so
         if self.context_bleu_weight:
             bm = BLEUMeasure(max_ngram=2)
+            refs = bm.get_references([da[0]])
             bleus = []
             for path, tree in zip(paths, trees):
-                bm.reset()
-                bm.append([(n.t_lemma, None) for n in tree.nodes[1:]], [da[0]])
-                bleu = (bm.ngram_precision()
-                        if self.context_bleu_metric == 'ngram_prec'
-                        else bm.bleu())
+                bleu = bm.sentence_bleu([n.t_lemma for n in tree.nodes[1:]], refs,
+                                        metric=self.context_bleu_metric)
                 bleus.append(bleu)
                 path.logprob += self.context_bleu_weight * bleu
 
@@ -274,8 +298,7 @@ class Seq2SeqBase(SentencePlanner):
 
         # add distances to logprob so that non-fitting will be heavily penalized
         if self.classif_filter:
-            self.classif_filter.init_run(da)
-            fits = self.classif_filter.dist_to_cur_da(trees)
+            fits = self.classif_filter.dist_to_das([da], [trees])[0]
             for path, fit in zip(paths, fits):
                 path.logprob -= self.misfit_penalty * fit
 
@@ -332,6 +355,24 @@ class Seq2SeqBase(SentencePlanner):
         # return the result
         return tree
 
+    def generate_trees(self, das):
+        """Generate trees for a batch of DAs at once (one TF session call for the whole batch
+        with greedy decoding or in-graph beam search, one by one otherwise).
+
+        @param das: list of input DAs (or context-DA pairs)
+        @return: list of generated trees (TreeData instances)
+        """
+        if self.beam_size <= 1:
+            log_debug("GENERATE TREES FOR DAS: " + " | ".join(unicode(da) for da in das))
+            return self.process_das(das)
+        if not self.in_graph_beam_search or not hasattr(self, 'beam_tokens'):
+            return [self.generate_tree(da) for da in das]
+
+        log_debug("GENERATE TREES FOR DAS: " + " | ".join(unicode(da) for da in das))
+        enc_inputs = cut_batch_into_steps([self.da_embs.get_embeddings(da) for da in das])
+        return [self.tree_embs.ids_to_tree(self._select_path(paths, da).transpose()[0])
+                for paths, da in izip(self._beam_search_in_graph(enc_inputs), das)]
+
     def init_slot_err_stats(self):
         """Initialize slot error statistics accumulator."""
         self.slot_err_stats = SlotErrAnalyzer()
@@ -343,15 +384,17 @@ class Seq2SeqBase(SentencePlanner):
                  self.slot_err_stats.superfluous, self.slot_err_stats.total))
 
     @staticmethod
-    def load_from_file(model_fname):
-        """Detect correct model type (plain/ensemble) and start loading."""
+    def load_from_file(model_fname, inference_only=False):
+        """Detect correct model type (plain/ensemble) and start loading.
+        @param inference_only: load the model for decoding only (see `Seq2SeqGen.load_from_file`)
+        """
         model_type = Seq2SeqGen  # default to plain generator
         with file_stream(model_fname, 'rb', encoding=None) as fh:
             data = pickle.load(fh)
             if isinstance(data, type):
                 model_type = data
 
-        return model_type.load_from_file(model_fname)
+        return model_type.load_from_file(model_fname, inference_only)
 
 
 class Seq2SeqGen(Seq2SeqBase, TFModel):
@@ -397,6 +440,7 @@ class Seq2SeqGen(Seq2SeqBase, TFModel):
         self.bleu_validation_weight = cfg.get('bleu_validation_weight', 0.0)
 
         self.use_context = cfg.get('use_context', False)
+        self.compiled_corpus = cfg.get('compiled_corpus')
 
         # Train Summaries
         self.train_summary_dir = cfg.get('tb_summary_dir', None)
@@ -416,17 +460,70 @@ class Seq2SeqGen(Seq2SeqBase, TFModel):
         @param validation_files: validation file paths (or None)
         @param lexic_files: paths to lexicalization data (or None)
         """
-        # read training data
-        log_info('Reading DAs from ' + das_file + '...')
-        das = read_das(das_file)
-        trees = self._load_trees(ttree_file)
-        if self.use_context:
-            das = self._load_contexts(das, context_file)
+        # load preprocessed training data from a compiled corpus, if available
+        corpus_embs = None
+        if self.compiled_corpus:
+            corpus_embs = self._load_compiled_corpus(
+                self.compiled_corpus, das_file, ttree_file, data_portion,
+                context_file, validation_files)
+        if corpus_embs is not None:
+            enc_embs, dec_embs = corpus_embs
+        else:
+            self._load_training_data(das_file, ttree_file, data_portion,
+                                     context_file, validation_files)
+            enc_embs = (self.da_embs.get_embeddings(da) for da in self.train_das)
+            dec_embs = (self.tree_embs.get_embeddings(tree) for tree in self.train_trees)
+
+        # prepare training batches
+        self.train_enc = [cut_batch_into_steps(b)
+                          for b in grouper(enc_embs, self.batch_size, None)]
+        self.train_dec = [cut_batch_into_steps(b)
+                          for b in grouper(dec_embs, self.batch_size, None)]
+
+        # train lexicalizer (store surface forms, possibly train LM)
+        if self.lexicalizer:
+            self.lexicalizer.train(lexic_files, self.train_trees, self.valid_trees_for_lexic)
+
+        # train the classifier for filtering n-best lists
+        if self.classif_filter:
+            self.classif_filter.train(self.train_das, self.train_trees,
+                                      valid_das=self.valid_das,
+                                      valid_trees=self.valid_trees)
+
+        # convert validation data to flat trees to enable F1 measuring
+        if self.validation_size > 0 and self.mode in ['tokens', 'tagged_lemmas']:
+            self.valid_trees = self._valid_data_to_flat_trees(self.valid_trees)
 
-        # make training data smaller if necessary
+        # initialize top costs
+        self.top_k_costs = [float('nan')] * self.top_k
+        self.checkpoint_path = None
+
+        # build the NN
+        self._init_neural_network()
+
+        # initialize the NN variables
+        self.session.run(tf.global_variables_initializer())
+
+    def _load_training_data(self, das_file, ttree_file, data_portion,
+                            context_file, validation_files):
+        """Load training and validation data, initialize embeddings (all data preprocessing,
+        before training batches are prepared).
+
+        @param das_file: training DAs (file path)
+        @param ttree_file: training t-trees (file path)
+        @param data_portion: portion of the data to be actually used for training
+        @param context_file: training contexts (file path)
+        @param validation_files: validation file paths (or None)
+        """
+        # read training data (make it smaller if necessary, only read the DAs needed)
+        trees = self._load_trees(ttree_file)
         train_size = int(round(data_portion * len(trees)))
         self.train_trees = trees[:train_size]
-        self.train_das = das[:train_size]
+        del trees
+        log_info('Reading DAs from ' + das_file + '...')
+        self.train_das = list(islice(iter_das(das_file), train_size))
+        if self.use_context:
+            self.train_das = self._load_contexts(self.train_das, context_file)
 
         # get validation set (default to empty)
         self.valid_trees = []
@@ -462,39 +559,80 @@ class Seq2SeqGen(Seq2SeqBase, TFModel):
         self.max_tree_len = self.tree_embs.get_embeddings_shape()[0]
         self.max_da_len = self.da_embs.get_embeddings_shape()[0]
 
-        # prepare training batches
-        self.train_enc = [cut_batch_into_steps(b)
-                          for b in grouper([self.da_embs.get_embeddings(da)
-                                            for da in self.train_das],
-                                           self.batch_size, None)]
-        self.train_dec = [cut_batch_into_steps(b)
-                          for b in grouper([self.tree_embs.get_embeddings(tree)
-                                            for tree in self.train_trees],
-                                           self.batch_size, None)]
+    def _corpus_sources(self, das_file, ttree_file, context_file, validation_files):
+        """Return identification of all source data files for a compiled corpus."""
+        return source_stats([das_file, ttree_file, context_file if self.use_context else None] +
+                            (validation_files.split(',') if validation_files else []))
 
-        # train lexicalizer (store surface forms, possibly train LM)
-        if self.lexicalizer:
-            self.lexicalizer.train(lexic_files, self.train_trees, self.valid_trees_for_lexic)
+    def compile_corpus(self, das_file, ttree_file, data_portion, context_file,
+                       validation_files, corpus_file):
+        """Preprocess the training data (as for training) and save them into a compiled corpus
+        file, which can be used in training instead of the source data files (see `tgen.corpus`).
 
-        # train the classifier for filtering n-best lists
-        if self.classif_filter:
-            self.classif_filter.train(self.train_das, self.train_trees,
-                                      valid_das=self.valid_das,
-                                      valid_trees=self.valid_trees)
-
-        # convert validation data to flat trees to enable F1 measuring
-        if self.validation_size > 0 and self.mode in ['tokens', 'tagged_lemmas']:
-            self.valid_trees = self._valid_data_to_flat_trees(self.valid_trees)
-
-        # initialize top costs
-        self.top_k_costs = [float('nan')] * self.top_k
-        self.checkpoint_path = None
-
-        # build the NN
-        self._init_neural_network()
-
-        # initialize the NN variables
-        self.session.run(tf.global_variables_initializer())
+        @param das_file: training DAs (file path)
+        @param ttree_file: training t-trees (file path)
+        @param data_portion: portion of the data to be actually used for training
+        @param context_file: training contexts (file path)
+        @param validation_files: validation file paths (or None)
+        @param corpus_file: output compiled corpus file path
+        """
+        self._load_training_data(das_file, ttree_file, data_portion,
+                                 context_file, validation_files)
+        cfg_digest = config_digest(self.cfg, data_portion)
+        sources = self._corpus_sources(das_file, ttree_file, context_file, validation_files)
+        version = corpus_version(cfg_digest, sources, self.da_embs, self.tree_embs)
+
+        log_info('Writing compiled corpus %s (version %s)...' % (corpus_file, version))
+        meta = {'cfg_digest': cfg_digest, 'sources': sources,
+                'da_embs': self.da_embs, 'tree_embs': self.tree_embs,
+                'da_dict_size': self.da_dict_size, 'tree_dict_size': self.tree_dict_size,
+                'max_da_len': self.max_da_len, 'max_tree_len': self.max_tree_len,
+                'valid_das': self.valid_das, 'valid_trees': self.valid_trees,
+                'valid_trees_for_lexic': self.valid_trees_for_lexic}
+        if self.use_context:
+            contexts, das = [context for context, _ in self.train_das], \
+                [da for _, da in self.train_das]
+        else:
+            contexts, das = None, self.train_das
+        write_corpus(corpus_file, version, meta, das, contexts, self.train_trees,
+                     (self.da_embs.get_embeddings(da) for da in self.train_das),
+                     (self.tree_embs.get_embeddings(tree) for tree in self.train_trees))
+
+    def _load_compiled_corpus(self, corpus_file, das_file, ttree_file, data_portion,
+                              context_file, validation_files):
+        """Load preprocessed training data from a compiled corpus file, if it matches the
+        current configuration and source data files.
+
+        @return: a pair of matrices of DA and tree embedding IDs for all training instances, \
+            or None if the compiled corpus is missing or does not match
+        """
+        if not os.path.isfile(corpus_file):
+            log_warn('Compiled corpus %s not found, using source data files.' % corpus_file)
+            return None
+        meta = read_corpus_meta(corpus_file)
+        if meta['cfg_digest'] != config_digest(self.cfg, data_portion):
+            log_warn('Compiled corpus %s was created with different settings, ' % corpus_file +
+                     'using source data files.')
+            return None
+        sources = self._corpus_sources(das_file, ttree_file, context_file, validation_files)
+        if meta['sources'] != sources:
+            log_warn('Compiled corpus %s does not match source data files, ' % corpus_file +
+                     'using source data files.')
+            return None
+        if meta['version'] != corpus_version(meta['cfg_digest'], meta['sources'],
+                                             meta['da_embs'], meta['tree_embs']):
+            log_warn('Compiled corpus %s is corrupt, using source data files.' % corpus_file)
+            return None
+
+        log_info('Loading compiled corpus %s (version %s)...' % (corpus_file, meta['version']))
+        meta, self.train_das, self.train_trees, enc_embs, dec_embs = read_corpus(corpus_file)
+        for key in ['da_embs', 'tree_embs', 'da_dict_size', 'tree_dict_size',
+                    'max_da_len', 'max_tree_len', 'valid_das', 'valid_trees',
+                    'valid_trees_for_lexic']:
+            setattr(self, key, meta[key])
+        log_info('Using %d training, %d validation instances.' %
+                 (len(self.train_das), len(self.valid_das)))
+        return enc_embs, dec_embs
 
     def _load_trees(self, ttree_file, selector=None):
         """Load input trees/sentences from a .yaml.gz/.pickle.gz (trees) or .txt (sentences) file."""
@@ -504,15 +642,14 @@ class Seq2SeqGen(Seq2SeqBase, TFModel):
                 raise ValueError("Cannot read trees from a .txt file (%s)!" % ttree_file)
             return read_tokens(ttree_file)
         else:
-            ttree_doc = read_ttrees(ttree_file)
             if selector is None:
                 selector = self.selector
             if self.mode == 'tokens':
-                return tokens_from_doc(ttree_doc, self.language, selector)
+                return tokens_from_file(ttree_file, self.language, selector)
             elif self.mode == 'tagged_lemmas':
-                return tagged_lemmas_from_doc(ttree_doc, self.language, selector)
+                return tagged_lemmas_from_file(ttree_file, self.language, selector)
             else:
-                return trees_from_doc(ttree_doc, self.language, selector)
+                return trees_from_file(ttree_file, self.language, selector)
 
     def _load_contexts(self, das, context_file):
         """Load input context utterances from a .yaml.gz/.pickle.gz/.txt file and add them to the
@@ -524,7 +661,7 @@ class Seq2SeqGen(Seq2SeqBase, TFModel):
         if context_file.endswith('.txt'):
             contexts = read_tokens(context_file)
         else:
-            contexts = tokens_from_doc(read_ttrees(context_file), self.language, self.selector)
+            contexts = tokens_from_file(context_file, self.language, self.selector)
         return [(context, da) for context, da in zip(contexts, das)]
 
     def _load_valid_data(self, valid_data_paths):
@@ -678,8 +815,12 @@ class Seq2SeqGen(Seq2SeqBase, TFModel):
         # sent = list of paraphrases for a given sentence
         return [self._tokens_to_flat_trees(sent) for sent in valid_sents]
 
-    def _init_neural_network(self):
-        """Initializing the NN (building a TensorFlow graph and initializing session)."""
+    def _init_neural_network(self, inference_only=False):
+        """Initializing the NN (building a TensorFlow graph and initializing session).
+        @param inference_only: only build the parts of the graph needed for decoding (no training \
+            network, cost and optimizer; the network for step-by-step beam search is built \
+            on demand, see `_init_step_graph`)
+        """
 
         # set TensorFlow random seed
         tf.set_random_seed(rnd.randint(-sys.maxint, sys.maxint))
@@ -714,29 +855,23 @@ class Seq2SeqGen(Seq2SeqBase, TFModel):
             self.cell = tf.contrib.rnn.MultiRNNCell([self.cell] * 2)
 
         # build the actual LSTM Seq2Seq network (for training and decoding)
+        self.outputs, self.states = None, None
         with tf.variable_scope(self.scope_name) as scope:
 
-            rnn_func = tf06s2s.embedding_rnn_seq2seq
-            if self.nn_type == 'emb_attention_seq2seq':
-                rnn_func = tf06s2s.embedding_attention_seq2seq
-            elif self.nn_type == 'emb_attention2_seq2seq':
-                rnn_func = partial(tf06s2s.embedding_attention_seq2seq, num_heads=2)
-            elif self.nn_type == 'emb_attention_seq2seq_context':
-                rnn_func = embedding_attention_seq2seq_context
-            elif self.nn_type == 'emb_attention2_seq2seq_context':
-                rnn_func = partial(embedding_attention_seq2seq_context, num_heads=2)
+            rnn_func = self._get_rnn_func()
 
             # for training: feed_previous == False, using dropout if available
             # outputs = batch_size * num_decoder_symbols ~ i.e. output logits at each steps
             # states = cell states at each steps
-            self.outputs, self.states = rnn_func(
-                self.enc_inputs_drop if self.enc_inputs_drop else self.enc_inputs,
-                self.dec_inputs, self.cell,
-                self.da_dict_size, self.tree_dict_size,
-                self.emb_size,
-                scope=scope)
+            if not inference_only:
+                self.outputs, self.states = rnn_func(
+                    self.enc_inputs_drop if self.enc_inputs_drop else self.enc_inputs,
+                    self.dec_inputs, self.cell,
+                    self.da_dict_size, self.tree_dict_size,
+                    self.emb_size,
+                    scope=scope)
 
-            scope.reuse_variables()
+                scope.reuse_variables()
 
             # for decoding: feed_previous == True
             self.dec_outputs, self.dec_states = rnn_func(
@@ -745,6 +880,17 @@ class Seq2SeqGen(Seq2SeqBase, TFModel):
                 self.emb_size,
                 feed_previous=True, scope=scope)
 
+            scope.reuse_variables()
+
+            # for fast beam search decoding: the whole search in a single TF while loop
+            if self.in_graph_beam_search:
+                if self.nn_type in ['emb_attention_seq2seq', 'emb_attention2_seq2seq']:
+                    self._init_beam_search_graph()
+                else:
+                    log_warn('In-graph beam search not supported for %s, ' % self.nn_type +
+                             'using step-by-step beam search.')
+                    self.in_graph_beam_search = False
+
         # TODO use output projection ???
 
         # target weights
@@ -753,43 +899,188 @@ class Seq2SeqGen(Seq2SeqBase, TFModel):
                              for trg in self.targets]
 
         # cost
-        self.tf_cost = tf06s2s.sequence_loss(self.outputs, self.targets,
-                                             self.cost_weights, self.tree_dict_size)
         self.dec_cost = tf06s2s.sequence_loss(self.dec_outputs, self.targets,
                                               self.cost_weights, self.tree_dict_size)
-        if self.use_dec_cost:
-            self.cost = 0.5 * (self.tf_cost + self.dec_cost)
-        else:
-            self.cost = self.tf_cost
-
-        # Tensorboard summaries
-        if self.train_summary_dir:
-            self.loss_summary_seq2seq = tf.summary.scalar("loss_seq2seq", self.cost)
-            self.train_summary_op = tf.summary.merge([self.loss_summary_seq2seq])
-
-        # optimizer (default to Adam)
-        self.learning_rate = tf.placeholder(tf.float32, name="learning_rate")
-        if self.optimizer_type == 'sgd':
-            self.optimizer = tf.train.GradientDescentOptimizer(self.learning_rate)
-        if self.optimizer_type == 'adagrad':
-            self.optimizer = tf.train.AdagradOptimizer(self.learning_rate)
-        else:
-            self.optimizer = tf.train.AdamOptimizer(self.learning_rate)
-        self.train_func = self.optimizer.minimize(self.cost)
+        if not inference_only:
+            self.tf_cost = tf06s2s.sequence_loss(self.outputs, self.targets,
+                                                 self.cost_weights, self.tree_dict_size)
+            if self.use_dec_cost:
+                self.cost = 0.5 * (self.tf_cost + self.dec_cost)
+            else:
+                self.cost = self.tf_cost
+
+            # Tensorboard summaries
+            if self.train_summary_dir:
+                self.loss_summary_seq2seq = tf.summary.scalar("loss_seq2seq", self.cost)
+                self.train_summary_op = tf.summary.merge([self.loss_summary_seq2seq])
+
+            # optimizer (default to Adam)
+            self.learning_rate = tf.placeholder(tf.float32, name="learning_rate")
+            if self.optimizer_type == 'sgd':
+                self.optimizer = tf.train.GradientDescentOptimizer(self.learning_rate)
+            if self.optimizer_type == 'adagrad':
+                self.optimizer = tf.train.AdagradOptimizer(self.learning_rate)
+            else:
+                self.optimizer = tf.train.AdamOptimizer(self.learning_rate)
+            self.train_func = self.optimizer.minimize(self.cost)
 
         # initialize session
-        session_config = None
-        if self.max_cores:
-            session_config = tf.ConfigProto(inter_op_parallelism_threads=self.max_cores,
-                                            intra_op_parallelism_threads=self.max_cores)
-        self.session = tf.Session(config=session_config)
+        self.session = self._create_session()
 
         # this helps us load/save the model
         self.saver = tf.train.Saver(tf.global_variables())
-        if self.train_summary_dir:  # Tensorboard summary writer
+        if self.train_summary_dir and not inference_only:  # Tensorboard summary writer
             self.train_summary_writer = tf.summary.FileWriter(
                 os.path.join(self.train_summary_dir, "main_seq2seq"), self.session.graph)
 
+    def _get_rnn_func(self):
+        """Return the function building the Seq2Seq network of the configured type."""
+        if self.nn_type == 'emb_attention_seq2seq':
+            return tf06s2s.embedding_attention_seq2seq
+        elif self.nn_type == 'emb_attention2_seq2seq':
+            return partial(tf06s2s.embedding_attention_seq2seq, num_heads=2)
+        elif self.nn_type == 'emb_attention_seq2seq_context':
+            return embedding_attention_seq2seq_context
+        elif self.nn_type == 'emb_attention2_seq2seq_context':
+            return partial(embedding_attention_seq2seq_context, num_heads=2)
+        return tf06s2s.embedding_rnn_seq2seq
+
+    def _create_session(self, graph=None):
+        """Create a TF session for the given graph (default graph if None), using at most
+        `max_cores` CPU cores if set."""
+        session_config = None
+        if self.max_cores:
+            session_config = tf.ConfigProto(inter_op_parallelism_threads=self.max_cores,
+                                            intra_op_parallelism_threads=self.max_cores)
+        return tf.Session(graph=graph, config=session_config)
+
+    def _init_step_graph(self):
+        """Build the network used in step-by-step beam search (the decoder is fed the given
+        inputs, same as in training) if it has not been built yet, i.e., if the model has been
+        loaded for inference only. Reuses the existing network variables."""
+        if self.outputs is not None:
+            return
+        if self.saver is None:
+            raise ValueError('The frozen graph does not support step-by-step beam search.')
+        with tf.variable_scope(self.scope_name, reuse=True) as scope:
+            self.outputs, self.states = self._get_rnn_func()(
+                self.enc_inputs_drop if self.enc_inputs_drop else self.enc_inputs,
+                self.dec_inputs, self.cell,
+                self.da_dict_size, self.tree_dict_size,
+                self.emb_size,
+                scope=scope)
+
+    def _init_beam_search_graph(self):
+        """Build the in-graph beam search decoder for a whole batch of inputs (a `tf.while_loop`
+        over decoder steps, reusing the network variables). Must be called in the network's
+        variable scope, with variable reuse on.
+
+        The beam for each input is kept as `beam_size` consecutive rows of the flattened
+        batch. In each step, top `beam_size` expansions of each path are found and the best
+        `beam_size` of all are kept (scored by logprob / length ** length_norm_weight), same as
+        in the step-by-step beam search. Decoding stops for an input once all its paths end
+        with <VOID>."""
+        num_heads = 2 if self.nn_type == 'emb_attention2_seq2seq' else 1
+        go, stop, void = self.tree_embs.GO, self.tree_embs.STOP, self.tree_embs.VOID
+
+        self.beam_size_ph = tf.placeholder_with_default(1, [], name='beam_size')
+        self.length_norm_ph = tf.placeholder_with_default(
+            tf.constant(0.0, tf.float64), [], name='length_norm_weight')
+        beam_size = self.beam_size_ph
+        batch_size = tf.shape(self.enc_inputs[0])[0]
+        flat_size = batch_size * beam_size
+
+        enc_state, attention_states = tf06s2s.embedding_attention_encoder(
+            self.enc_inputs, self.cell, self.da_dict_size, self.emb_size)
+
+        # copy encoder outputs for each path in the beam
+        beam_to_input = tf.reshape(tf.tile(tf.expand_dims(tf.range(batch_size), 1),
+                                           [1, beam_size]), [-1])
+        init_state = nest.map_structure(lambda t: tf.gather(t, beam_to_input), enc_state)
+        attention_states = tf.gather(attention_states, beam_to_input)
+        attn_size = attention_states.get_shape()[2].value
+        init_attns = [tf.zeros(tf.stack([flat_size, attn_size])) for _ in xrange(num_heads)]
+        for attn in init_attns:
+            attn.set_shape([None, attn_size])
+        dec_cell = tf.contrib.rnn.OutputProjectionWrapper(self.cell, self.tree_dict_size)
+
+        # only the 1st path of each beam is valid at the start
+        init_logprobs = tf.tile(tf.concat([tf.zeros([1], tf.float64),
+                                           tf.fill(tf.expand_dims(beam_size - 1, 0),
+                                                   np.float64(-np.inf))], 0),
+                                [batch_size])
+        init_tokens = tf.fill(tf.stack([flat_size, 1]), go)
+        init_lengths = tf.ones(tf.expand_dims(flat_size, 0), tf.float64)
+        init_stopped = tf.zeros(tf.expand_dims(flat_size, 0), tf.bool)
+        init_finished = tf.zeros(tf.expand_dims(batch_size, 0), tf.bool)
+        init_num_steps = tf.zeros(tf.expand_dims(batch_size, 0), tf.int32)
+
+        def cond(step, tokens, state, attns, logprobs, lengths, stopped, finished, num_steps):
+            return tf.logical_and(step < self.max_tree_len,
+                                  tf.logical_not(tf.reduce_all(finished)))
+
+        def body(step, tokens, state, attns, logprobs, lengths, stopped, finished, num_steps):
+            output, new_state, new_attns = tf06s2s.embedding_attention_decoder_step(
+                tokens[:, -1], state, attns, attention_states, dec_cell,
+                self.tree_dict_size, self.emb_size, num_heads, self.tree_dict_size)
+
+            # expand each path with its top beam_size continuations
+            out_logprobs = tf.cast(tf.log(tf.nn.softmax(output)), tf.float64)
+            top_logprobs, top_ids = tf.nn.top_k(out_logprobs, beam_size)
+            is_stop = tf.equal(top_ids, stop)
+            cand_logprobs = tf.expand_dims(logprobs, 1) + top_logprobs
+            cand_lengths = tf.expand_dims(lengths, 1) + tf.cast(
+                tf.logical_and(tf.logical_not(tf.expand_dims(stopped, 1)),
+                               tf.logical_not(is_stop)), tf.float64)
+            cand_stopped = tf.logical_or(tf.expand_dims(stopped, 1), is_stop)
+            cand_scores = cand_logprobs / tf.pow(cand_lengths, self.length_norm_ph)
+
+            # select the best beam_size candidates for each input
+            _, sel = tf.nn.top_k(tf.reshape(cand_scores, tf.stack([batch_size, -1])), beam_size)
+            offsets = tf.expand_dims(tf.range(batch_size) * beam_size, 1)
+            parents = tf.reshape(offsets + sel // beam_size, [-1])
+            cands = tf.reshape(offsets * beam_size + sel, [-1])
+
+            def pick(t):
+                return tf.gather(tf.reshape(t, [-1]), cands)
+
+            new_tokens = tf.concat([tf.gather(tokens, parents),
+                                    tf.expand_dims(pick(top_ids), 1)], 1)
+            new_state = nest.map_structure(lambda t: tf.gather(t, parents), new_state)
+            new_attns = [tf.gather(attn, parents) for attn in new_attns]
+            new_logprobs = pick(cand_logprobs)
+            new_lengths = pick(cand_lengths)
+            new_stopped = pick(cand_stopped)
+
+            # inputs decoded before this step keep their paths (only padded with <VOID>)
+            keep = tf.gather(finished, beam_to_input)
+            new_tokens = tf.where(keep, tf.concat([tokens, tf.fill(tf.stack([flat_size, 1]),
+                                                                   void)], 1),
+                                  new_tokens)
+            new_state = nest.map_structure(lambda old, new: tf.where(keep, old, new),
+                                           state, new_state)
+            new_attns = [tf.where(keep, old, new) for old, new in zip(attns, new_attns)]
+            new_logprobs = tf.where(keep, logprobs, new_logprobs)
+            new_lengths = tf.where(keep, lengths, new_lengths)
+            new_stopped = tf.where(keep, stopped, new_stopped)
+
+            new_num_steps = num_steps + tf.cast(tf.logical_not(finished), tf.int32)
+            all_void = tf.reduce_all(tf.reshape(tf.equal(new_tokens[:, -1], void),
+                                                tf.stack([batch_size, beam_size])), 1)
+            new_finished = tf.logical_or(finished, all_void)
+            return (step + 1, new_tokens, new_state, new_attns, new_logprobs, new_lengths,
+                    new_stopped, new_finished, new_num_steps)
+
+        loop_vars = (tf.constant(0), init_tokens, init_state, init_attns, init_logprobs,
+                     init_lengths, init_stopped, init_finished, init_num_steps)
+        shape_invariants = nest.map_structure(lambda t: t.get_shape(), loop_vars)
+        shape_invariants = (shape_invariants[0], tf.TensorShape([None, None])) + shape_invariants[2:]
+
+        res = tf.while_loop(cond, body, loop_vars, shape_invariants=shape_invariants,
+                            back_prop=False)
+        _, self.beam_tokens, _, _, self.beam_logprobs, self.beam_lengths, _, _, \
+            self.beam_num_steps = res
+
     def _training_pass(self, iter_no):
         """Perform one pass through the training data (epoch).
         @param iter_no: pass number (for logging)
@@ -934,8 +1225,12 @@ class Seq2SeqGen(Seq2SeqBase, TFModel):
         @return: BLEU score, as a float (percentage)
         """
         evaluator = BLEUMeasure()
-        for pred_tree, gold_trees in zip(cur_valid_out, valid_trees):
-            evaluator.append(pred_tree, gold_trees)
+        # reference n-gram counts are only computed once for the same validation set
+        if self._valid_bleu_refs is None or self._valid_bleu_refs[0] is not valid_trees:
+            self._valid_bleu_refs = (valid_trees, [evaluator.get_references(gold_trees)
+                                                   for gold_trees in valid_trees])
+        for pred_tree, refs in zip(cur_valid_out, self._valid_bleu_refs[1]):
+            evaluator.append(pred_tree, refs)
         return evaluator.bleu()
 
     def _compute_f1(self, cur_valid_out, valid_trees):
@@ -999,12 +1294,15 @@ class Seq2SeqGen(Seq2SeqBase, TFModel):
         self.saver.save(self.session, self.checkpoint_path)
 
     @staticmethod
-    def load_from_file(model_fname):
+    def load_from_file(model_fname, inference_only=False):
         """Load the generator from a file (actually two files, one for configuration and one
         for the TensorFlow graph, which must be stored separately).
 
         @param model_fname: file name (for the configuration file); TF graph must be stored with a \
             different extension
+        @param inference_only: load the model for decoding only (skip building the training \
+            network and optimizer); use the frozen inference graph if there is one that is \
+            not older than the model and its parameters (see `save_frozen_graph`)
         """
         log_info("Loading generator from %s..." % model_fname)
         with file_stream(model_fname, 'rb', encoding=None) as fh:
@@ -1028,10 +1326,25 @@ class Seq2SeqGen(Seq2SeqBase, TFModel):
                 log_warn("Lexicalizer data not found, ignoring.")
                 ret.lexicalizer = None
 
-        # re-build TF graph and restore the TF session
         tf_session_fname = os.path.abspath(re.sub(r'(.pickle)?(.gz)?$', '.tfsess', model_fname))
         param_dump_fname = re.sub(r'(.pickle)?(.gz)?$', '.params.gz', model_fname)
-        ret._init_neural_network()
+
+        # load the frozen inference graph, if applicable
+        frozen_fname = re.sub(r'(.pickle)?(.gz)?$', '.frozen.gz', model_fname)
+        if inference_only and os.path.isfile(frozen_fname):
+            # (TF sessions are saved as several files with the same prefix)
+            model_files = [model_fname, param_dump_fname] + glob.glob(tf_session_fname + '*')
+            model_mtime = max(os.path.getmtime(fname) for fname in model_files
+                              if os.path.isfile(fname))
+            if os.path.getmtime(frozen_fname) >= model_mtime:
+                log_info('Loading frozen inference graph from %s...' % frozen_fname)
+                ret._load_frozen_graph(frozen_fname)
+                return ret
+            log_warn('Frozen inference graph %s is older than the model or its parameters, ' %
+                     frozen_fname + 'ignoring.')
+
+        # re-build TF graph and restore the TF session
+        ret._init_neural_network(inference_only)
         if os.path.isfile(param_dump_fname):
             log_info('Loading params dump from %s...' % param_dump_fname)
             with file_stream(param_dump_fname, 'rb', encoding=None) as fh:
@@ -1042,6 +1355,55 @@ class Seq2SeqGen(Seq2SeqBase, TFModel):
 
         return ret
 
+    # network inputs and outputs needed for decoding (stored with the frozen inference graph)
+    INFERENCE_TENSORS = ['enc_inputs', 'dec_inputs', 'targets', 'initial_state', 'dec_outputs',
+                         'dec_cost', 'outputs', 'states', 'beam_size_ph', 'length_norm_ph',
+                         'beam_tokens', 'beam_logprobs', 'beam_lengths', 'beam_num_steps']
+
+    def save_frozen_graph(self, model_fname):
+        """Save the inference graph of the generator, with all parameters folded in as constants
+        (a frozen GraphDef), along with the names of the input and output tensors. The frozen
+        graph is stored next to the model file and used by `load_from_file` with
+        `inference_only` set, so the model can be loaded without building the network and
+        restoring the parameters.
+
+        @param model_fname: model file name (the frozen graph is stored with a different extension)
+        """
+        frozen_fname = re.sub(r'(.pickle)?(.gz)?$', '.frozen.gz', model_fname)
+        log_info('Saving frozen inference graph to %s...' % frozen_fname)
+        if not self.in_graph_beam_search:
+            self._init_step_graph()
+        tensors = {}
+        for attr in self.INFERENCE_TENSORS:
+            if getattr(self, attr, None) is not None:
+                tensors[attr] = nest.map_structure(lambda t: t.name, getattr(self, attr))
+        output_ops = sorted(set(name.split(':')[0]
+                                for names in tensors.itervalues() for name in nest.flatten(names)))
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            self.session, self.session.graph.as_graph_def(), output_ops)
+        # (keeping the .gz extension for the temporary file, so that it is compressed)
+        tmp_fname = re.sub(r'\.gz$', '.tmp-%d.gz' % os.getpid(), frozen_fname)
+        with file_stream(tmp_fname, 'wb', encoding=None) as fh:
+            pickle.dump({'graph_def': graph_def.SerializeToString(), 'tensors': tensors},
+                        fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_fname, frozen_fname)
+
+    def _load_frozen_graph(self, frozen_fname):
+        """Load a frozen inference graph (see `save_frozen_graph`) into a new TF session, set
+        the input and output tensors."""
+        with file_stream(frozen_fname, 'rb', encoding=None) as fh:
+            data = pickle.load(fh)
+        graph_def = tf.GraphDef()
+        graph_def.ParseFromString(data['graph_def'])
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.session = self._create_session(graph)
+        self.saver = None  # no variables to save or restore
+        self.outputs, self.states = None, None
+        for attr, names in data['tensors'].iteritems():
+            setattr(self, attr, nest.map_structure(graph.get_tensor_by_name, names))
+
     def _get_greedy_decoder_output(self, enc_inputs, dec_inputs, compute_cost=False):
         """Run greedy decoding with the given inputs; return decoder outputs and the cost
         (if required).
@@ -1078,6 +1440,7 @@ class Seq2SeqGen(Seq2SeqBase, TFModel):
 
     def _init_beam_search(self, enc_inputs):
         """Initialize beam search for the current DA (with the given encoder inputs)."""
+        self._init_step_graph()
         # initial state
         initial_state = np.zeros([1, self.emb_size])
         self._beam_search_feed_dict = {self.initial_state: initial_state}
@@ -1107,6 +1470,33 @@ class Seq2SeqGen(Seq2SeqBase, TFModel):
         out_probs = softmax(output[0])
         return out_probs, state
 
+    def _beam_search_in_graph(self, enc_inputs):
+        """Run beam search decoding for a whole batch of inputs at once, in a single call
+        to the TF session.
+
+        @param enc_inputs: encoder inputs (list of token IDs, batch-sized)
+        @return: a list of n-best lists of decoding paths (sorted by score), one for each input
+        """
+        feed_dict = {self.beam_size_ph: self.beam_size,
+                     self.length_norm_ph: self.length_norm_weight}
+        for i in xrange(len(enc_inputs)):
+            feed_dict[self.enc_inputs[i]] = enc_inputs[i]
+
+        tokens, logprobs, lengths, num_steps = self.session.run(
+            [self.beam_tokens, self.beam_logprobs, self.beam_lengths, self.beam_num_steps],
+            feed_dict=feed_dict)
+
+        ret = []
+        for inp_no, inp_steps in enumerate(num_steps):
+            paths = []
+            for row in xrange(inp_no * self.beam_size, (inp_no + 1) * self.beam_size):
+                paths.append(self.DecodingPath(
+                    stop_token_id=self.tree_embs.STOP,
+                    dec_inputs=[np.array(tok, ndmin=1) for tok in tokens[row, :inp_steps + 1]],
+                    logprob=logprobs[row], length=int(lengths[row])))
+            ret.append(paths)
+        return ret
+
     def lexicalize(self, trees, abstr_file):
         """Lexicalize generated trees according to the given lexicalization instruction file.
         @param trees: list of generated TreeData instances (delexicalized)
@@ -23,18 +23,23 @@ class Seq2SeqEnsemble(Seq2SeqBase):
         super(Seq2SeqEnsemble, self).__init__(cfg)
 
         self.gens = []
+        # member outputs are averaged at each step, beam search can only run step-by-step
+        self.in_graph_beam_search = False
 
-    def build_ensemble(self, models, rerank_settings=None, rerank_params=None):
+    def build_ensemble(self, models, rerank_settings=None, rerank_params=None,
+                       inference_only=False):
         """Build the ensemble model (build all networks and load their parameters).
 
         @param models: list of tuples (settings, parameter set) of all models in the ensemble
         @param rerank_settings:
+        @param inference_only: build the member networks for decoding only (no training network \
+            and optimizer)
         """
 
         for setting, parset in models:
             model = Seq2SeqGen(setting['cfg'])
             model.load_all_settings(setting)
-            model._init_neural_network()
+            model._init_neural_network(inference_only)
             model.set_model_params(parset)
             self.gens.append(model)
 
@@ -106,9 +111,12 @@ class Seq2SeqEnsemble(Seq2SeqBase):
         return ensemble_output, ensemble_state
 
     @staticmethod
-    def load_from_file(model_fname):
+    def load_from_file(model_fname, inference_only=False):
         """Load the whole ensemble from a file (load settings and model parameters, then build the
-        ensemble network)."""
+        ensemble network).
+        @param inference_only: load the model for decoding only (no training network and \
+            optimizer; frozen graphs are not supported for ensembles)
+        """
         # TODO support for lexicalizer
 
         log_info("Loading ensemble generator from %s..." % model_fname)
@@ -127,7 +135,7 @@ class Seq2SeqEnsemble(Seq2SeqBase):
                 rerank_settings = None
                 rerank_params = None
 
-        ret.build_ensemble(gens_dump, rerank_settings, rerank_params)
+        ret.build_ensemble(gens_dump, rerank_settings, rerank_params, inference_only)
         return ret
 
     def save_to_file(self, model_fname):
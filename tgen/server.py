@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Persistent generation server for Seq2Seq generators. The generator (including its classification
+filter and lexicalizer) is loaded once and kept in memory, requests are read as JSON lines from
+a Unix domain socket or from the standard input. Concurrent requests are batched dynamically --
+up to a maximum batch size, waiting at most a given time for a batch to fill up.
+
+Request format (one JSON object per line):
+
+    {"id": <anything>, "da": "inform(food=X-food)&...",
+     "context": "tokenized context utterance" (optional),
+     "absts": "tab-separated lexicalization instructions" (optional)}
+
+Response format (one JSON object per line, in the order in which the requests are finished):
+
+    {"id": <same as in the request>, "text": "generated text"}
+    {"id": <same as in the request>, "error": "error message"}
+
+The outputs are lexicalized only if lexicalization instructions are given in the request and
+the generator has a lexicalizer.
+"""
+
+from __future__ import unicode_literals
+import json
+import os
+import Queue
+import SocketServer
+import sys
+import threading
+import time
+
+from tgen.data import DA
+from tgen.futil import parse_absts, postprocess_tokens
+from tgen.logf import log_info, log_warn
+
+
+class GenRequest(object):
+    """A single parsed generation request, waiting in the queue."""
+
+    __slots__ = ['req_id', 'da', 'context', 'absts', 'callback']
+
+    def __init__(self, req_id, da, context, absts, callback):
+        self.req_id = req_id
+        self.da = da
+        self.context = context
+        self.absts = absts
+        self.callback = callback
+
+
+class GenerationServer(object):
+    """The generation backend: a request queue and a thread that takes requests from the queue
+    in batches and runs the generator on them. Requests may be submitted from any thread;
+    the generator itself is only ever used from the batching thread."""
+
+    def __init__(self, tgen, max_batch_size=20, max_wait=0.005):
+        """Initialize the server (does not start processing, see `start`).
+        @param tgen: the loaded Seq2Seq generator
+        @param max_batch_size: maximum number of requests processed in one batch
+        @param max_wait: maximum time to wait for more requests to fill up a batch (seconds)
+        """
+        self.tgen = tgen
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.use_context = tgen.use_context or tgen.context_bleu_weight
+        self.num_requests = 0
+        self.num_batches = 0
+        self._queue = Queue.Queue()
+        self._thread = None
+        if tgen.beam_size > 1 and not (tgen.in_graph_beam_search and
+                                       hasattr(tgen, 'beam_tokens')):
+            log_warn('Beam search decoding is not done in-graph, ' +
+                     'batched requests will be decoded one by one.')
+
+    def start(self):
+        """Start the batching thread."""
+        self._thread = threading.Thread(target=self._batch_loop, name='GenerationServer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Finish all requests submitted so far and stop the batching thread."""
+        self._queue.put(None)
+        self._thread.join()
+        log_info('Served %d requests in %d batches.' % (self.num_requests, self.num_batches))
+        log_info(self.tgen.get_slot_err_stats())
+
+    def submit(self, line, callback):
+        """Parse a request and queue it for generation (returns immediately).
+        @param line: the request (JSON string)
+        @param callback: function to be called with the response (a dictionary) once the \
+            request is finished -- called from the batching thread (or from this one if the \
+            request cannot be parsed)
+        """
+        req_id = None
+        try:
+            data = json.loads(line)
+            req_id = data.get('id')
+            da = DA.parse(data['da'].strip())
+            context = None
+            if data.get('context') is not None:
+                context = [(form, None) for form in data['context'].split()]
+            absts = None
+            if data.get('absts') is not None:
+                absts = parse_absts(data['absts'])
+        except Exception as e:
+            callback({'id': req_id, 'error': 'Invalid request: %s' % unicode(e)})
+            return
+        self._queue.put(GenRequest(req_id, da, context, absts, callback))
+
+    def generate(self, line):
+        """Process a request synchronously (wait for the response).
+        @param line: the request (JSON string)
+        @return: the response (a dictionary)
+        """
+        done = threading.Event()
+        response = {}
+
+        def callback(resp):
+            response.update(resp)
+            done.set()
+
+        self.submit(line, callback)
+        done.wait()
+        return response
+
+    def _batch_loop(self):
+        """Main loop of the batching thread: collect batches of requests and process them,
+        until the stop sentinel (None) is found in the queue."""
+        stop = False
+        while not stop:
+            req = self._queue.get()
+            if req is None:
+                break
+            batch = [req]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    timeout = deadline - time.time()
+                    req = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if req is None:
+                    stop = True
+                    break
+                batch.append(req)
+            self._process_batch(batch)
+
+    def _process_batch(self, batch):
+        """Generate outputs for a batch of requests and send out the responses. If the batch
+        fails, its requests are retried one by one (so that a single faulty request does not
+        spoil the others)."""
+        self.num_batches += 1
+        self.num_requests += len(batch)
+        try:
+            texts = self._generate(batch)
+        except Exception as e:
+            if len(batch) > 1:
+                log_warn('Batch failed, retrying requests one by one: %s' % unicode(e))
+                self.num_batches -= 1
+                self.num_requests -= len(batch)
+                for req in batch:
+                    self._process_batch([req])
+                return
+            log_warn('Request failed: %s' % unicode(e))
+            self._respond(batch[0], {'error': unicode(e)})
+            return
+        for req, text in zip(batch, texts):
+            self._respond(req, {'text': text})
+
+    def _generate(self, batch):
+        """Run the generator (and lexicalizer) on a batch of requests, return output texts."""
+        if self.use_context:
+            inputs = [(req.context or [], req.da) for req in batch]
+        else:
+            inputs = [req.da for req in batch]
+        trees = self.tgen.generate_trees(inputs)
+
+        if self.tgen.lexicalizer:
+            lex = [(tree, req.absts) for tree, req in zip(trees, batch) if req.absts is not None]
+            if lex:
+                self.tgen.lexicalizer.lexicalize_trees([tree for tree, _ in lex],
+                                                       [absts for _, absts in lex])
+        texts = []
+        for tree, req in zip(trees, batch):
+            toks = tree.to_tok_list()
+            postprocess_tokens([toks], [req.da])
+            texts.append(' '.join(tok for tok, _ in toks))
+        return texts
+
+    def _respond(self, req, response):
+        """Pass a response to the request's callback (adding the request ID)."""
+        response['id'] = req.req_id
+        try:
+            req.callback(response)
+        except Exception as e:
+            log_warn('Could not send response: %s' % unicode(e))
+
+
+def _format_response(response):
+    """Return a response as a JSON line (bytes)."""
+    return json.dumps(response) + b"\n"
+
+
+def serve_stdio(server, in_stream=None, out_stream=None):
+    """Serve requests from a stream of JSON lines (stdin by default), writing responses to another
+    stream (stdout by default). Requests are read ahead, so they can be batched. Returns once
+    the input is exhausted and all requests are finished.
+    @param server: a started `GenerationServer`
+    """
+    in_stream = in_stream or sys.stdin
+    out_stream = out_stream or sys.stdout
+    lock = threading.Lock()
+
+    def respond(response):
+        with lock:
+            out_stream.write(_format_response(response))
+            out_stream.flush()
+
+    # (not iterating over the file directly -- its read-ahead would delay the requests)
+    for line in iter(in_stream.readline, b''):
+        if line.strip():
+            server.submit(line, respond)
+    server.stop()
+
+
+class _ConnectionHandler(SocketServer.StreamRequestHandler):
+    """Handling one client connection: reading requests as they come, writing responses as they
+    are finished (requests on one connection may be pipelined)."""
+
+    def handle(self):
+        lock = threading.Condition()
+        pending = [0]
+
+        def respond(response):
+            with lock:
+                try:
+                    self.wfile.write(_format_response(response))
+                    self.wfile.flush()
+                except IOError:
+                    pass  # client has disconnected, nobody's listening anymore
+                pending[0] -= 1
+                lock.notify()
+
+        for line in iter(self.rfile.readline, b''):
+            if not line.strip():
+                continue
+            with lock:
+                pending[0] += 1
+            self.server.gen_server.submit(line, respond)
+
+        # wait for all responses before closing the connection
+        with lock:
+            while pending[0] > 0:
+                lock.wait()
+
+
+class _UnixSocketServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve_unix_socket(server, socket_path):
+    """Serve requests on a Unix domain socket (one thread per client connection), until
+    interrupted.
+    @param server: a started `GenerationServer`
+    @param socket_path: path to the socket to be created (an existing file will be removed)
+    """
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    sock_server = _UnixSocketServer(socket_path, _ConnectionHandler)
+    sock_server.gen_server = server
+    log_info('Listening on %s...' % socket_path)
+    try:
+        sock_server.serve_forever()
+    except KeyboardInterrupt:
+        log_info('Interrupted, shutting down...')
+    finally:
+        sock_server.server_close()
+        os.remove(socket_path)
+        server.stop()
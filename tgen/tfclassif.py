@@ -23,8 +23,7 @@ from pytreex.core.util import file_stream
 
 from tgen.rnd import rnd
 from tgen.logf import log_debug, log_info
-from tgen.futil import read_das, read_ttrees, trees_from_doc, tokens_from_doc, \
-    tagged_lemmas_from_doc
+from tgen.futil import read_das, trees_from_file, tokens_from_file, tagged_lemmas_from_file
 from tgen.features import Features
 from tgen.ml import DictVectorizer
 from tgen.embeddings import EmbeddingExtract, TokenEmbeddingSeq2SeqExtract, \
@@ -32,6 +31,7 @@ from tgen.embeddings import EmbeddingExtract, TokenEmbeddingSeq2SeqExtract, \
 from tgen.tree import TreeData
 from tgen.data import DA
 from tgen.tf_ml import TFModel
+from tgen.eval import p_r_f1_from_counts
 
 
 class TreeEmbeddingClassifExtract(EmbeddingExtract):
@@ -106,6 +106,11 @@ class RerankingClassifier(TFModel):
 
         self.nn_shape = cfg.get('nn_shape', 'ff')
         self.num_hidden_units = cfg.get('num_hidden_units', 512)
+        # use dynamic RNN with packed inputs (instead of static RNN with per-step inputs)
+        self.dynamic_rnn = cfg.get('dynamic_rnn', False)
+        # run the dynamic RNN over the whole left-padded input, without packing (this gives
+        # the same results as the static RNN; used for models converted from static RNN ones)
+        self.dynamic_rnn_full_len = cfg.get('dynamic_rnn_full_len', False)
 
         self.passes = cfg.get('passes', 200)
         self.min_passes = cfg.get('min_passes', 0)
@@ -114,9 +119,11 @@ class RerankingClassifier(TFModel):
         self.batch_size = cfg.get('batch_size', 1)
 
         self.validation_freq = cfg.get('validation_freq', 10)
+        self.valid_batch_size = cfg.get('valid_batch_size', 1000)
         self.max_cores = cfg.get('max_cores')
         self.cur_da = None
         self.cur_da_bin = None
+        self.da_bin_memo = {}
         self.checkpoint_path = None
 
         self.delex_slots = cfg.get('delex_slots', None)
@@ -228,8 +235,7 @@ class RerankingClassifier(TFModel):
 
                 valid_diff = 0
                 if valid_das:
-                    valid_diff = np.sum([np.sum(self.dist_to_da(d, t))
-                                         for d, t in zip(valid_das, valid_trees)])
+                    valid_diff = self._validate(valid_das, valid_trees)
 
                 # cost combining validation and training data performance
                 # (+ "real" cost with negligible weight)
@@ -257,7 +263,42 @@ class RerankingClassifier(TFModel):
         self._add_inputs_to_feed_dict(inputs, fd)
         results = self.session.run(self.outputs, feed_dict=fd)
         # normalize & binarize the result
-        return np.array([[1. if r > 0 else 0. for r in result] for result in results])
+        return (results > 0).astype(float)
+
+    def _validate(self, valid_das, valid_trees):
+        """Classify all validation trees in large batches (see `valid_batch_size`), compare to
+        validation DAs and log per-class precision and recall, as well as the total Hamming
+        error.
+
+        @param valid_das: validation data DAs
+        @param valid_trees: list of lists of corresponding paraphrases (same length as valid_das)
+        @return: total Hamming distance of all validation trees to their DAs
+        """
+        start_time = time.time()
+        das = [da for da, paraphrases in zip(valid_das, valid_trees) for _ in paraphrases]
+        trees = [tree for _, paraphrases in zip(valid_das, valid_trees) for tree in paraphrases]
+        if not trees:
+            return 0
+
+        pred = np.concatenate([self.classify(trees[i: i + self.valid_batch_size])
+                               for i in xrange(0, len(trees), self.valid_batch_size)]) != 0
+        gold = np.array([self._da_bin(da) for da in das])
+
+        # per-class statistics, all computed at once
+        correct = np.sum(pred & gold, axis=0)
+        predicted = np.sum(pred, axis=0)
+        golden = np.sum(gold, axis=0)
+        errors = np.sum(pred != gold, axis=0)
+        for name, c, p, g, e in zip(self.da_vect.get_feature_names(),
+                                    correct, predicted, golden, errors):
+            prec, rec, _ = p_r_f1_from_counts(c, p, g)
+            log_debug('VALID %s: P %.4f, R %.4f, errors %d' % (name, prec, rec, e))
+
+        valid_diff = np.sum(errors)
+        prec, rec, f1 = p_r_f1_from_counts(np.sum(correct), np.sum(predicted), np.sum(golden))
+        log_info('Validation: P %.4f, R %.4f, F1 %.4f, Hamming error %d, %.1f examples/sec' %
+                 (prec, rec, f1, valid_diff, len(trees) / max(time.time() - start_time, 1e-6)))
+        return valid_diff
 
     def _normalize_da(self, da):
         if isinstance(da, tuple):  # if DA is actually context + DA, ignore context
@@ -266,11 +307,21 @@ class RerankingClassifier(TFModel):
             da = da.get_delexicalized(self.delex_slots)
         return da
 
+    def _da_bin(self, da):
+        """Get the binarized representation of the given DA (as a boolean array). Results
+        are memoized, keyed by the normalized DA."""
+        da = self._normalize_da(da)
+        key = unicode(da)
+        da_bin = self.da_bin_memo.get(key)
+        if da_bin is None:
+            da_bin = self.da_vect.transform([self.da_feats.get_features(None, {'da': da})])[0] != 0
+            self.da_bin_memo[key] = da_bin
+        return da_bin
+
     def init_run(self, da):
         """Remember the current DA for subsequent runs of `dist_to_cur_da`."""
         self.cur_da = self._normalize_da(da)
-        da_bin = self.da_vect.transform([self.da_feats.get_features(None, {'da': self.cur_da})])[0]
-        self.cur_da_bin = da_bin != 0
+        self.cur_da_bin = self._da_bin(self.cur_da)
 
     def dist_to_da(self, da, trees):
         """Return Hamming distance of given trees to the given DA.
@@ -279,11 +330,26 @@ class RerankingClassifier(TFModel):
         @param trees: list of trees to measure the distance
         @return: list of Hamming distances for each tree
         """
-        da = self._normalize_da(da)
-        da_bin = self.da_vect.transform([self.da_feats.get_features(None, {'da': da})])[0]
-        da_bin = da_bin != 0
-        covered = self.classify(trees)
-        return [sum(abs(c - da_bin)) for c in covered]
+        return self.dist_to_das([da], [trees])[0]
+
+    def dist_to_das(self, das, trees_per_da):
+        """Return Hamming distances of given trees to the corresponding DAs. All the trees
+        are classified in a single batch.
+
+        @param das: list of DAs as the bases of the Hamming distance measure
+        @param trees_per_da: list of lists of trees (one list of trees per DA)
+        @return: list of lists of Hamming distances (one list per DA, one distance per tree)
+        """
+        trees = [tree for da_trees in trees_per_da for tree in da_trees]
+        if not trees:
+            return [[] for _ in das]
+        covered = self.classify(trees) != 0
+        da_bins = np.array([self._da_bin(da)
+                            for da, da_trees in zip(das, trees_per_da)
+                            for _ in da_trees])
+        dists = np.sum(covered != da_bins, axis=1)
+        bounds = np.cumsum([len(da_trees) for da_trees in trees_per_da])[:-1]
+        return [list(da_dists) for da_dists in np.split(dists, bounds)]
 
     def dist_to_cur_da(self, trees):
         """Return Hamming distance of given trees to the current DA (set in `init_run`).
@@ -291,9 +357,8 @@ class RerankingClassifier(TFModel):
         @param trees: list of trees to measure the distance
         @return: list of Hamming distances for each tree
         """
-        da_bin = self.cur_da_bin
-        covered = self.classify(trees)
-        return [sum(abs(c - da_bin)) for c in covered]
+        covered = self.classify(trees) != 0
+        return list(np.sum(covered != self.cur_da_bin, axis=1))
 
     def _init_training(self, das, trees, data_portion):
         """Initialize training.
@@ -311,15 +376,14 @@ class RerankingClassifier(TFModel):
             das = read_das(das)
         if not isinstance(trees, list):
             log_info('Reading t-trees from ' + trees + '...')
-            ttree_doc = read_ttrees(trees)
             if self.mode == 'tokens':
-                tokens = tokens_from_doc(ttree_doc, self.language, self.selector)
+                tokens = tokens_from_file(trees, self.language, self.selector)
                 trees = self._tokens_to_flat_trees(tokens)
             elif self.mode == 'tagged_lemmas':
-                tls = tagged_lemmas_from_doc(ttree_doc, self.language, self.selector)
+                tls = tagged_lemmas_from_file(trees, self.language, self.selector)
                 trees = self._tokens_to_flat_trees(tls, use_tags=True)
             else:
-                trees = trees_from_doc(ttree_doc, self.language, self.selector)
+                trees = trees_from_file(trees, self.language, self.selector)
         elif self.mode in ['tokens', 'tagged_lemmas']:
             trees = self._tokens_to_flat_trees(trees, use_tags=self.mode == 'tagged_lemmas')
 
@@ -414,10 +478,15 @@ class RerankingClassifier(TFModel):
             # RNNs
             elif self.nn_shape.startswith('rnn'):
                 self.initial_state = tf.placeholder(tf.float32, [None, self.emb_size])
-                self.inputs = [tf.placeholder(tf.int32, [None], name=('enc_inp-%d' % i))
-                               for i in xrange(self.input_shape[0])]
                 self.cell = tf.contrib.rnn.BasicLSTMCell(self.emb_size)
-                self.outputs = self._rnn('rnn', self.inputs)
+                if self.dynamic_rnn:
+                    self.inputs = tf.placeholder(tf.int32, [None, None], name='enc_inp')
+                    self.inputs_len = tf.placeholder(tf.int32, [None], name='enc_inp_len')
+                    self.outputs = self._dynamic_rnn('rnn', self.inputs, self.inputs_len)
+                else:
+                    self.inputs = [tf.placeholder(tf.int32, [None], name=('enc_inp-%d' % i))
+                                   for i in xrange(self.input_shape[0])]
+                    self.outputs = self._rnn('rnn', self.inputs)
 
         # the cost as computed by TF actually adds a "fake" sigmoid layer on top
         # (or is computed as if there were a sigmoid layer on top)
@@ -467,7 +536,22 @@ class RerankingClassifier(TFModel):
     def _rnn(self, name, enc_inputs):
         encoder_cell = tf.contrib.rnn.EmbeddingWrapper(self.cell, self.dict_size, self.emb_size)
         encoder_outputs, encoder_state = tf.contrib.rnn.static_rnn(encoder_cell, enc_inputs, dtype=tf.float32)
-
+        return self._rnn_output_layer(name, encoder_state)
+
+    def _dynamic_rnn(self, name, enc_inputs, enc_inputs_len):
+        """Dynamic RNN variant of `_rnn`, taking a single [batch, time] input tensor and sequence
+        lengths. The embedding matrix is named the same as in the static variant, minus the
+        embedding wrapper scope (see `util/rerank_cl_to_dynamic.py` for model conversion)."""
+        with tf.variable_scope('rnn'):
+            embedding = tf.get_variable('embedding', (self.dict_size, self.emb_size),
+                                        initializer=tf.random_uniform_initializer(-math.sqrt(3),
+                                                                                  math.sqrt(3)))
+        embedded = tf.nn.embedding_lookup(embedding, enc_inputs)
+        _, encoder_state = tf.nn.dynamic_rnn(self.cell, embedded, sequence_length=enc_inputs_len,
+                                             dtype=tf.float32, scope='rnn')
+        return self._rnn_output_layer(name, encoder_state)
+
+    def _rnn_output_layer(self, name, encoder_state):
         # TODO for historical reasons, the last layer uses both output and state.
         # try this just with outputs (might work exactly the same)
         if isinstance(self.cell.state_size, tf.contrib.rnn.LSTMStateTuple):
@@ -483,13 +567,48 @@ class RerankingClassifier(TFModel):
         return tf.matmul(final_input, w) + b
 
     def _batches(self):
-        """Create batches from the input; use as iterator."""
+        """Create batches from the input; use as iterator. For dynamic RNNs with packed
+        inputs, the batches are formed out of instances of similar length (and then shuffled,
+        if required)."""
+        if self.nn_shape.startswith('rnn') and self.dynamic_rnn and not self.dynamic_rnn_full_len:
+            lens = np.sum(self.X != self.tree_embs.VOID, axis=1)
+            order = sorted(self.train_order, key=lambda idx: lens[idx])
+            batches = [order[i: i + self.batch_size]
+                       for i in xrange(0, len(order), self.batch_size)]
+            if self.randomize:
+                rnd.shuffle(batches)
+            for batch in batches:
+                yield batch
+            return
         for i in xrange(0, len(self.train_order), self.batch_size):
             yield self.train_order[i: i + self.batch_size]
 
+    def _pack_inputs(self, inputs):
+        """Convert left-padded embedding IDs into right-padded ones, trimmed to the longest
+        instance in the batch (as required by the dynamic RNN).
+
+        @param inputs: 2D array of left-padded embedding IDs (batch x max. tree length)
+        @return: a tuple of right-padded 2D array of embedding IDs + 1D array of their lengths
+        """
+        inputs = np.asarray(inputs)
+        lens = np.sum(inputs != self.tree_embs.VOID, axis=1)
+        max_len = max(1, np.max(lens))
+        steps = np.arange(max_len)[np.newaxis, :]
+        idxs = np.minimum(steps + (inputs.shape[1] - lens)[:, np.newaxis], inputs.shape[1] - 1)
+        packed = inputs[np.arange(inputs.shape[0])[:, np.newaxis], idxs]
+        packed[steps >= lens[:, np.newaxis]] = self.tree_embs.VOID
+        return packed, lens
+
     def _add_inputs_to_feed_dict(self, inputs, fd):
 
-        if self.nn_shape.startswith('rnn'):
+        if self.nn_shape.startswith('rnn') and self.dynamic_rnn:
+            fd[self.initial_state] = np.zeros([inputs.shape[0], self.emb_size])
+            if self.dynamic_rnn_full_len:
+                fd[self.inputs] = inputs
+                fd[self.inputs_len] = np.repeat(inputs.shape[1], inputs.shape[0])
+            else:
+                fd[self.inputs], fd[self.inputs_len] = self._pack_inputs(inputs)
+        elif self.nn_shape.startswith('rnn'):
             fd[self.initial_state] = np.zeros([inputs.shape[0], self.emb_size])
             sliced_inputs = np.squeeze(np.array(np.split(np.array([ex for ex in inputs
                                                                    if ex is not None]),
@@ -525,7 +644,7 @@ class RerankingClassifier(TFModel):
             else:
                 results, cost, _ = self.session.run([self.outputs, self.cost, self.train_func],
                                                     feed_dict=fd)
-            bin_result = np.array([[1. if r > 0 else 0. for r in result] for result in results])
+            bin_result = (results > 0).astype(float)
 
             log_debug('R: ' + str(bin_result))
             log_debug('COST: %f' % cost)
@@ -535,15 +654,17 @@ class RerankingClassifier(TFModel):
             pass_diff += np.sum(np.abs(self.y[tree_nos] - bin_result))
 
         # print and return statistics
-        self._print_pass_stats(pass_no, datetime.timedelta(seconds=(time.time() - pass_start_time)),
-                               pass_cost, pass_diff)
+        pass_secs = time.time() - pass_start_time
+        self._print_pass_stats(pass_no, datetime.timedelta(seconds=pass_secs),
+                               pass_cost, pass_diff, len(self.train_order) / max(pass_secs, 1e-6))
         if self.train_summary_dir:  # Tensorboard: iteration summary
             self.train_summary_writer.add_summary(train_summary_op, pass_no)
 
         return pass_cost, pass_diff
 
-    def _print_pass_stats(self, pass_no, time, cost, diff):
-        log_info('PASS %03d: duration %s, cost %f, diff %d' % (pass_no, str(time), cost, diff))
+    def _print_pass_stats(self, pass_no, time, cost, diff, speed):
+        log_info('PASS %03d: duration %s, cost %f, diff %d, %.1f examples/sec' %
+                 (pass_no, str(time), cost, diff, speed))
 
     def evaluate_file(self, das_file, ttree_file):
         """Evaluate the reranking classifier on a given pair of DA/tree files (show the
@@ -554,21 +675,22 @@ class RerankingClassifier(TFModel):
         @return: a tuple (total DAIs, distance)
         """
         das = read_das(das_file)
-        ttree_doc = read_ttrees(ttree_file)
         if self.mode == 'tokens':
-            tokens = tokens_from_doc(ttree_doc, self.language, self.selector)
+            tokens = tokens_from_file(ttree_file, self.language, self.selector)
             trees = self._tokens_to_flat_trees(tokens)
         elif self.mode == 'tagged_lemmas':
-            tls = tagged_lemmas_from_doc(ttree_doc, self.language, self.selector)
+            tls = tagged_lemmas_from_file(ttree_file, self.language, self.selector)
             trees = self._tokens_to_flat_trees(tls)
         else:
-            trees = trees_from_doc(ttree_doc, self.language, self.selector)
+            trees = trees_from_file(ttree_file, self.language, self.selector)
 
-        da_len = 0
+        pairs = zip(das, trees)
+        da_len = sum(len(da) for da, _ in pairs)
+        # classify in batches of limited size (see `valid_batch_size`)
         dist = 0
-
-        for da, tree in zip(das, trees):
-            da_len += len(da)
-            dist += self.dist_to_da(da, [tree])[0]
+        for i in xrange(0, len(pairs), self.valid_batch_size):
+            batch = pairs[i: i + self.valid_batch_size]
+            dists = self.dist_to_das([da for da, _ in batch], [[tree] for _, tree in batch])
+            dist += sum(da_dists[0] for da_dists in dists)
 
         return da_len, dist
@@ -345,9 +345,56 @@ class TreeData(object):
     def common_subtree_size(self, other):
         """Return the common subtree size of the two trees; the technical root is counted,
         i.e. the common subtree size >= 1.
+
+        Works iteratively, with the same results as `_common_subtree_size`. Identical subtrees
+        (with equal signatures, see `_subtree_signatures`) are not traversed, their whole
+        size is counted right away.
         @rtype: integer
         """
-        return TreeData._common_subtree_size(self, -1, other, -1)
+        sig_ids = {}
+        children_a, sizes_a, sigs_a = self._subtree_signatures(sig_ids)
+        children_b, sizes_b, sigs_b = other._subtree_signatures(sig_ids)
+        size = 0
+        stack = [(self.children_idxs(-1), other.children_idxs(-1))]
+        while stack:
+            idxs_a, idxs_b = stack.pop()
+            com_ch_a, com_ch_b = TreeData._longest_common_subseq(self, idxs_a, other, idxs_b)
+            size += len(com_ch_a)
+            for idx_a, idx_b in zip(com_ch_a, com_ch_b):
+                if sigs_a[idx_a] == sigs_b[idx_b]:
+                    size += sizes_a[idx_a] - 1
+                else:
+                    stack.append((children_a[idx_a], children_b[idx_b]))
+        return size
+
+    def _subtree_signatures(self, sig_ids):
+        """Compute children lists, subtree sizes, and subtree signatures for all nodes
+        (in one bottom-up pass). Signatures are IDs assigned to (node, is right child,
+        children's signatures) in the given table, so equal signatures mean identical subtrees.
+
+        @param sig_ids: signature ID table (dict, shared by all trees to be compared)
+        @return: a tuple: lists of children indexes, subtree sizes, and signatures for all nodes
+        """
+        children = [[] for _ in self.nodes]
+        for idx, parent_idx in enumerate(self.parents):
+            if parent_idx >= 0:
+                children[parent_idx].append(idx)
+        # pre-order traversal; reversed, it has all children before their parents
+        order = []
+        stack = [idx for idx, parent_idx in enumerate(self.parents) if parent_idx < 0]
+        while stack:
+            idx = stack.pop()
+            order.append(idx)
+            stack.extend(children[idx])
+        sizes = [1] * len(self.nodes)
+        sigs = [None] * len(self.nodes)
+        for idx in reversed(order):
+            for child_idx in children[idx]:
+                sizes[idx] += sizes[child_idx]
+            sig = (self.nodes[idx], self.parents[idx] < idx,
+                   tuple(sigs[child_idx] for child_idx in children[idx]))
+            sigs[idx] = sig_ids.setdefault(sig, len(sig_ids))
+        return children, sizes, sigs
 
     @staticmethod
     def _common_subtree_idxs(tree_a, idx_a, tree_b, idx_b):
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark beam search decoding of a trained Seq2Seq generator, comparing the step-by-step
+beam search (one TF session call per path and step) with the in-graph beam search (the whole
+search in a single TF session call, for one sentence or a whole batch of sentences).
+
+Checks that both produce the same n-best lists and reports per-sentence latency.
+
+Usage: ./bench_beam_search.py [-b beam_size] [-s batch_size] seq2seq_model.pickle.gz test-das.txt
+"""
+
+from __future__ import unicode_literals
+from argparse import ArgumentParser
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from tgen.seq2seq import Seq2SeqBase, cut_batch_into_steps
+from tgen.futil import read_das
+
+
+def nbest_strings(paths):
+    """Represent an n-best list as token ID sequences, rounded log probabilities and lengths."""
+    return [([int(inp[0]) for inp in path.dec_inputs], round(path.logprob, 4), len(path))
+            for path in paths]
+
+
+if __name__ == '__main__':
+    ap = ArgumentParser()
+    ap.add_argument('-b', '--beam-size', type=int, help='Override beam size')
+    ap.add_argument('-s', '--batch-size', type=int, default=20,
+                    help='Batch size for batched in-graph beam search')
+    ap.add_argument('seq2seq_model_file', type=str, help='Trained Seq2Seq generator model')
+    ap.add_argument('das_file', type=str, help='Input DAs')
+    args = ap.parse_args()
+
+    print >> sys.stderr, 'Loading...'
+    tgen = Seq2SeqBase.load_from_file(args.seq2seq_model_file)
+    if args.beam_size is not None:
+        tgen.beam_size = args.beam_size
+    # the in-graph beam search decoder is only built if enabled in the model configuration
+    if (not hasattr(tgen, 'beam_tokens') and getattr(tgen, 'saver', None) is not None and
+            tgen.nn_type in ['emb_attention_seq2seq', 'emb_attention2_seq2seq']):
+        with tf.variable_scope(tgen.scope_name, reuse=True):
+            tgen._init_beam_search_graph()
+    if not hasattr(tgen, 'beam_tokens'):
+        sys.exit('In-graph beam search is not supported for this model')
+    das = read_das(args.das_file)
+    if tgen.use_context:
+        das = [da[1] for da in das]
+    enc_inputs = [tgen.da_embs.get_embeddings(da) for da in das]
+
+    results = {}
+    times = {}
+    for name in ['step-by-step', 'in-graph']:
+        print >> sys.stderr, 'Running test (%s)...' % name
+        results[name] = []
+        times[name] = []
+        for enc_input in enc_inputs:
+            enc_input = cut_batch_into_steps([enc_input])
+            start = time.time()
+            if name == 'step-by-step':
+                paths = tgen._beam_search_paths(enc_input)
+            else:
+                paths = tgen._beam_search_in_graph(enc_input)[0]
+            times[name].append(time.time() - start)
+            results[name].append(nbest_strings(paths))
+
+    print >> sys.stderr, 'Running test (in-graph, batches of %d)...' % args.batch_size
+    results['in-graph batched'] = []
+    start = time.time()
+    for pos in xrange(0, len(enc_inputs), args.batch_size):
+        batch = cut_batch_into_steps(enc_inputs[pos:pos + args.batch_size])
+        results['in-graph batched'].extend([nbest_strings(paths)
+                                            for paths in tgen._beam_search_in_graph(batch)])
+    times['in-graph batched'] = [(time.time() - start) / len(enc_inputs)]
+
+    for name in ['step-by-step', 'in-graph', 'in-graph batched']:
+        print >> sys.stderr, 'Per-sentence latency (%s): mean %.2f ms, median %.2f ms' % (
+            name, 1000 * np.mean(times[name]), 1000 * np.median(times[name]))
+
+    for name in ['in-graph', 'in-graph batched']:
+        diffs = sum(1 for res1, res2 in zip(results['step-by-step'], results[name])
+                    if res1 != res2)
+        if diffs:
+            print >> sys.stderr, 'WARNING: %s n-best lists differ for %d sentences!' % (name, diffs)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark lexicalization of delexicalized sentences (e.g. the E2E devset), comparing surface
+form lookup through the flat surface form index and through the nested surface form tables.
+
+Usage: ./bench_lexicalize.py [-n repeats] model.lexic.pickle.gz devel-text.txt devel-abst.txt
+"""
+
+from __future__ import unicode_literals
+from argparse import ArgumentParser
+import sys
+import timeit
+import datetime
+
+from tgen.lexicalize import Lexicalizer
+from tgen.futil import read_tokens
+from tgen.tree import TreeData, NodeData
+from tgen.rnd import rnd
+
+
+def tokens_to_trees(sents):
+    """Build flat trees from the given delexicalized sentences (lists of form-tag pairs)."""
+    trees = []
+    for sent in sents:
+        tree = TreeData()
+        for form, _ in sent:
+            tree.create_child(0, len(tree), NodeData(form, 'x'))
+        trees.append(tree)
+    return trees
+
+
+def run_lexicalizer(lexicalizer, sents, abst_file):
+    """Lexicalize all the given sentences, return the resulting trees."""
+    rnd.seed(1206)
+    trees = tokens_to_trees(sents)
+    lexicalizer.lexicalize(trees, abst_file)
+    return trees
+
+
+if __name__ == '__main__':
+    ap = ArgumentParser()
+    ap.add_argument('-n', '--repeats', type=int, default=10, help='Number of test runs')
+    ap.add_argument('lexic_file', type=str, help='Path to the lexicalizer model')
+    ap.add_argument('text_file', type=str, help='Delexicalized sentences')
+    ap.add_argument('abst_file', type=str, help='Lexicalization instructions')
+    args = ap.parse_args()
+
+    print >> sys.stderr, 'Loading...'
+    lexicalizer = Lexicalizer.load_from_file(args.lexic_file)
+    if lexicalizer.mode != 'tokens':
+        sys.exit('Only lexicalizers in the tokens mode are supported')
+    sents = read_tokens(args.text_file, ref_mode=True)
+    if sents and sents[0] and isinstance(sents[0][0], list):  # multiple references: take the 1st one
+        sents = [refs[0] for refs in sents]
+    lexicalizer._load_sf_tables()  # needed for the nested tables path
+    if lexicalizer._form_index is None:
+        lexicalizer.use_form_index = True
+        lexicalizer._build_form_index()
+    form_index = lexicalizer._form_index
+
+    results = {}
+    for name, index in [('nested tables', None), ('flat index', form_index)]:
+        lexicalizer._form_index = index
+        results[name] = run_lexicalizer(lexicalizer, sents, args.abst_file)
+
+        print >> sys.stderr, 'Running test (%s)...' % name
+        secs = timeit.timeit(lambda: run_lexicalizer(lexicalizer, sents, args.abst_file),
+                             number=args.repeats)
+        td = datetime.timedelta(seconds=secs)
+        print >> sys.stderr, 'Time taken (%s): %s (%.1f sents/sec)' % (
+            name, str(td), len(sents) * args.repeats / secs)
+
+    if results['nested tables'] != results['flat index']:
+        print >> sys.stderr, 'WARNING: outputs differ!'
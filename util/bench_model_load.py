@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark loading of a trained Seq2Seq generator: full loading (training and decoding network,
+optimizer), inference-only loading (decoding network only), and loading the frozen inference
+graph (if present, or if created with -f). Each variant is loaded in a separate process, several
+times; with -d, the loaded models are also used to generate outputs for the given DAs, and the
+outputs are checked to be the same.
+
+Usage: ./bench_model_load.py [-f] [-n repeats] [-d test-das.txt] seq2seq_model.pickle.gz
+"""
+
+from __future__ import unicode_literals
+from argparse import ArgumentParser, SUPPRESS
+import hashlib
+import json
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+def load_and_generate(model_fname, inference_only, das_file, freeze):
+    """Load the model (in this process), optionally generate outputs for the given DAs and
+    save the frozen graph. Print the load time and a hash of the outputs as JSON."""
+    from tgen.seq2seq import Seq2SeqBase
+    from tgen.futil import read_das
+
+    start = time.time()
+    tgen = Seq2SeqBase.load_from_file(model_fname, inference_only=inference_only)
+    load_time = time.time() - start
+    res = {'load_time': load_time, 'frozen': getattr(tgen, 'saver', True) is None}
+
+    if das_file:
+        das = read_das(das_file)
+        if tgen.use_context or tgen.context_bleu_weight:
+            das = [([], da) for da in das]
+        outputs = [unicode(tree) for tree in tgen.generate_trees(das)]
+        res['outputs_hash'] = hashlib.md5('\n'.join(outputs).encode('UTF-8')).hexdigest()
+
+    if freeze:
+        tgen.save_frozen_graph(model_fname)
+    print json.dumps(res)
+
+
+def run_child(args, inference_only, freeze=False):
+    """Run the loading in a separate process, return its results."""
+    cmd = [sys.executable, __file__, '--child']
+    if inference_only:
+        cmd.append('--inference-only')
+    if freeze:
+        cmd.append('--freeze')
+    if args.das_file:
+        cmd.extend(['-d', args.das_file])
+    cmd.append(args.seq2seq_model_file)
+    output = subprocess.check_output(cmd)
+    return json.loads(output.strip().split('\n')[-1])
+
+
+if __name__ == '__main__':
+    ap = ArgumentParser()
+    ap.add_argument('-f', '--freeze', action='store_true',
+                    help='Create the frozen inference graph for the model')
+    ap.add_argument('-n', '--repeats', type=int, default=3,
+                    help='Number of loads for each variant')
+    ap.add_argument('-d', '--das-file', type=str,
+                    help='Input DAs to generate from (to check that outputs are the same)')
+    ap.add_argument('--child', action='store_true', help=SUPPRESS)
+    ap.add_argument('--inference-only', action='store_true', help=SUPPRESS)
+    ap.add_argument('seq2seq_model_file', type=str, help='Trained Seq2Seq generator model')
+    args = ap.parse_args()
+
+    if args.child:
+        load_and_generate(args.seq2seq_model_file, args.inference_only, args.das_file, args.freeze)
+        sys.exit()
+
+    results = {}
+    for name, inference_only in [('full', False), ('inference-only', True), ('frozen', True)]:
+        if name == 'frozen':
+            if not args.freeze:
+                break
+            print >> sys.stderr, 'Creating frozen inference graph...'
+            run_child(args, True, freeze=True)
+        print >> sys.stderr, 'Loading (%s)...' % name
+        runs = [run_child(args, inference_only) for _ in xrange(args.repeats)]
+        if name == 'inference-only' and runs[0]['frozen']:
+            name = 'frozen'  # an existing frozen graph is used automatically
+        results[name] = runs
+        print 'Load time (%s): mean %.3f s, min %.3f s' % (
+            name, np.mean([run['load_time'] for run in runs]),
+            min(run['load_time'] for run in runs))
+
+    if args.das_file:
+        hashes = set(run['outputs_hash'] for runs in results.itervalues() for run in runs)
+        if len(hashes) > 1:
+            print >> sys.stderr, 'WARNING: outputs differ among the variants!'
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Differential check of the compiled tokenizer (tgen.futil.tokenize) against the original
+rule-by-rule implementation (tgen.futil.tokenize_reference).
+
+Tokenizes all lines of the given text files (e.g. raw sentences from the bundled datasets)
+and a randomly generated corpus of strings with lots of punctuation, numbers, contractions,
+and assorted Unicode characters and whitespace, and reports any differences. Also reports
+the time taken by both implementations.
+
+Usage: ./check_tokenize.py [-n random-sents] [-s seed] [text-file...]
+"""
+
+from __future__ import unicode_literals
+from argparse import ArgumentParser
+import codecs
+import random
+import sys
+import time
+
+from tgen.futil import tokenize, tokenize_reference
+
+
+# building blocks of random sentences
+WORDS = ['I', 'm', 's', 'd', 'll', 're', 've', 'n', 't', 'don', 'can', 'cannot', 'Cannot',
+         'd', 'D', 'ye', 'gimme', 'Gimme', 'gonna', 'gotta', 'Gotta', 'lemme', 'more', 'More',
+         'tis', 'Tis', 'twas', 'wanna', 'Wanna', 'the', 'Aromi', 'café', 'Žluťoučký', 'X-name',
+         '£20', '20', '3.5', '1,000', '½', '²', '٣', 'ß', '東京', 'e.g', 'etc', 'mid-range']
+CHARS = (['.', ',', '-', '−', '–', '—', '\'', '’', '´', '"', '!', '?', '(', ')', ':', ';', '&',
+          '/', '$', '£', '%', '…', '°'] + list('aenst019') +
+         ['²', '½', 'é', 'Ω', '٣', '́', '\x00'])
+SPACES = [' '] * 20 + ['  ', '\t', '\n', '\xa0', ' ', '　', '\x1c', '​']
+
+
+def random_sent(rnd):
+    """Generate a random sentence from words, punctuation, and various spaces."""
+    parts = []
+    for _ in xrange(rnd.randint(0, 25)):
+        roll = rnd.random()
+        if roll < 0.5:
+            parts.append(rnd.choice(WORDS))
+        elif roll < 0.8:
+            parts.append(rnd.choice(CHARS) * rnd.choice([1, 1, 1, 2, 3]))
+        else:
+            parts.append(unichr(rnd.randint(0x20, 0x3000)))
+        parts.append(rnd.choice(SPACES) if rnd.random() < 0.6 else '')
+    return ''.join(parts)
+
+
+def check(sents, name):
+    """Tokenize the given sentences by both tokenizers, report differences & timing.
+    @return: number of differences
+    """
+    start = time.time()
+    ref = [tokenize_reference(sent) for sent in sents]
+    ref_time = time.time() - start
+    start = time.time()
+    out = [tokenize(sent) for sent in sents]
+    out_time = time.time() - start
+
+    diffs = 0
+    for sent, ref_toks, out_toks in zip(sents, ref, out):
+        if ref_toks != out_toks:
+            diffs += 1
+            if diffs <= 10:
+                print >> sys.stderr, ('DIFF:\n IN:  %r\n REF: %r\n OUT: %r' %
+                                      (sent, ref_toks, out_toks))
+    print >> sys.stderr, ('%s: %d sentences, %d differences, reference %.3f s, '
+                          'compiled %.3f s (%.1fx faster)' %
+                          (name, len(sents), diffs, ref_time, out_time,
+                           ref_time / max(out_time, 1e-9)))
+    return diffs
+
+
+if __name__ == '__main__':
+    ap = ArgumentParser()
+    ap.add_argument('-n', '--num-random', type=int, default=100000,
+                    help='Number of random sentences to check')
+    ap.add_argument('-s', '--seed', type=int, default=1206, help='Random seed')
+    ap.add_argument('text_files', type=str, nargs='*', help='Text files to check (line by line)')
+    args = ap.parse_args()
+
+    diffs = 0
+    for fname in args.text_files:
+        with codecs.open(fname, 'r', 'UTF-8') as fh:
+            diffs += check([line.rstrip('\r\n') for line in fh], fname)
+
+    rnd = random.Random(args.seed)
+    diffs += check([random_sent(rnd) for _ in xrange(args.num_random)], 'random')
+
+    if diffs:
+        sys.exit('Found %d differences!' % diffs)
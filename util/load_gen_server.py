@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Load generator for the Seq2Seq generation server (`run_tgen.py seq2seq_serve -s <socket>`):
+sends requests with DAs from a file over the given number of concurrent connections (each
+connection waits for a response before sending its next request) and reports latency
+percentiles and throughput.
+
+Usage: ./load_gen_server.py [-c concurrency] [-n num-requests] [-a abstr-file] [-w warmup] \\
+        socket-path test-das.txt
+"""
+
+from __future__ import unicode_literals
+from argparse import ArgumentParser
+import codecs
+import json
+import socket
+import sys
+import threading
+import time
+
+import numpy as np
+
+
+def read_lines(fname):
+    """Read all lines of a file (without the trailing newlines)."""
+    with codecs.open(fname, 'r', 'UTF-8') as fh:
+        return [line.rstrip('\r\n') for line in fh]
+
+
+def run_client(socket_path, requests, latencies, errors):
+    """Send the given requests over a single connection one by one, waiting for each response.
+    Record latencies (in seconds) and error messages."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    rfile = sock.makefile('rb')
+    try:
+        for request in requests:
+            start = time.time()
+            sock.sendall(request)
+            response = json.loads(rfile.readline())
+            latencies.append(time.time() - start)
+            if 'error' in response:
+                errors.append(response['error'])
+    finally:
+        rfile.close()
+        sock.close()
+
+
+def run_load(socket_path, requests, concurrency):
+    """Distribute the requests among the given number of concurrent clients and run them.
+    @return: a tuple: list of latencies, list of errors, total wall-clock time
+    """
+    latencies, errors = [], []
+    threads = [threading.Thread(target=run_client,
+                                args=(socket_path, requests[num::concurrency], latencies, errors))
+               for num in xrange(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors, time.time() - start
+
+
+if __name__ == '__main__':
+    ap = ArgumentParser()
+    ap.add_argument('-c', '--concurrency', type=int, default=1,
+                    help='Number of concurrent client connections')
+    ap.add_argument('-n', '--num-requests', type=int,
+                    help='Total number of requests (default: one per input DA; DAs are ' +
+                    'repeated if needed)')
+    ap.add_argument('-a', '--abstr-file', type=str,
+                    help='Lexicalization instructions for the DAs (one line per DA)')
+    ap.add_argument('-w', '--warmup', type=int, default=0,
+                    help='Number of warm-up requests sent before measuring')
+    ap.add_argument('socket_path', type=str, help='Generation server socket')
+    ap.add_argument('das_file', type=str, help='Input DAs')
+    args = ap.parse_args()
+
+    das = read_lines(args.das_file)
+    absts = read_lines(args.abstr_file) if args.abstr_file else None
+    num_requests = args.num_requests or len(das)
+    requests = []
+    for num in xrange(num_requests):
+        request = {'id': num, 'da': das[num % len(das)]}
+        if absts is not None:
+            request['absts'] = absts[num % len(das)]
+        requests.append(json.dumps(request) + b"\n")
+
+    if args.warmup:
+        print >> sys.stderr, 'Warming up (%d requests)...' % args.warmup
+        run_load(args.socket_path, requests[:args.warmup], args.concurrency)
+
+    print >> sys.stderr, 'Sending %d requests over %d connections...' % (num_requests,
+                                                                         args.concurrency)
+    latencies, errors, total_time = run_load(args.socket_path, requests, args.concurrency)
+
+    latencies = 1000 * np.array(latencies)
+    print 'Requests: %d, errors: %d, concurrency: %d' % (len(latencies), len(errors),
+                                                         args.concurrency)
+    print 'Latency: mean %.2f ms, p50 %.2f ms, p99 %.2f ms, max %.2f ms' % (
+        np.mean(latencies), np.percentile(latencies, 50), np.percentile(latencies, 99),
+        np.max(latencies))
+    print 'Throughput: %.2f requests/s' % (len(latencies) / total_time)
+    if errors:
+        print >> sys.stderr, 'First error: %s' % errors[0]
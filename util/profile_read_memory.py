@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Check that streaming reading of DA files (tgen.futil.iter_das) runs in constant memory:
+creates a synthetic DA file with the given number of lines (or uses an existing one),
+reads it through, and reports the process resident set size (RSS) as it goes.
+
+Exits with an error if RSS grows by more than the given tolerance after the first
+reported checkpoint.
+
+Usage: ./profile_read_memory.py [-n num-lines] [-c chunk-size] [-t tolerance-MB] [das-file]
+"""
+
+from __future__ import unicode_literals
+from argparse import ArgumentParser
+import resource
+import tempfile
+import os
+import sys
+
+from tgen.futil import file_stream, iter_das
+
+
+def get_rss_mb():
+    """Return current resident set size of this process in MB (maximum RSS if the current
+    value is not available)."""
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * resource.getpagesize() / (1024.0 ** 2)
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def create_da_file(fname, num_lines):
+    """Write a synthetic DA file with the given number of lines."""
+    with file_stream(fname, 'w') as fh:
+        for num in xrange(num_lines):
+            print >> fh, ('inform(name="X-name %d",food=italian,area=centre,pricerange=cheap)&' +
+                          'request(phone)') % num
+
+
+if __name__ == '__main__':
+    ap = ArgumentParser()
+    ap.add_argument('-n', '--num-lines', type=int, default=10000000,
+                    help='Number of lines of the synthetic DA file')
+    ap.add_argument('-c', '--chunk-size', type=int, default=None,
+                    help='Read DAs in chunks of the given size')
+    ap.add_argument('-t', '--tolerance', type=float, default=10.0,
+                    help='Maximum allowed RSS growth (MB)')
+    ap.add_argument('das_file', type=str, nargs='?', help='Existing DA file to read instead')
+    args = ap.parse_args()
+
+    das_file = args.das_file
+    if das_file is None:
+        fd, das_file = tempfile.mkstemp(suffix='.txt', prefix='das-')
+        os.close(fd)
+        print >> sys.stderr, 'Creating %s with %d lines...' % (das_file, args.num_lines)
+        create_da_file(das_file, args.num_lines)
+
+    try:
+        report_every = max(1, args.num_lines // 10)
+        base_rss = None
+        max_rss = 0.0
+        num_das = 0
+        for item in iter_das(das_file, args.chunk_size):
+            num_das += len(item) if args.chunk_size else 1
+            if num_das % report_every < (args.chunk_size or 1):
+                rss = get_rss_mb()
+                if base_rss is None:
+                    base_rss = rss
+                max_rss = max(max_rss, rss)
+                print >> sys.stderr, 'DAs read: %d, RSS: %.1f MB' % (num_das, rss)
+    finally:
+        if args.das_file is None:
+            os.remove(das_file)
+
+    print >> sys.stderr, 'Total DAs: %d, RSS growth: %.1f MB' % (num_das, max_rss - (base_rss or 0))
+    if base_rss is not None and max_rss - base_rss > args.tolerance:
+        sys.exit('RSS grew by more than %.1f MB!' % args.tolerance)
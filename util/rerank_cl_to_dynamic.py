@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+"""
+Convert a saved RNN reranking classifier using static RNN into one using dynamic RNN
+(renames the variables in the TF checkpoint as needed).
+
+By default, the converted model runs the dynamic RNN over the whole left-padded input
+(`dynamic_rnn_full_len` is stored in its configuration), so it gives the same outputs as
+the original one. With `-p`, the converted model uses packed inputs and skips the padding,
+which is faster, but its outputs differ from the original model's (the padding steps
+change the RNN state in the static model).
+
+The outputs of both models are compared on a random sample batch after conversion; the
+conversion fails if they differ (in the packed mode, just a warning is shown).
+"""
+
+from __future__ import unicode_literals
+from argparse import ArgumentParser
+import cPickle as pickle
+import re
+import os
+import sys
+
+import numpy as np
+
+import tensorflow as tf
+from tensorflow.python.framework.ops import reset_default_graph
+
+from pytreex.core.util import file_stream
+from tgen.tfclassif import RerankingClassifier
+from tgen.logf import log_info, log_warn
+
+
+def static_to_dynamic_var_name(name):
+    """Get the dynamic RNN variable name corresponding to a static RNN variable name
+    (the dynamic RNN does not use an embedding wrapper)."""
+    return re.sub(r'/(EmbeddingWrapper|embedding_wrapper)/', '/', name)
+
+
+def sample_inputs(model, num_insts=64):
+    """Create a random batch of left-padded embedding IDs to compare the models on."""
+    rng = np.random.RandomState(1234)
+    void = model.tree_embs.VOID
+    width = model.input_shape[0]
+    inputs = rng.randint(void + 1, model.dict_size, (num_insts, width))
+    lens = rng.randint(1, width + 1, num_insts)
+    inputs[np.arange(width)[np.newaxis, :] < (width - lens)[:, np.newaxis]] = void
+    return inputs
+
+
+def get_logits(model, inputs):
+    """Get the raw classifier outputs for the given inputs."""
+    fd = {}
+    model._add_inputs_to_feed_dict(inputs, fd)
+    return model.session.run(model.outputs, feed_dict=fd)
+
+
+def convert_model(model_fname, out_fname, packed=False):
+    """Convert the model and compare its outputs with the original model.
+
+    @param model_fname: path to the static RNN model
+    @param out_fname: path where to save the dynamic RNN model
+    @param packed: use packed inputs (skip the padding) in the converted model?
+    @return: True if the outputs of the converted model match the original model
+    """
+    # get the original model's outputs on a sample batch
+    reset_default_graph()
+    model = RerankingClassifier.load_from_file(model_fname)
+    inputs = sample_inputs(model)
+    orig_logits = get_logits(model, inputs)
+
+    reset_default_graph()
+    log_info('Converting %s to %s...' % (model_fname, out_fname))
+    with file_stream(model_fname, 'rb', encoding=None) as fh:
+        data = pickle.load(fh)
+    data['cfg']['dynamic_rnn'] = True
+    data['cfg']['dynamic_rnn_full_len'] = not packed
+    model = RerankingClassifier(cfg=data['cfg'])
+    model.load_all_settings(data)
+    model._init_neural_network()
+    model.session.run(tf.global_variables_initializer())
+
+    # load the static RNN checkpoint variables under their new names
+    tf_session_fname = os.path.abspath(re.sub(r'(.pickle)?(.gz)?$', '.tfsess', model_fname))
+    vals = {}
+    for name, _ in tf.contrib.framework.list_variables(tf_session_fname):
+        vals[static_to_dynamic_var_name(name) + ':0'] = \
+            tf.contrib.framework.load_variable(tf_session_fname, name)
+    missing = [var.name for var in tf.global_variables()
+               if var.name.startswith(model.scope_name) and var.name not in vals]
+    if missing:
+        log_warn('Variables not found in the original model: %s' % ', '.join(missing))
+    model.set_model_params(vals)
+
+    # compare the outputs
+    logits = get_logits(model, inputs)
+    max_diff = np.max(np.abs(logits - orig_logits))
+    log_info('Max. difference of outputs on a sample batch: %g' % max_diff)
+    if not np.allclose(logits, orig_logits, atol=1e-5):
+        if not packed:
+            log_warn('The converted model gives different outputs, not saving it.')
+            return False
+        log_warn('The converted model gives different outputs (expected with packed inputs).')
+    model.save_to_file(out_fname)
+    return True
+
+
+if __name__ == '__main__':
+    ap = ArgumentParser()
+    ap.add_argument('-p', '--packed', action='store_true',
+                    help='Use packed inputs (faster, but outputs differ from the original model)')
+    ap.add_argument('model_file', type=str, help='Path to the static RNN model')
+    ap.add_argument('out_file', type=str, help='Path to the converted dynamic RNN model')
+    args = ap.parse_args()
+
+    if not convert_model(args.model_file, args.out_file, args.packed):
+        sys.exit(1)